@@ -0,0 +1,151 @@
+"""
+POST /api/batch/: várias requisições da API em uma única chamada HTTP.
+
+As sub-requisições são resolvidas pelas rotas do projeto e executadas no mesmo processo,
+com o usuário já autenticado na requisição do batch e a mesma conexão com o banco.
+"""
+import json
+from contextlib import ExitStack
+from io import BytesIO
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import transaction
+from django.urls import Resolver404, resolve
+from rest_framework import serializers, status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from processos import shards
+
+METODOS = ['GET', 'POST', 'PUT', 'PATCH', 'DELETE']
+
+# cabeçalhos gerados pelo próprio DRF/HTTP, omitidos das sub-respostas
+CABECALHOS_OMITIDOS = ('Content-Type', 'Content-Length', 'Vary', 'Allow')
+
+# META da requisição do batch repassado às sub-requisições (o resto vem de cada sub-requisição)
+META_COMPARTILHADO = ('SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL', 'REMOTE_ADDR', 'HTTP_HOST', 'wsgi.url_scheme')
+
+
+class SubRequisicaoSerializer(serializers.Serializer):
+    metodo = serializers.ChoiceField(choices=METODOS)
+    url = serializers.CharField(max_length=2000)
+    corpo = serializers.JSONField(required=False, allow_null=True, default=None)
+    cabecalhos = serializers.DictField(child=serializers.CharField(), required=False, default=dict)
+
+    def validate_url(self, value):
+        if not value.startswith('/api/') or value.split('?')[0].rstrip('/') == '/api/batch':
+            raise serializers.ValidationError("A URL deve ser uma rota da API (exceto /api/batch/).")
+        return value
+
+
+class BatchSerializer(serializers.Serializer):
+    transacional = serializers.BooleanField(default=False)
+    requisicoes = SubRequisicaoSerializer(many=True, allow_empty=False)
+
+    def validate_requisicoes(self, value):
+        maximo = getattr(settings, 'BATCH_MAX_REQUISICOES', 20)
+        if len(value) > maximo:
+            raise serializers.ValidationError(f"No máximo {maximo} requisições por batch.")
+        return value
+
+
+def _criar_sub_requisicao(request, sub):
+    caminho, _, query_string = sub['url'].partition('?')
+    corpo = b'' if sub['corpo'] is None else json.dumps(sub['corpo']).encode('utf-8')
+
+    environ = {chave: valor for chave, valor in request.META.items() if chave in META_COMPARTILHADO}
+    environ.update({
+        'REQUEST_METHOD': sub['metodo'],
+        'PATH_INFO': caminho,
+        'QUERY_STRING': query_string,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(corpo)),
+        'wsgi.input': BytesIO(corpo),
+    })
+    for nome, valor in sub['cabecalhos'].items():
+        environ['HTTP_' + nome.upper().replace('-', '_')] = valor
+
+    sub_requisicao = WSGIRequest(environ)
+    # lidos pelo DRF (ForcedAuthentication): a sub-requisição não decodifica o JWT de novo
+    sub_requisicao._force_auth_user = request.user
+    sub_requisicao._force_auth_token = request.auth
+    return sub_requisicao
+
+
+def _corpo_resposta(response):
+    if not response.content:
+        return None
+    if response.get('Content-Type', '').startswith('application/json'):
+        return json.loads(response.content)
+    return response.content.decode(response.charset)
+
+
+class BatchView(APIView):
+    """
+    Executa uma lista de sub-requisições e devolve o status e o corpo de cada uma.
+
+    Com "transacional": true, todas rodam em uma única transação em cada alias: a primeira resposta
+    com status >= 400 desfaz as anteriores e as seguintes não são executadas. Os commits dos aliases
+    são independentes (não há two-phase commit): uma falha do banco entre eles não é desfeita.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = BatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        transacional = serializer.validated_data['transacional']
+        requisicoes = serializer.validated_data['requisicoes']
+
+        rotas = []
+        for sub in requisicoes:
+            try:
+                rotas.append(resolve(sub['url'].partition('?')[0]))
+            except Resolver404:
+                rotas.append(None)
+
+        if not transacional:
+            respostas = [self._executar(request, sub, rota) for sub, rota in zip(requisicoes, rotas)]
+            return Response({"respostas": respostas}, status=status.HTTP_200_OK)
+
+        # uma transação em cada alias (o 'default' e os shards): as escritas de uma sub-requisição no
+        # shard de um processo (iniciar, finalizar...) também são desfeitas se uma seguinte falhar
+        respostas = []
+        aliases = shards.aliases()
+        with ExitStack() as pilha:
+            for alias in aliases:
+                pilha.enter_context(transaction.atomic(using=alias))
+            for sub, rota in zip(requisicoes, rotas):
+                resposta = self._executar(request, sub, rota)
+                respostas.append(resposta)
+                if resposta['status'] >= 400:
+                    for alias in aliases:
+                        transaction.set_rollback(True, using=alias)
+                    break
+
+        if respostas[-1]['status'] >= 400:
+            return Response(
+                {"detail": "Transação revertida: uma das requisições falhou.", "respostas": respostas},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({"respostas": respostas}, status=status.HTTP_200_OK)
+
+    def _executar(self, request, sub, rota):
+        if rota is None:
+            return {"status": status.HTTP_404_NOT_FOUND, "corpo": {"detail": "Rota não encontrada."}}
+
+        try:
+            response = rota.func(_criar_sub_requisicao(request, sub), *rota.args, **rota.kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+        except Exception as e:
+            return {"status": status.HTTP_500_INTERNAL_SERVER_ERROR, "corpo": {"detail": f"Erro interno: {e}"}}
+
+        return {
+            "status": response.status_code,
+            "cabecalhos": {nome: valor for nome, valor in response.items() if nome not in CABECALHOS_OMITIDOS},
+            "corpo": _corpo_resposta(response),
+        }
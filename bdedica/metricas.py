@@ -0,0 +1,299 @@
+"""
+Métricas no formato de texto do Prometheus (GET /metrics).
+
+Cada processo do servidor acumula histogramas e contadores em memória e, de tempos em tempos,
+grava um retrato deles em METRICAS_DIR (um arquivo por processo). O endpoint /metrics soma os
+arquivos de todos os processos, então as métricas ficam agregadas mesmo com vários workers.
+Sem METRICAS_DIR, apenas as métricas do processo que respondeu são expostas.
+"""
+import glob
+import hmac
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+AJUDA = {
+    'bdedica_requisicao_segundos': ('histogram', "Latência das requisições por view/ação do DRF."),
+    'bdedica_sql_segundos': ('histogram', "Latência dos comandos SQL, agrupados por comando e tabela."),
+    'bdedica_procedure_segundos': ('histogram', "Latência das stored procedures."),
+    'bdedica_mysql_erros_total': ('counter', "Erros retornados pelo MySQL, por código de erro."),
+    'bdedica_conexoes_abertas_total': ('counter', "Conexões abertas com o banco de dados."),
+    'bdedica_retentativas_total': ('counter', "Transações do workflow repetidas após deadlock/lock wait timeout."),
+    'bdedica_retentativas_esgotadas_total': ('counter', "Transações do workflow que falharam após todas as tentativas."),
+    'bdedica_dimensoes_buscas_total': ('counter', "Buscas no banco por linhas que não estavam no cache de dimensões, por tabela."),
+}
+
+RE_COMANDO_SQL = re.compile(
+    r"^\s*(?:/\*.*?\*/\s*)?(?:WITH\b.*?\)\s*)?(SELECT|INSERT|UPDATE|DELETE|CALL|REPLACE)\b",
+    re.IGNORECASE | re.DOTALL
+)
+RE_TABELA_SQL = {
+    'SELECT': re.compile(r"\bFROM\s+`?(\w+)", re.IGNORECASE),
+    'INSERT': re.compile(r"\bINTO\s+`?(\w+)", re.IGNORECASE),
+    'REPLACE': re.compile(r"\bINTO\s+`?(\w+)", re.IGNORECASE),
+    'UPDATE': re.compile(r"\bUPDATE\s+`?(\w+)", re.IGNORECASE),
+    'DELETE': re.compile(r"\bFROM\s+`?(\w+)", re.IGNORECASE),
+    'CALL': re.compile(r"\bCALL\s+`?(\w+)", re.IGNORECASE),
+}
+
+
+class Registro:
+    """
+    Histogramas e contadores do processo atual. Seguro para uso com várias threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histogramas = {}
+        self.contadores = {}
+        self._ultima_gravacao = 0.0
+        self._arquivo = None
+
+    def observar(self, nome, labels, valor):
+        chave = (nome, tuple(sorted(labels.items())))
+        indice = bisect_left(BUCKETS, valor)
+        with self._lock:
+            histograma = self.histogramas.get(chave)
+            if histograma is None:
+                # contagens por bucket (não cumulativas) + bucket +Inf, soma, total
+                histograma = self.histogramas[chave] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            histograma[0][indice] += 1
+            histograma[1] += valor
+            histograma[2] += 1
+
+    def incrementar(self, nome, labels, valor=1):
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            self.contadores[chave] = self.contadores.get(chave, 0) + valor
+
+    def retrato(self):
+        with self._lock:
+            return {
+                'histogramas': [
+                    [nome, list(labels), list(contagens), soma, total]
+                    for (nome, labels), (contagens, soma, total) in self.histogramas.items()
+                ],
+                'contadores': [
+                    [nome, list(labels), valor]
+                    for (nome, labels), valor in self.contadores.items()
+                ],
+            }
+
+    def gravar(self, forcar=False):
+        """
+        Grava o retrato do processo em METRICAS_DIR, no máximo a cada
+        METRICAS_INTERVALO_GRAVACAO_SEGUNDOS (ou imediatamente com forcar=True).
+        """
+        diretorio = getattr(settings, 'METRICAS_DIR', None)
+        if not diretorio:
+            return
+
+        agora = time.monotonic()
+        if not forcar and agora - self._ultima_gravacao < getattr(settings, 'METRICAS_INTERVALO_GRAVACAO_SEGUNDOS', 5):
+            return
+        self._ultima_gravacao = agora
+
+        if self._arquivo is None:
+            # pid + horário de início: um pid reutilizado depois de um restart não sobrescreve os contadores antigos
+            self._arquivo = os.path.join(diretorio, f"{os.getpid()}-{int(time.time() * 1000)}.json")
+
+        os.makedirs(diretorio, exist_ok=True)
+        descritor, temporario = tempfile.mkstemp(dir=diretorio, suffix='.tmp')
+        with os.fdopen(descritor, 'w') as arquivo:
+            json.dump(self.retrato(), arquivo)
+        os.replace(temporario, self._arquivo)
+
+
+registro = Registro()
+
+
+def codigo_erro_mysql(erro):
+    """
+    Código numérico do erro do MySQL (ex.: 1213, 1205, 1644), procurando também
+    na exceção original encapsulada pelo Django. Retorna None se não houver.
+    """
+    while erro is not None:
+        if erro.args and isinstance(erro.args[0], int):
+            return erro.args[0]
+        erro = erro.__cause__
+    return None
+
+
+def registrar_erro_mysql(erro):
+    codigo = codigo_erro_mysql(erro)
+    if codigo is not None:
+        registro.incrementar('bdedica_mysql_erros_total', {'codigo': str(codigo)})
+
+
+@lru_cache(maxsize=2048)
+def nome_sql(sql):
+    """
+    Nome curto de um comando SQL para uso como label (ex.: 'SELECT execucao_etapa').
+    """
+    comando = RE_COMANDO_SQL.match(sql)
+    if not comando:
+        return 'OUTRO'
+    verbo = comando.group(1).upper()
+    tabela = RE_TABELA_SQL[verbo].search(sql, comando.start(1))
+    return f"{verbo} {tabela.group(1)}" if tabela else verbo
+
+
+def medir_sql(execute, sql, params, many, context):
+    """
+    execute_wrapper do Django: mede cada comando SQL e conta os erros do MySQL.
+    """
+    inicio = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    except Exception as e:
+        registrar_erro_mysql(e)
+        raise
+    finally:
+        registro.observar('bdedica_sql_segundos', {'sql': nome_sql(sql)}, time.perf_counter() - inicio)
+
+
+def nome_view(view_func, metodo):
+    """
+    Nome da view/ação do DRF (ex.: 'ExecucaoEtapaViewSet.finalizar_execucao').
+    """
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return getattr(view_func, '__qualname__', 'desconhecida')
+
+    acoes = getattr(view_func, 'actions', None) or {}
+    acao = acoes.get(metodo.lower(), metodo.lower())
+    return f"{cls.__name__}.{acao}"
+
+
+class MetricasMiddleware:
+    """
+    Mede a latência de cada requisição (por view/ação) e de cada comando SQL executado nela.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        inicio = time.perf_counter()
+
+        # todos os aliases (o 'default' e os shards): uma requisição pode consultar mais de um
+        with ExitStack() as pilha:
+            for conexao in connections.all():
+                pilha.enter_context(conexao.execute_wrapper(medir_sql))
+            response = self.get_response(request)
+
+        registro.observar(
+            'bdedica_requisicao_segundos',
+            {
+                'view': getattr(request, '_metricas_view', 'desconhecida'),
+                'metodo': request.method,
+                'status': f"{response.status_code // 100}xx",
+            },
+            time.perf_counter() - inicio
+        )
+        registro.gravar()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metricas_view = nome_view(view_func, request.method)
+
+
+def _conexao_aberta(sender, connection, **kwargs):
+    registro.incrementar('bdedica_conexoes_abertas_total', {'alias': connection.alias})
+
+
+connection_created.connect(_conexao_aberta)
+
+
+def _agregar():
+    """
+    Soma os retratos de todos os processos (ou usa só o processo atual, sem METRICAS_DIR).
+    """
+    diretorio = getattr(settings, 'METRICAS_DIR', None)
+    if not diretorio:
+        retratos = [registro.retrato()]
+    else:
+        registro.gravar(forcar=True)
+        retratos = []
+        for caminho in glob.glob(os.path.join(diretorio, '*.json')):
+            try:
+                with open(caminho) as arquivo:
+                    retratos.append(json.load(arquivo))
+            except (OSError, ValueError):
+                continue
+
+    histogramas, contadores = {}, {}
+    for retrato in retratos:
+        for nome, labels, contagens, soma, total in retrato['histogramas']:
+            chave = (nome, tuple(tuple(par) for par in labels))
+            atual = histogramas.setdefault(chave, [[0] * len(contagens), 0.0, 0])
+            atual[0] = [a + b for a, b in zip(atual[0], contagens)]
+            atual[1] += soma
+            atual[2] += total
+        for nome, labels, valor in retrato['contadores']:
+            chave = (nome, tuple(tuple(par) for par in labels))
+            contadores[chave] = contadores.get(chave, 0) + valor
+
+    return histogramas, contadores
+
+
+def _formatar_labels(labels, extra=None):
+    pares = list(labels) + ([extra] if extra else [])
+    if not pares:
+        return ''
+    texto = ','.join(
+        '{}="{}"'.format(chave, str(valor).replace('\\', '\\\\').replace('"', '\\"'))
+        for chave, valor in pares
+    )
+    return '{' + texto + '}'
+
+
+def view_metricas(request):
+    """
+    GET /metrics
+    Exposição no formato de texto do Prometheus. Se METRICAS_TOKEN estiver definido,
+    exige o cabeçalho X-Metricas-Token com o mesmo valor.
+    """
+    token = getattr(settings, 'METRICAS_TOKEN', None)
+    if token and not hmac.compare_digest(request.headers.get('X-Metricas-Token', '').encode(), token.encode()):
+        return HttpResponse(status=403)
+
+    histogramas, contadores = _agregar()
+    linhas = []
+    tipos_escritos = set()
+
+    def cabecalho(nome):
+        if nome in tipos_escritos:
+            return
+        tipos_escritos.add(nome)
+        tipo, ajuda = AJUDA.get(nome, ('untyped', nome))
+        linhas.append(f"# HELP {nome} {ajuda}")
+        linhas.append(f"# TYPE {nome} {tipo}")
+
+    for (nome, labels), (contagens, soma, total) in sorted(histogramas.items()):
+        cabecalho(nome)
+        acumulado = 0
+        for limite, contagem in zip(list(BUCKETS) + ['+Inf'], contagens):
+            acumulado += contagem
+            linhas.append(f"{nome}_bucket{_formatar_labels(labels, ('le', limite))} {acumulado}")
+        linhas.append(f"{nome}_sum{_formatar_labels(labels)} {soma}")
+        linhas.append(f"{nome}_count{_formatar_labels(labels)} {total}")
+
+    for (nome, labels), valor in sorted(contadores.items()):
+        cabecalho(nome)
+        linhas.append(f"{nome}{_formatar_labels(labels)} {valor}")
+
+    return HttpResponse('\n'.join(linhas) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
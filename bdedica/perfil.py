@@ -0,0 +1,166 @@
+"""
+Perfil (profiling) sob demanda de uma requisição: chamadas Python (cProfile) e comandos SQL com os tempos.
+
+O perfil é ligado para uma requisição pelo cabeçalho X-Perfil-Token (igual a PERFIL_TOKEN) ou por
+amostragem (PERFIL_AMOSTRAGEM, fração das requisições). O resultado é gravado em 'perfil_requisicao',
+o id volta no cabeçalho X-Perfil-Id e a consulta é feita em /api/perfis/ (apenas coordenadores).
+Desligado, o custo por requisição é a leitura de um cabeçalho e um sorteio.
+"""
+import cProfile
+import hmac
+import io
+import json
+import pstats
+import random
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connection, connections
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from usuarios.permissions import IsCoordenador
+
+QUERY_GRAVAR = """
+    INSERT INTO perfil_requisicao (nome_view, metodo, caminho, status_http, duracao_ms, id_usuario, chamadas, comandos_sql)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+
+def perfil_pedido(request):
+    token = getattr(settings, 'PERFIL_TOKEN', None)
+    if token and hmac.compare_digest(request.headers.get('X-Perfil-Token', '').encode(), token.encode()):
+        return True
+    amostragem = getattr(settings, 'PERFIL_AMOSTRAGEM', 0)
+    return amostragem > 0 and random.random() < amostragem
+
+
+class PerfilMiddleware:
+    """
+    Liga o cProfile e registra os comandos SQL apenas nas requisições escolhidas por perfil_pedido.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not perfil_pedido(request):
+            return self.get_response(request)
+
+        comandos = []
+
+        def capturar_sql(execute, sql, params, many, context):
+            inicio = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                comandos.append({
+                    'alias': context['connection'].alias, 'sql': sql,
+                    'ms': round((time.perf_counter() - inicio) * 1000, 3), 'many': many,
+                })
+
+        perfil = cProfile.Profile()
+        inicio = time.perf_counter()
+        with ExitStack() as pilha:
+            for conexao in connections.all():
+                pilha.enter_context(conexao.execute_wrapper(capturar_sql))
+            perfil.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                perfil.disable()
+        duracao_ms = (time.perf_counter() - inicio) * 1000
+
+        id_perfil = self._gravar(request, response, duracao_ms, perfil, comandos)
+        if id_perfil is not None:
+            response['X-Perfil-Id'] = str(id_perfil)
+        return response
+
+    def _gravar(self, request, response, duracao_ms, perfil, comandos):
+        """
+        Grava o perfil; uma falha aqui não pode derrubar a resposta já pronta.
+        """
+        texto = io.StringIO()
+        estatisticas = pstats.Stats(perfil, stream=texto)
+        estatisticas.sort_stats('cumulative').print_stats(getattr(settings, 'PERFIL_MAX_FUNCOES', 60))
+
+        usuario = getattr(request, 'user', None)
+        id_usuario = usuario.id if usuario is not None and usuario.is_authenticated else None
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(QUERY_GRAVAR, [
+                    getattr(request, '_metricas_view', 'desconhecida'), request.method, request.path[:255],
+                    response.status_code, round(duracao_ms, 3), id_usuario,
+                    texto.getvalue(), json.dumps(comandos),
+                ])
+                return cursor.lastrowid
+        except Exception:
+            return None
+
+
+class PerfilListaView(APIView):
+    """
+    GET /api/perfis/
+    Perfis gravados, do mais recente para o mais antigo (sem o conteúdo). Aceita ?view= e ?limite=.
+    """
+    permission_classes = [IsAuthenticated, IsCoordenador]
+
+    def get(self, request):
+        query = """
+            SELECT id, nome_view, metodo, caminho, status_http, duracao_ms, id_usuario, data_criacao,
+                JSON_LENGTH(comandos_sql) AS quantidade_sql
+            FROM perfil_requisicao
+        """
+        params = []
+        if request.query_params.get('view'):
+            query += " WHERE nome_view = %s"
+            params.append(request.query_params['view'])
+        query += " ORDER BY id DESC LIMIT %s"
+
+        try:
+            params.append(max(1, min(int(request.query_params.get('limite', 50)), 500)))
+        except ValueError:
+            return Response({"detail": "O parâmetro 'limite' deve ser um número inteiro."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                colunas = [col[0] for col in cursor.description]
+                perfis = [dict(zip(colunas, row)) for row in cursor.fetchall()]
+            return Response(perfis, status=status.HTTP_200_OK)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class PerfilDetalheView(APIView):
+    """
+    GET /api/perfis/<id>/
+    Perfil completo: chamadas Python (pstats, ordenadas pelo tempo acumulado) e comandos SQL com os tempos.
+    """
+    permission_classes = [IsAuthenticated, IsCoordenador]
+
+    def get(self, request, pk):
+        query = """
+            SELECT id, nome_view, metodo, caminho, status_http, duracao_ms, id_usuario, data_criacao,
+                chamadas, comandos_sql
+            FROM perfil_requisicao WHERE id = %s
+        """
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, [pk])
+                row = cursor.fetchone()
+                colunas = [col[0] for col in cursor.description]
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        if not row:
+            return Response({"detail": "Perfil não encontrado."}, status=status.HTTP_404_NOT_FOUND)
+
+        perfil = dict(zip(colunas, row))
+        perfil['comandos_sql'] = json.loads(perfil['comandos_sql'])
+        return Response(perfil, status=status.HTTP_200_OK)
@@ -45,6 +45,8 @@ INSTALLED_APPS = [
                  ] + MY_APPS
 
 MIDDLEWARE = [
+    'bdedica.metricas.MetricasMiddleware',
+    'bdedica.perfil.PerfilMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -93,6 +95,14 @@ DATABASES = {
     }
 }
 
+# Sharding dos dados de processo por template (processos.shards). Cada shard é um alias de DATABASES:
+# SHARDS = {'shard1': {'offset': 2, 'templates': [7]}} leva os processos do template 7 (id da versão original)
+# para 'shard1'. SHARDS_INCREMENTO é o auto_increment_increment de todas as conexões e não pode mudar depois
+# que houver dados; o 'default' usa offset 1.
+SHARDS = {}
+SHARDS_INCREMENTO = 10
+DATABASE_ROUTERS = ['processos.shards.ShardRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -138,7 +148,13 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
-    )
+    ),
+    # ?format=columnar nas listagens (processos.renderers.ColunarRenderer)
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'processos.renderers.ColunarRenderer',
+    ),
 }
 
 from datetime import timedelta
@@ -174,3 +190,71 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_LIFETIME': timedelta(days=36500),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=36500),
 }
+
+# Fila de jobs em segundo plano (python manage.py worker_jobs)
+JOBS_PROCESSOS = 1
+JOBS_THREADS = 2
+JOBS_INTERVALO_SEGUNDOS = 1.0
+JOBS_LEASE_SEGUNDOS = 300
+JOBS_MAX_TENTATIVAS = 3
+JOBS_ESPERA_RETENTATIVA_SEGUNDOS = 30
+
+# Exclusão de templates/etapas em lotes pelo worker_jobs (linhas por lote e pausa entre lotes)
+EXCLUSAO_LOTE = 1000
+EXCLUSAO_PAUSA_SEGUNDOS = 0.1
+
+# Reatribuição das pendências de um usuário pelo worker_jobs (execuções por lote e pausa entre lotes)
+REATRIBUICAO_LOTE = 500
+REATRIBUICAO_PAUSA_SEGUNDOS = 0.1
+
+# Retentativas de iniciar/finalizar após deadlock (1213) ou lock wait timeout (1205). Nenhuma tentativa
+# começa depois de RETENTATIVA_PRAZO_SEGUNDOS (limitado à metade de IDEMPOTENCIA_ABANDONO_SEGUNDOS)
+RETENTATIVA_MAX_TENTATIVAS = 3
+RETENTATIVA_ESPERA_BASE_SEGUNDOS = 0.05
+RETENTATIVA_PRAZO_SEGUNDOS = 10
+
+# Máximo de sub-requisições em POST /api/batch/
+BATCH_MAX_REQUISICOES = 20
+
+# Cache de dimensões (processos.dimensoes): intervalo, em segundos, entre as verificações de versão
+DIMENSOES_INTERVALO_SEGUNDOS = 5
+
+# Feed de mudanças (/api/processos/mudancas/): registros por página e atraso de estabilização do cursor
+MUDANCAS_LIMITE = 500
+MUDANCAS_ATRASO_SEGUNDOS = 1
+
+# Anexos em disco, endereçados pelo SHA-256 (processos.anexos): diretório, bloco de leitura/escrita e tamanho máximo
+ANEXOS_DIR = BASE_DIR / 'anexos'
+ANEXOS_TAMANHO_BLOCO = 1024 * 1024
+ANEXOS_TAMANHO_MAXIMO = 100 * 1024 * 1024
+
+# Previsão de conclusão dos processos abertos (job prever_conclusoes): simulações por processo, máximo de
+# etapas por simulação, processos simulados por lote, janela do histórico e peso de cada fluxo do grafo
+PREVISAO_SIMULACOES = 500
+PREVISAO_MAX_PASSOS = 200
+PREVISAO_LOTE_PROCESSOS = 2000
+PREVISAO_HISTORICO_DIAS = 365
+PREVISAO_PESO_FLUXO = 1.0
+
+# Fila compartilhada de tarefas por cargo (exec_etapas/reservar/)
+FILA_RESERVA_SEGUNDOS = 600
+
+# Cabeçalho Idempotency-Key em iniciar/finalizar: validade do resultado guardado e reserva de uma chave em
+# andamento (python manage.py limpar_idempotencia remove as expiradas)
+IDEMPOTENCIA_TTL_SEGUNDOS = 86400
+IDEMPOTENCIA_ABANDONO_SEGUNDOS = 60
+
+# Métricas do Prometheus (GET /metrics). Com vários processos (gunicorn/uwsgi), METRICAS_DIR deve
+# apontar para um diretório compartilhado, esvaziado a cada deploy.
+METRICAS_DIR = None
+METRICAS_INTERVALO_GRAVACAO_SEGUNDOS = 5
+METRICAS_TOKEN = None
+
+# Perfil sob demanda de requisições (bdedica.perfil): o cabeçalho X-Perfil-Token com o valor de PERFIL_TOKEN
+# liga o perfil de uma requisição; PERFIL_AMOSTRAGEM liga em uma fração delas (0 = desligado)
+PERFIL_TOKEN = None
+PERFIL_AMOSTRAGEM = 0
+PERFIL_MAX_FUNCOES = 60
+
+# Testes de orçamento de consultas (python manage.py test); precisam do MySQL
+TEST_RUNNER = 'bdedica.testes.MySQLTestRunner'
@@ -0,0 +1,177 @@
+"""
+Infraestrutura dos testes que rodam contra o MySQL (schema em scripts/trab1-pgbd.sql).
+"""
+from contextlib import contextmanager
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models.signals import pre_migrate
+from django.test import TransactionTestCase, override_settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from usuarios.models import Usuario
+
+SCRIPT_SCHEMA = settings.BASE_DIR / 'scripts' / 'trab1-pgbd.sql'
+SCRIPT_DADOS = settings.BASE_DIR / 'scripts' / 'trab1-inserts.sql'
+
+IGNORAR = ('create database', 'use ', 'create user', 'grant ', 'flush ')
+
+# controle de transação registrado pelo Django (atomic), que não conta no orçamento
+CONTROLE_TRANSACAO = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE SAVEPOINT')
+
+
+def comandos_script(caminho):
+    """
+    Separa um script do cliente mysql em comandos, respeitando DELIMITER.
+    Ignora a criação do banco/usuários e a seção AUXILIARES do script de schema.
+    """
+    delimitador = ';'
+    atual = []
+
+    with open(caminho, encoding='utf-8') as arquivo:
+        for linha in arquivo:
+            texto = linha.strip()
+
+            if texto.upper().startswith('-- AUXILIARES'):
+                break
+            if texto.upper().startswith('DELIMITER'):
+                delimitador = texto.split()[1]
+                continue
+            if not atual and (not texto or texto.startswith('--')):
+                continue
+
+            atual.append(linha.rstrip('\n'))
+            if texto.endswith(delimitador):
+                comando = '\n'.join(atual).rstrip()[:-len(delimitador)].strip()
+                atual = []
+                if comando and not comando.lower().startswith(IGNORAR):
+                    yield comando
+
+
+def executar_script(cursor, caminho):
+    for comando in comandos_script(caminho):
+        cursor.execute(comando)
+
+
+def carregar_dados(conexao):
+    """
+    Esvazia as tabelas do projeto e carrega scripts/trab1-inserts.sql, com ids sequenciais.
+    """
+    from processos.shards import configurar_sessao
+
+    configurar_sessao(conexao)
+    with conexao.cursor() as cursor:
+        tabelas = [
+            tabela for tabela in conexao.introspection.table_names()
+            if not tabela.startswith(('django_', 'auth_'))
+        ]
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+        for tabela in tabelas:
+            cursor.execute(f"TRUNCATE TABLE `{tabela}`")
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+        executar_script(cursor, SCRIPT_DADOS)
+
+
+def criar_schema(sender, using, **kwargs):
+    """
+    pre_migrate: cria as tabelas, procedures e triggers do script no banco de testes
+    antes das migrations do Django (que dependem da tabela usuario), como no banco real.
+    """
+    conexao = connections[using]
+    if 'usuario' in conexao.introspection.table_names():
+        return
+    with conexao.cursor() as cursor:
+        executar_script(cursor, SCRIPT_SCHEMA)
+
+
+class MySQLTestRunner(DiscoverRunner):
+    """
+    Runner que monta o banco de testes a partir de scripts/trab1-pgbd.sql.
+
+    Os models do projeto são managed = False, então o Django não cria as suas tabelas.
+    Além disso, usuario.id é bigint no script e IntegerField no model: as chaves
+    estrangeiras que as migrations do admin criariam para ele seriam incompatíveis,
+    por isso elas não são criadas no banco de testes.
+    """
+
+    def setup_databases(self, **kwargs):
+        if connection.vendor != 'mysql':
+            return super().setup_databases(**kwargs)
+
+        # todos os aliases (o 'default' e os shards, ver processos.shards) recebem o mesmo schema
+        pre_migrate.connect(criar_schema, dispatch_uid='bdedica_criar_schema')
+        for conexao in connections.all():
+            conexao.features.supports_foreign_keys = False
+        try:
+            return super().setup_databases(**kwargs)
+        finally:
+            pre_migrate.disconnect(dispatch_uid='bdedica_criar_schema')
+            for conexao in connections.all():
+                del conexao.features.supports_foreign_keys
+
+
+@skipUnless(connection.vendor == 'mysql', "Os testes de orçamento precisam do MySQL (procedures e triggers).")
+@override_settings(DIMENSOES_INTERVALO_SEGUNDOS=3600, SHARDS={})
+class OrcamentoTestCase(TransactionTestCase):
+    """
+    Base dos testes de orçamento: cada teste parte dos dados de scripts/trab1-inserts.sql
+    (5 usuários, 2 templates, 8 etapas, 11 fluxos, 15 processos, 38 execuções) e verifica
+    quantos comandos SQL e chamadas de procedure cada requisição pode executar.
+
+    É TransactionTestCase porque as views confirmam as próprias transações (inclusive em outros
+    aliases) e alguns testes observam os dados por uma segunda conexão, o que a transação que
+    envolve cada teste em um TestCase esconderia.
+
+    Os testes rodam sem shards (SHARDS = {}): os ids dos dados de teste são sequenciais.
+    """
+
+    def setUp(self):
+        carregar_dados(connection)
+
+        call_command('popular_participacao', stdout=StringIO())
+        call_command('popular_etapa_atual', stdout=StringIO())
+
+        # cache de dimensões aquecido e sem verificações de versão durante o teste:
+        # os orçamentos medem só as consultas das views
+        from processos.dimensoes import dimensoes
+        dimensoes.limpar()
+        dimensoes.carregar()
+
+        self.client = APIClient()
+
+    def autenticar(self, id_usuario):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT username, cargo FROM usuario WHERE id = %s", [id_usuario])
+            username, cargo = cursor.fetchone()
+        self.client.force_authenticate(user=Usuario(id=id_usuario, username=username, cargo=cargo))
+
+    @contextmanager
+    def orcamento(self, max_sql, max_procedures=0):
+        """
+        Falha se o bloco executar mais de 'max_sql' comandos SQL
+        ou mais de 'max_procedures' chamadas de stored procedure.
+        BEGIN/COMMIT/SAVEPOINT dos blocos atomic não entram na contagem.
+        """
+        from processos.procedures import chamar_procedure
+
+        with CaptureQueriesContext(connection) as consultas, \
+                mock.patch('processos.views.chamar_procedure', wraps=chamar_procedure) as procedures:
+            yield
+
+        executadas = [
+            consulta['sql'] for consulta in consultas.captured_queries
+            if not consulta['sql'].upper().startswith(CONTROLE_TRANSACAO)
+        ]
+        self.assertLessEqual(
+            len(executadas), max_sql,
+            f"Orçamento de SQL excedido ({len(executadas)} > {max_sql}):\n" + '\n'.join(executadas)
+        )
+        self.assertLessEqual(
+            procedures.call_count, max_procedures,
+            f"Orçamento de procedures excedido ({procedures.call_count} > {max_procedures})."
+        )
@@ -1,7 +1,15 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from .batch import BatchView
+from .metricas import view_metricas
+from .perfil import PerfilDetalheView, PerfilListaView
+
 urlpatterns = [
+    path('api/batch/', BatchView.as_view(), name='batch'),
+    path('api/perfis/', PerfilListaView.as_view(), name='perfis'),
+    path('api/perfis/<int:pk>/', PerfilDetalheView.as_view(), name='perfil'),
     path('api/', include('usuarios.urls')),
     path('api/processos/', include('processos.urls')),
+    path('metrics', view_metricas, name='metricas'),
 ]
\ No newline at end of file
@@ -0,0 +1,160 @@
+"""
+Armazenamento dos anexos em disco, endereçado pelo conteúdo (SHA-256) e sem duplicatas.
+
+O upload é lido do corpo da requisição em blocos de ANEXOS_TAMANHO_BLOCO bytes, gravado em um arquivo
+temporário enquanto o hash é calculado e movido (os.replace) para ANEXOS_DIR/sha256/ab/cd/<hash>;
+se o arquivo já existe, o temporário é descartado. A coluna execucao_etapa.anexo guarda a referência
+"sha256:<hash>". O download é servido direto do arquivo (wsgi.file_wrapper/sendfile quando o servidor
+oferece), com suporte a Range para downloads retomáveis: nada é carregado inteiro na memória do worker.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from django.conf import settings
+
+PREFIXO = 'sha256:'
+RE_HASH = re.compile(r'^[0-9a-f]{64}$')
+RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class AnexoGrandeDemais(Exception):
+    pass
+
+
+class HashDivergente(Exception):
+    pass
+
+
+def diretorio():
+    return str(getattr(settings, 'ANEXOS_DIR', settings.BASE_DIR / 'anexos'))
+
+
+def caminho(hash_hex):
+    return os.path.join(diretorio(), 'sha256', hash_hex[:2], hash_hex[2:4], hash_hex)
+
+
+def hash_da_referencia(referencia):
+    """
+    Hash de uma referência "sha256:<hash>", ou None se o texto não é uma referência de anexo.
+    """
+    if not referencia or not referencia.startswith(PREFIXO):
+        return None
+    hash_hex = referencia[len(PREFIXO):]
+    return hash_hex if RE_HASH.match(hash_hex) else None
+
+
+def anexo_invalido(anexo):
+    """
+    Mensagem de erro se 'anexo' parece uma referência de anexo mas não aponta para um arquivo armazenado.
+    Textos que não começam com "sha256:" (links, anexos antigos) são aceitos como antes.
+    """
+    if not anexo or not anexo.startswith(PREFIXO):
+        return None
+    hash_hex = hash_da_referencia(anexo)
+    if hash_hex is None or not os.path.exists(caminho(hash_hex)):
+        return f"Anexo não encontrado: {anexo}."
+    return None
+
+
+def salvar(stream, hash_esperado=None):
+    """
+    Grava o conteúdo lido de 'stream' e retorna (hash, tamanho, novo).
+    Levanta AnexoGrandeDemais acima de ANEXOS_TAMANHO_MAXIMO bytes e HashDivergente se
+    'hash_esperado' (cabeçalho X-Anexo-Sha256) não confere com o conteúdo recebido.
+    """
+    bloco = getattr(settings, 'ANEXOS_TAMANHO_BLOCO', 1024 * 1024)
+    maximo = getattr(settings, 'ANEXOS_TAMANHO_MAXIMO', 100 * 1024 * 1024)
+
+    # o temporário fica no mesmo sistema de arquivos do destino, para que os.replace seja atômico
+    temporarios = os.path.join(diretorio(), 'tmp')
+    os.makedirs(temporarios, exist_ok=True)
+    descritor, temporario = tempfile.mkstemp(dir=temporarios)
+
+    try:
+        sha256 = hashlib.sha256()
+        tamanho = 0
+        with os.fdopen(descritor, 'wb') as arquivo:
+            while True:
+                dados = stream.read(bloco)
+                if not dados:
+                    break
+                tamanho += len(dados)
+                if tamanho > maximo:
+                    raise AnexoGrandeDemais(f"O anexo passa do limite de {maximo} bytes.")
+                sha256.update(dados)
+                arquivo.write(dados)
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+
+        hash_hex = sha256.hexdigest()
+        if hash_esperado and hash_esperado.lower() != hash_hex:
+            raise HashDivergente(f"O conteúdo recebido tem SHA-256 {hash_hex}, diferente do informado.")
+
+        destino = caminho(hash_hex)
+        if os.path.exists(destino):
+            os.remove(temporario)
+            return hash_hex, tamanho, False
+
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(temporario, destino)
+        return hash_hex, tamanho, True
+    except BaseException:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+
+
+def intervalo(cabecalho, tamanho):
+    """
+    Interpreta um cabeçalho Range de um único intervalo ("bytes=a-b", "bytes=a-", "bytes=-n").
+    Retorna (inicio, fim) inclusivo, None para servir o arquivo inteiro (sem Range ou com vários
+    intervalos) ou False se o intervalo não pode ser atendido (416).
+    """
+    if not cabecalho:
+        return None
+    encontrado = RE_RANGE.match(cabecalho.strip())
+    if not encontrado or encontrado.group(1) == encontrado.group(2) == '':
+        return None
+
+    inicio, fim = encontrado.groups()
+    if inicio == '':
+        # sufixo: os últimos n bytes
+        quantidade = int(fim)
+        if quantidade == 0 or tamanho == 0:
+            return False
+        return max(0, tamanho - quantidade), tamanho - 1
+
+    inicio = int(inicio)
+    fim = tamanho - 1 if fim == '' else min(int(fim), tamanho - 1)
+    if inicio >= tamanho or inicio > fim:
+        return False
+    return inicio, fim
+
+
+class TrechoArquivo:
+    """
+    Arquivo já posicionado no início do intervalo que entrega no máximo 'restante' bytes.
+    Mantém fileno(): servidores com sendfile (ex.: gunicorn) enviam o trecho sem copiá-lo
+    para o processo, limitados pelo Content-Length da resposta.
+    """
+
+    def __init__(self, arquivo, restante):
+        self.arquivo = arquivo
+        self.restante = restante
+
+    def read(self, tamanho=-1):
+        if self.restante <= 0:
+            return b''
+        if tamanho is None or tamanho < 0 or tamanho > self.restante:
+            tamanho = self.restante
+        dados = self.arquivo.read(tamanho)
+        self.restante -= len(dados)
+        return dados
+
+    def fileno(self):
+        return self.arquivo.fileno()
+
+    def close(self):
+        self.arquivo.close()
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ProcessosConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'processos'
+
+    def ready(self):
+        # registra a configuração de auto_increment das conexões dos shards (connection_created)
+        from . import shards  # noqa: F401
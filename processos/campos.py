@@ -0,0 +1,52 @@
+"""
+Leitura e gravação em lote dos campos dinâmicos (modelo_campo / campo) das etapas.
+"""
+
+
+def salvar_campos(cursor, id_exec_etapa, campos):
+    """
+    Grava todos os valores de campos de uma execução pendente com um único upsert de várias linhas.
+    Retorna uma mensagem de erro, ou None se os campos foram gravados.
+    """
+    query_modelos = """
+        SELECT mc.id FROM execucao_etapa ee
+        JOIN modelo_campo mc ON mc.id_etapa = ee.id_etapa
+        WHERE ee.id = %s AND ee.status_exec = 'PENDENTE'
+    """
+    cursor.execute(query_modelos, [id_exec_etapa])
+    modelos_da_etapa = {row[0] for row in cursor.fetchall()}
+
+    invalidos = sorted({campo['id_modelo'] for campo in campos} - modelos_da_etapa)
+    if invalidos:
+        return f"Campos não pertencem à etapa desta execução (ou execução já concluída): {invalidos}."
+
+    if not campos:
+        return None
+
+    # VALUES(dados) em vez de alias: só nesse formato o mysqlclient agrupa o executemany em um único INSERT
+    query_upsert = """
+        INSERT INTO campo (id_modelo, id_exec_etapa, dados)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE dados = VALUES(dados)
+    """
+    cursor.executemany(query_upsert, [
+        [campo['id_modelo'], id_exec_etapa, campo['dados']]
+        for campo in campos
+    ])
+    return None
+
+
+def campos_obrigatorios_pendentes(cursor, id_exec_etapa, id_etapa):
+    """
+    Retorna os nomes dos campos obrigatórios da etapa ainda não preenchidos na execução,
+    verificando todos os campos com uma única consulta.
+    """
+    query = """
+        SELECT mc.nome FROM modelo_campo mc
+        LEFT JOIN campo c ON c.id_modelo = mc.id AND c.id_exec_etapa = %s
+        WHERE mc.id_etapa = %s AND mc.obrigatorio = TRUE
+        AND (c.dados IS NULL OR c.dados = '')
+        ORDER BY mc.ordem, mc.id
+    """
+    cursor.execute(query, [id_exec_etapa, id_etapa])
+    return [row[0] for row in cursor.fetchall()]
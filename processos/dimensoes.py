@@ -0,0 +1,146 @@
+"""
+Cache, em cada worker, das tabelas pequenas de dimensão (template_processo, usuario, etapa).
+
+As consultas das listagens trazem só os ids dessas tabelas (lendo apenas processo/execucao_etapa)
+e os nomes são preenchidos depois, a partir do cache. A invalidação é por versão: os triggers de
+UPDATE/DELETE das três tabelas incrementam 'versao_dimensao', que o cache confere a cada
+DIMENSOES_INTERVALO_SEGUNDOS; uma tabela cuja versão mudou é descartada e recarregada sob demanda.
+Ids novos (inserções) são buscados na primeira vez em que aparecem.
+
+O cache também guarda os ids ocultos (oculto = TRUE) de template_processo e etapa, para que as listagens
+filtrem os registros excluídos com NOT IN, sem juntar essas tabelas a cada linha. Um registro nasce
+visível e só fica oculto por UPDATE, que incrementa a versão: a lista de ocultos é descartada junto.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from bdedica.metricas import registro
+
+# colunas guardadas de cada tabela
+DIMENSOES = {
+    'template_processo': ('nome',),
+    'usuario': ('nome',),
+    'etapa': ('nome', 'responsavel', 'campo_anexo'),
+}
+
+# tabelas com a coluna 'oculto' (exclusão em lotes, ver jobs.excluir_template/excluir_etapa)
+OCULTAVEIS = ('template_processo', 'etapa')
+
+
+class CacheDimensoes:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.limpar()
+
+    def limpar(self):
+        with self._lock:
+            self._linhas = {tabela: {} for tabela in DIMENSOES}
+            self._ocultos = {}
+            self._versoes = {}
+            self._verificado_em = None
+
+    def carregar(self):
+        """
+        Carrega as tabelas inteiras (aquecimento, ex.: nos testes antes de medir os orçamentos).
+        """
+        with connection.cursor() as cursor:
+            self._verificar_versoes(cursor, forcar=True)
+            for tabela, colunas in DIMENSOES.items():
+                cursor.execute(f"SELECT id, {', '.join(colunas)} FROM {tabela}")
+                self._guardar(tabela, colunas, cursor.fetchall())
+            for tabela in OCULTAVEIS:
+                self._buscar_ocultos(cursor, tabela)
+
+    def ocultos(self, tabela):
+        """
+        Ids ocultos de 'tabela' (uma de OCULTAVEIS), buscados de novo só quando a versão da tabela muda.
+        """
+        with connection.cursor() as cursor:
+            self._verificar_versoes(cursor)
+            ocultos = self._ocultos.get(tabela)
+            if ocultos is None:
+                ocultos = self._buscar_ocultos(cursor, tabela)
+                registro.incrementar('bdedica_dimensoes_buscas_total', {'tabela': tabela})
+        return ocultos
+
+    def invalidar(self, *tabelas):
+        """
+        Descarta as tabelas já alteradas por este worker, sem esperar a próxima verificação de versão.
+        """
+        with self._lock:
+            for tabela in tabelas:
+                self._linhas[tabela] = {}
+                self._ocultos.pop(tabela, None)
+
+    def preencher(self, linhas, campos):
+        """
+        Troca, em cada linha, o id guardado nas colunas de 'campos' pelo valor da dimensão.
+        'campos' mapeia a coluna da resposta para (tabela, coluna da dimensão); colunas que não
+        estão nas linhas (não pedidas em ?fields=) são ignoradas. Ids inexistentes viram None.
+        """
+        campos = {coluna: dimensao for coluna, dimensao in campos.items() if linhas and coluna in linhas[0]}
+        if not campos:
+            return linhas
+
+        # cópia local das linhas buscadas agora: uma invalidação em outra thread não as perde no meio do preenchimento
+        buscadas = {tabela: {} for tabela in DIMENSOES}
+
+        with connection.cursor() as cursor:
+            self._verificar_versoes(cursor)
+
+            faltando = {}
+            for coluna, (tabela, _) in campos.items():
+                for linha in linhas:
+                    if linha[coluna] is not None and linha[coluna] not in self._linhas[tabela]:
+                        faltando.setdefault(tabela, set()).add(linha[coluna])
+
+            for tabela, ids in faltando.items():
+                colunas = DIMENSOES[tabela]
+                marcadores = ', '.join(['%s'] * len(ids))
+                cursor.execute(f"SELECT id, {', '.join(colunas)} FROM {tabela} WHERE id IN ({marcadores})", sorted(ids))
+                buscadas[tabela] = self._guardar(tabela, colunas, cursor.fetchall())
+                registro.incrementar('bdedica_dimensoes_buscas_total', {'tabela': tabela})
+
+        for coluna, (tabela, coluna_dimensao) in campos.items():
+            dimensao = self._linhas[tabela]
+            for linha in linhas:
+                valores = dimensao.get(linha[coluna]) or buscadas[tabela].get(linha[coluna])
+                linha[coluna] = valores[coluna_dimensao] if valores else None
+        return linhas
+
+    def _verificar_versoes(self, cursor, forcar=False):
+        agora = time.monotonic()
+        intervalo = getattr(settings, 'DIMENSOES_INTERVALO_SEGUNDOS', 5)
+        if not forcar and self._verificado_em is not None and agora - self._verificado_em < intervalo:
+            return
+
+        cursor.execute("SELECT tabela, versao FROM versao_dimensao")
+        versoes = dict(cursor.fetchall())
+
+        with self._lock:
+            for tabela in DIMENSOES:
+                if versoes.get(tabela, 0) != self._versoes.get(tabela, 0):
+                    self._linhas[tabela] = {}
+                    self._ocultos.pop(tabela, None)
+            self._versoes = versoes
+            self._verificado_em = agora
+
+    def _buscar_ocultos(self, cursor, tabela):
+        cursor.execute(f"SELECT id FROM {tabela} WHERE oculto = TRUE")
+        ocultos = frozenset(row[0] for row in cursor.fetchall())
+        with self._lock:
+            self._ocultos[tabela] = ocultos
+        return ocultos
+
+    def _guardar(self, tabela, colunas, resultado):
+        linhas = {row[0]: dict(zip(colunas, row[1:])) for row in resultado}
+        with self._lock:
+            self._linhas[tabela].update(linhas)
+        return linhas
+
+
+dimensoes = CacheDimensoes()
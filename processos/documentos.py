@@ -0,0 +1,50 @@
+"""
+Respostas de detalhe montadas pelo próprio MySQL (JSON_OBJECT/JSON_ARRAYAGG) em uma única consulta.
+
+O documento chega pronto do banco e é enviado como está, sem dictfetchall nem o JSONRenderer do DRF.
+"""
+from django.http import HttpResponse
+
+
+def data_iso(expressao):
+    """
+    Data no mesmo formato do JSON do DRF para os datetimes das consultas ("2025-10-01T09:06:00").
+    Os '%' estão escapados porque as consultas são executadas com parâmetros.
+    """
+    return f"DATE_FORMAT({expressao}, '%%Y-%%m-%%dT%%H:%%i:%%s')"
+
+
+def objeto_json(colunas, nomes=None):
+    """
+    JSON_OBJECT com as colunas 'nomes' (todas, se None) de 'colunas' (nome na resposta -> expressão SQL).
+    Os nomes vêm dos mapas de colunas das views (ou já validados por colunas_selecionadas).
+    """
+    nomes = list(colunas) if nomes is None else nomes
+    return "JSON_OBJECT(" + ", ".join(f"'{nome}', {colunas[nome]}" for nome in nomes) + ")"
+
+
+def lista_json(objeto, consulta, ordem=None):
+    """
+    Subconsulta com a lista JSON (JSON_ARRAYAGG) de 'objeto' para cada linha de 'consulta' (FROM ... WHERE ...),
+    ou [] quando não há linhas.
+
+    JSON_ARRAYAGG não garante a ordem dos elementos; com 'ordem', a agregação é feita como função
+    de janela sobre todas as linhas, na ordem pedida, e a primeira linha já traz a lista completa.
+    """
+    if ordem is None:
+        agregacao = f"SELECT JSON_ARRAYAGG({objeto}) {consulta}"
+    else:
+        agregacao = f"""
+            SELECT JSON_ARRAYAGG({objeto}) OVER (
+                ORDER BY {ordem} ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+            ) {consulta}
+            LIMIT 1
+        """
+    return f"CAST(COALESCE(({agregacao}), JSON_ARRAY()) AS JSON)"
+
+
+def resposta_documento(documento, status=200):
+    """
+    Envia o documento JSON gerado pelo banco sem decodificar e codificar de novo.
+    """
+    return HttpResponse(documento, content_type='application/json', status=status)
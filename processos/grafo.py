@@ -0,0 +1,197 @@
+"""
+Operações em conjunto (set-based) sobre o grafo de um template (etapas + fluxos) e versões do grafo.
+"""
+from contextlib import ExitStack, contextmanager
+
+from django.db import connection, transaction
+from django.db.transaction import TransactionManagementError
+
+from . import shards
+
+
+QUERY_MAPA_ETAPAS = """
+    WITH mapa AS (
+        SELECT antigo.id AS id_antigo, novo.id AS id_novo
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (ORDER BY id) AS posicao
+            FROM etapa WHERE id_template = %s AND oculto = FALSE
+        ) antigo
+        JOIN (
+            SELECT id, ROW_NUMBER() OVER (ORDER BY id) AS posicao
+            FROM etapa WHERE id_template = %s
+        ) novo ON novo.posicao = antigo.posicao
+    )
+"""
+
+
+def copiar_grafo(cursor, id_template_origem, id_template_destino):
+    """
+    Copia as etapas, os fluxos e os modelos de campo de um template para outro com
+    três INSERT ... SELECT, independente do tamanho do grafo.
+
+    As etapas novas são inseridas na mesma ordem de id das originais; como o auto_increment
+    é crescente dentro de um mesmo INSERT, a posição (ROW_NUMBER) de cada etapa nos dois
+    templates faz o mapeamento id antigo -> id novo usado para remapear os fluxos e campos.
+
+    Etapas ocultas (exclusão em andamento) não são copiadas.
+
+    Retorna (quantidade de etapas, quantidade de fluxos) copiados.
+    """
+    query_etapas = """
+        INSERT INTO etapa (id_template, nome, ordem, campo_anexo, responsavel, prazo_horas)
+        SELECT %s, nome, ordem, campo_anexo, responsavel, prazo_horas
+        FROM etapa
+        WHERE id_template = %s AND oculto = FALSE
+        ORDER BY id
+    """
+    cursor.execute(query_etapas, [id_template_destino, id_template_origem])
+    qtd_etapas = cursor.rowcount
+
+    query_fluxos = "INSERT INTO fluxo_execucao (id_origem, id_destino)" + QUERY_MAPA_ETAPAS + """
+        SELECT mo.id_novo, md.id_novo
+        FROM fluxo_execucao f
+        JOIN mapa mo ON mo.id_antigo = f.id_origem
+        JOIN mapa md ON md.id_antigo = f.id_destino
+    """
+    cursor.execute(query_fluxos, [id_template_origem, id_template_destino])
+    qtd_fluxos = cursor.rowcount
+
+    query_campos = "INSERT INTO modelo_campo (id_etapa, nome, tipo, obrigatorio, ordem)" + QUERY_MAPA_ETAPAS + """
+        SELECT m.id_novo, mc.nome, mc.tipo, mc.obrigatorio, mc.ordem
+        FROM modelo_campo mc
+        JOIN mapa m ON m.id_antigo = mc.id_etapa
+    """
+    cursor.execute(query_campos, [id_template_origem, id_template_destino])
+
+    return qtd_etapas, qtd_fluxos
+
+
+class VersaoSubstituida(Exception):
+    """
+    A versão do template já foi substituída por uma mais nova e não pode mais ser editada.
+    """
+
+    def __init__(self, id_versao_atual):
+        super().__init__(f"Versão substituída; edite a versão atual do template (id={id_versao_atual}).")
+        self.id_versao_atual = id_versao_atual
+
+
+# id da versão original (a menor da família): define o alias dos processos do template (ver shards)
+SUBQUERY_ORIGINAL = """
+    (SELECT MIN(v.id) FROM template_processo v WHERE v.id = tp.id OR v.id_versao_atual = tp.id)
+"""
+
+QUERY_TEMPLATE = f"""
+    SELECT tp.id, tp.id_versao_atual, {SUBQUERY_ORIGINAL} AS id_original
+    FROM template_processo tp
+    WHERE tp.id = %s AND tp.oculto = FALSE
+"""
+
+QUERY_TEMPLATE_DA_ETAPA = f"""
+    SELECT tp.id, tp.id_versao_atual, {SUBQUERY_ORIGINAL} AS id_original
+    FROM etapa e
+    JOIN template_processo tp ON tp.id = e.id_template
+    WHERE e.id = %s AND e.oculto = FALSE AND tp.oculto = FALSE
+"""
+
+
+def _buscar_template(cursor, id_template, id_etapa, travar=False):
+    if id_etapa is not None:
+        query, params = QUERY_TEMPLATE_DA_ETAPA, [id_etapa]
+    else:
+        query, params = QUERY_TEMPLATE, [id_template]
+    cursor.execute(query + (" FOR UPDATE OF tp" if travar else ""), params)
+    return cursor.fetchone()
+
+
+@contextmanager
+def transacao_de_edicao(id_template=None, id_etapa=None):
+    """
+    Transação de uma edição do grafo do template (ou do template da etapa), em que versao_para_edicao roda.
+
+    Com shards, os processos do template ficam no alias da versão original: a transação é aberta também
+    nele, antes da do 'default' e fechada depois dela, para que a trava tomada lá por versao_para_edicao
+    dure até a edição ser confirmada. Ao fim da edição, ainda nas duas transações, o grafo editado é
+    copiado para o shard (shards.replicar_template).
+    """
+    with ExitStack() as pilha:
+        linha = None
+        if shards.fragmentado():
+            with connection.cursor() as cursor:
+                linha = _buscar_template(cursor, id_template, id_etapa)
+            alias = shards.alias_do_template(linha[2]) if linha else 'default'
+            if alias != 'default':
+                pilha.enter_context(transaction.atomic(using=alias))
+        pilha.enter_context(transaction.atomic())
+        yield
+        if linha is not None:
+            shards.replicar_template(linha[0])
+
+
+def versao_para_edicao(cursor, id_template=None, id_etapa=None):
+    """
+    Devolve (id do template, id da versão a editar, copiada) para uma edição do grafo
+    do template (ou do template da etapa), ou None se ele não existe. Deve rodar em transacao_de_edicao().
+
+    Uma versão que já tem processos (publicada) é imutável: a edição é feita em uma cópia
+    (nova versão, copiada = True), e os processos em andamento seguem na versão em que começaram.
+    Uma versão sem processos (rascunho) é editada no lugar.
+
+    O template fica travado (FOR UPDATE) até o fim da transação, e a verificação de processos trava
+    (FOR SHARE) a faixa do índice de processo.id_template no alias dos processos do template: um processo
+    iniciado ao mesmo tempo ou termina antes da verificação (e a edição vira uma nova versão) ou espera
+    a edição terminar.
+    """
+    linha = _buscar_template(cursor, id_template, id_etapa, travar=True)
+    if linha is None:
+        return None
+    id_template, id_versao_atual, id_original = linha
+    if id_versao_atual is not None:
+        raise VersaoSubstituida(id_versao_atual)
+
+    conexao_processos = shards.conexao(shards.alias_do_template(id_original))
+    if not conexao_processos.in_atomic_block:
+        raise TransactionManagementError("versao_para_edicao deve rodar em transacao_de_edicao().")
+    with conexao_processos.cursor() as cursor_processos:
+        cursor_processos.execute("SELECT 1 FROM processo WHERE id_template = %s LIMIT 1 FOR SHARE", [id_template])
+        publicado = cursor_processos.fetchone() is not None
+
+    if not publicado:
+        return id_template, id_template, False
+
+    return id_template, criar_versao(cursor, id_template), True
+
+
+def criar_versao(cursor, id_template):
+    """
+    Cria a próxima versão do template (cópia do grafo, ver copiar_grafo) e a torna a versão atual.
+    """
+    cursor.execute("""
+        INSERT INTO template_processo (nome, descricao, versao)
+        SELECT nome, descricao, versao + 1
+        FROM template_processo
+        WHERE id = %s
+    """, [id_template])
+    id_nova_versao = cursor.lastrowid
+
+    copiar_grafo(cursor, id_template, id_nova_versao)
+
+    cursor.execute("""
+        UPDATE template_processo SET id_versao_atual = %s
+        WHERE id = %s OR id_versao_atual = %s
+    """, [id_nova_versao, id_template, id_template])
+
+    return id_nova_versao
+
+
+def mapear_etapas(cursor, id_template_origem, id_template_destino, ids_etapas):
+    """
+    Ids, na cópia feita por copiar_grafo, das etapas 'ids_etapas' do template de origem.
+    Etapas que não pertencem ao template de origem ficam fora do dicionário.
+    """
+    marcadores = ', '.join(['%s'] * len(ids_etapas))
+    cursor.execute(
+        QUERY_MAPA_ETAPAS + f"SELECT id_antigo, id_novo FROM mapa WHERE id_antigo IN ({marcadores})",
+        [id_template_origem, id_template_destino, *ids_etapas]
+    )
+    return dict(cursor.fetchall())
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import shards
+
+CABECALHO_CHAVE = 'Idempotency-Key'
+CABECALHO_REPETICAO = 'Idempotent-Replayed'
+
+# erros que a mesma requisição sempre repetiria; conflitos (409, 423) dependem do momento e não são guardados
+ERROS_GUARDADOS = {400, 403, 404}
+
+
+def _ttl_segundos():
+    return getattr(settings, 'IDEMPOTENCIA_TTL_SEGUNDOS', 86400)
+
+
+def _abandono_segundos():
+    return getattr(settings, 'IDEMPOTENCIA_ABANDONO_SEGUNDOS', 60)
+
+
+def _hash_corpo(request):
+    """
+    SHA-256 do corpo já interpretado (JSON canônico): espaços e ordem das chaves não mudam o hash.
+    """
+    corpo = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha256(corpo.encode('utf-8')).hexdigest()
+
+
+def resposta_em_processamento():
+    return Response(
+        {"detail": f"Requisição com esta {CABECALHO_CHAVE} ainda em processamento."},
+        status=status.HTTP_409_CONFLICT
+    )
+
+
+class ReservaChave:
+    """
+    Chave reservada por uma requisição. O token identifica a dona da reserva, que vale por
+    IDEMPOTENCIA_ABANDONO_SEGUNDOS; depois disso, outra requisição com a mesma chave pode assumi-la
+    (novo token) e as gravações da dona anterior passam a não encontrar a chave (ver gravar_resposta).
+    """
+
+    def __init__(self, alias, id_usuario, chave, token):
+        self.alias = alias
+        self.id_usuario = id_usuario
+        self.chave = chave
+        self.token = token
+        self.resposta_gravada = None
+
+
+def _reservar_chave(cursor, alias, id_usuario, chave, rota, hash_corpo, token):
+    """
+    Busca a chave e, se ela ainda não existir (ou estiver expirada, ou com a reserva vencida), a reserva
+    para esta requisição com o 'token'. Retorna uma Response quando a requisição não deve ser executada
+    (repetição de um resultado já salvo ou conflito), ou None quando a view deve rodar.
+    """
+    query_busca = """
+        SELECT rota, hash_corpo, status_http, resposta, token, expira_em > NOW(), reserva_expira > NOW()
+        FROM chave_idempotencia
+        WHERE id_usuario = %s AND chave = %s
+    """
+    cursor.execute(query_busca, [id_usuario, chave])
+    registro = cursor.fetchone()
+
+    if registro:
+        rota_salva, hash_salvo, status_http, resposta, token_salvo, valida, reservada = registro
+
+        if valida:
+            if rota_salva != rota:
+                return Response(
+                    {"detail": f"{CABECALHO_CHAVE} já utilizada em outra operação."},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                )
+            if hash_salvo != hash_corpo:
+                return Response(
+                    {"detail": f"{CABECALHO_CHAVE} já utilizada com outro corpo de requisição."},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                )
+            if status_http is not None:
+                return Response(
+                    json.loads(resposta) if resposta is not None else None,
+                    status=status_http,
+                    headers={CABECALHO_REPETICAO: 'true'}
+                )
+            if reservada:
+                return resposta_em_processamento()
+
+            # reserva vencida (a dona caiu ou ainda não terminou): esta requisição assume a chave;
+            # se a dona anterior terminar depois, gravar_resposta desfaz o que ela fez
+            query_assumir = """
+                UPDATE chave_idempotencia SET token = %s, reserva_expira = NOW() + INTERVAL %s SECOND
+                WHERE id_usuario = %s AND chave = %s AND token = %s AND status_http IS NULL
+            """
+            cursor.execute(query_assumir, [token, _abandono_segundos(), id_usuario, chave, token_salvo])
+            return None if cursor.rowcount == 1 else resposta_em_processamento()
+
+        cursor.execute(
+            "DELETE FROM chave_idempotencia WHERE id_usuario = %s AND chave = %s AND expira_em <= NOW()",
+            [id_usuario, chave]
+        )
+
+    query_reserva = """
+        INSERT INTO chave_idempotencia (id_usuario, chave, rota, hash_corpo, token, reserva_expira, expira_em)
+        VALUES (%s, %s, %s, %s, %s, NOW() + INTERVAL %s SECOND, NOW() + INTERVAL %s SECOND)
+    """
+    try:
+        with transaction.atomic(using=alias):
+            cursor.execute(query_reserva, [
+                id_usuario, chave, rota, hash_corpo, token, _abandono_segundos(), _ttl_segundos()
+            ])
+    except IntegrityError:
+        # outra requisição com a mesma chave reservou primeiro
+        return resposta_em_processamento()
+
+    return None
+
+
+def _concluir(cursor, reserva, response):
+    query_resultado = """
+        UPDATE chave_idempotencia SET status_http = %s, resposta = %s
+        WHERE id_usuario = %s AND chave = %s AND token = %s AND status_http IS NULL
+    """
+    cursor.execute(query_resultado, [
+        response.status_code,
+        json.dumps(getattr(response, 'data', None), cls=DjangoJSONEncoder),
+        reserva.id_usuario,
+        reserva.chave,
+        reserva.token
+    ])
+    return cursor.rowcount == 1
+
+
+def _liberar(reserva):
+    with shards.conexao(reserva.alias).cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM chave_idempotencia WHERE id_usuario = %s AND chave = %s AND token = %s AND status_http IS NULL",
+            [reserva.id_usuario, reserva.chave, reserva.token]
+        )
+
+
+def gravar_resposta(request, cursor, response):
+    """
+    Grava 'response' como o resultado da Idempotency-Key da requisição (se houver) pelo 'cursor', dentro
+    da transação que alterou o workflow: o resultado e as alterações são confirmados (ou perdidos) juntos.
+
+    Retorna False se a requisição perdeu a reserva da chave para outra; a view deve então desfazer a
+    transação e responder resposta_em_processamento().
+    """
+    reserva = getattr(request, 'reserva_idempotencia', None)
+    if reserva is None:
+        return True
+    if not _concluir(cursor, reserva, response):
+        return False
+    reserva.resposta_gravada = response
+    return True
+
+
+def idempotente(operacao, alias=None):
+    """
+    Decorator para ações de escrita do workflow que aceitam o cabeçalho Idempotency-Key.
+
+    A primeira requisição com uma chave executa a view e salva o status e o corpo da resposta
+    por IDEMPOTENCIA_TTL_SEGUNDOS. Repetições com a mesma chave (e mesmo usuário) e o mesmo corpo
+    recebem a resposta salva a partir de uma busca pela chave primária, sem tocar nas tabelas do workflow.
+    Só são salvos os sucessos (2xx) e os erros de ERROS_GUARDADOS: conflitos e 5xx liberam a chave,
+    para que o cliente possa tentar novamente.
+
+    A view grava o resultado de sucesso com gravar_resposta, na mesma transação das alterações; os
+    demais resultados são salvos aqui, depois da view. 'alias(request, **kwargs)' é o alias da
+    operação (onde fica a chave); sem ele, o 'default'.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(self, request, *args, **kwargs):
+            chave = request.headers.get(CABECALHO_CHAVE)
+            if not chave:
+                return view(self, request, *args, **kwargs)
+
+            if len(chave) > 255:
+                return Response(
+                    {"detail": f"{CABECALHO_CHAVE} deve ter no máximo 255 caracteres."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            id_usuario = request.user.id
+            rota = f"{operacao}:{kwargs.get('pk', '')}"
+            alias_chave = alias(request, **kwargs) if alias else 'default'
+            reserva = ReservaChave(alias_chave, id_usuario, chave, uuid.uuid4().hex)
+
+            with shards.conexao(alias_chave).cursor() as cursor:
+                resposta_salva = _reservar_chave(
+                    cursor, alias_chave, id_usuario, chave, rota, _hash_corpo(request), reserva.token
+                )
+            if resposta_salva is not None:
+                return resposta_salva
+
+            request.reserva_idempotencia = reserva
+            try:
+                response = view(self, request, *args, **kwargs)
+            except Exception:
+                _liberar(reserva)
+                raise
+
+            if not (200 <= response.status_code < 300 or response.status_code in ERROS_GUARDADOS):
+                _liberar(reserva)
+            elif reserva.resposta_gravada is not response:
+                with shards.conexao(alias_chave).cursor() as cursor:
+                    _concluir(cursor, reserva, response)
+
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,385 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import shards
+
+JOBS_REGISTRADOS = {}
+
+STATUS_PENDENTE = 'PENDENTE'
+STATUS_EXECUTANDO = 'EXECUTANDO'
+STATUS_CONCLUIDO = 'CONCLUIDO'
+STATUS_ERRO = 'ERRO'
+
+
+def registrar_job(tipo):
+    """
+    Decorator que registra uma função como executora dos jobs do 'tipo' informado.
+    A função recebe um ContextoJob e pode retornar um dicionário (salvo em 'resultado').
+    """
+    def decorator(funcao):
+        JOBS_REGISTRADOS[tipo] = funcao
+        return funcao
+    return decorator
+
+
+def nome_worker():
+    """
+    Identificador do worker atual (host:pid), gravado no job reservado.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lease_segundos():
+    return getattr(settings, 'JOBS_LEASE_SEGUNDOS', 300)
+
+
+class ContextoJob:
+    """
+    Dados do job reservado, entregues à função executora.
+    """
+
+    def __init__(self, id, tipo, parametros, tentativas, worker):
+        self.id = id
+        self.tipo = tipo
+        self.parametros = parametros
+        self.tentativas = tentativas
+        self.worker = worker
+
+    def progresso(self, dados):
+        """
+        Registra o progresso do job (só enquanto a reserva ainda é deste worker).
+        """
+        query = """
+            UPDATE job SET progresso = %s
+            WHERE id = %s AND worker = %s AND status_job = 'EXECUTANDO'
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query, [json.dumps(dados, default=str), self.id, self.worker])
+
+
+class RenovacaoReserva(threading.Thread):
+    """
+    Renova a reserva do job a cada JOBS_LEASE_SEGUNDOS / 3 enquanto a função executora roda,
+    mesmo que ela passe muito tempo sem registrar progresso (ex.: a simulação de prever_conclusoes).
+    Se o worker morrer, a renovação para junto e a reserva expira (liberar_jobs_expirados).
+
+    Roda em uma thread própria, então usa uma conexão própria com o banco (fechada ao final).
+    """
+
+    def __init__(self, job):
+        super().__init__(daemon=True)
+        self.job = job
+        self.parar = threading.Event()
+
+    def run(self):
+        query = """
+            UPDATE job SET reserva_expira = NOW() + INTERVAL %s SECOND
+            WHERE id = %s AND worker = %s AND status_job = 'EXECUTANDO'
+        """
+        try:
+            while not self.parar.wait(lease_segundos() / 3):
+                with connection.cursor() as cursor:
+                    cursor.execute(query, [lease_segundos(), self.job.id, self.job.worker])
+                    if cursor.rowcount == 0:
+                        # a reserva expirou e o job foi devolvido à fila: o resultado deste worker será descartado
+                        break
+        finally:
+            connection.close()
+
+
+def enfileirar_job(tipo, parametros, id_usuario=None, max_tentativas=None):
+    """
+    Insere um novo job na fila e retorna o seu id.
+    """
+    if tipo not in JOBS_REGISTRADOS:
+        raise ValueError(f"Tipo de job desconhecido: {tipo}")
+
+    if max_tentativas is None:
+        max_tentativas = getattr(settings, 'JOBS_MAX_TENTATIVAS', 3)
+
+    query = """
+        INSERT INTO job (tipo, parametros, id_usuario, max_tentativas)
+        VALUES (%s, %s, %s, %s)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, [tipo, json.dumps(parametros, default=str), id_usuario, max_tentativas])
+        return cursor.lastrowid
+
+
+def liberar_jobs_expirados():
+    """
+    Devolve para a fila os jobs cujo worker parou de renovar a reserva (worker morto).
+    Um job que já usou as max_tentativas (o worker morre sempre nele) vai para ERRO.
+    """
+    query = """
+        UPDATE job
+        SET status_job = IF(tentativas >= max_tentativas, 'ERRO', 'PENDENTE'),
+            data_fim = IF(tentativas >= max_tentativas, NOW(), NULL),
+            erro = IF(tentativas >= max_tentativas, 'Reserva expirada: o worker parou de renovar a reserva.', erro),
+            worker = NULL, reserva_expira = NULL
+        WHERE status_job = 'EXECUTANDO' AND reserva_expira < NOW()
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        return cursor.rowcount
+
+
+def reservar_job(worker):
+    """
+    Reserva o próximo job pendente da fila.
+
+    O SELECT ... FOR UPDATE SKIP LOCKED faz com que vários workers disputem a fila
+    em paralelo sem esperar uns pelos outros: cada um pula as linhas já travadas.
+    Retorna um ContextoJob ou None se a fila estiver vazia.
+    """
+    query_proximo = """
+        SELECT id, tipo, parametros, tentativas FROM job
+        WHERE status_job = 'PENDENTE' AND data_disponivel <= NOW()
+        ORDER BY data_disponivel, id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    """
+    query_reserva = """
+        UPDATE job
+        SET status_job = 'EXECUTANDO', tentativas = tentativas + 1, worker = %s,
+            data_inicio = NOW(), reserva_expira = NOW() + INTERVAL %s SECOND
+        WHERE id = %s
+    """
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(query_proximo)
+            row = cursor.fetchone()
+            if not row:
+                return None
+
+            id_job, tipo, parametros, tentativas = row
+            cursor.execute(query_reserva, [worker, lease_segundos(), id_job])
+
+    return ContextoJob(id_job, tipo, json.loads(parametros), tentativas + 1, worker)
+
+
+def executar_job(job):
+    """
+    Executa um job reservado e grava o resultado.
+    Em caso de erro, o job volta para a fila (com espera crescente) até atingir max_tentativas.
+
+    O resultado só é gravado se o job ainda está reservado para este worker: se a reserva expirou
+    e o job foi entregue a outro worker, o resultado deste é descartado e a função retorna False.
+    """
+    funcao = JOBS_REGISTRADOS.get(job.tipo)
+    renovacao = RenovacaoReserva(job)
+    renovacao.start()
+
+    try:
+        if funcao is None:
+            raise ValueError(f"Tipo de job desconhecido: {job.tipo}")
+        resultado = funcao(job)
+    except Exception:
+        erro = traceback.format_exc()
+        query_erro = """
+            UPDATE job
+            SET status_job = IF(tentativas >= max_tentativas, 'ERRO', 'PENDENTE'),
+                data_disponivel = NOW() + INTERVAL %s SECOND,
+                data_fim = IF(tentativas >= max_tentativas, NOW(), NULL),
+                erro = %s, worker = NULL, reserva_expira = NULL
+            WHERE id = %s AND worker = %s AND status_job = 'EXECUTANDO'
+        """
+        espera = getattr(settings, 'JOBS_ESPERA_RETENTATIVA_SEGUNDOS', 30) * job.tentativas
+        with connection.cursor() as cursor:
+            cursor.execute(query_erro, [espera, erro, job.id, job.worker])
+        return False
+    finally:
+        renovacao.parar.set()
+        renovacao.join()
+
+    query_sucesso = """
+        UPDATE job
+        SET status_job = 'CONCLUIDO', resultado = %s, data_fim = NOW(),
+            erro = NULL, reserva_expira = NULL
+        WHERE id = %s AND worker = %s AND status_job = 'EXECUTANDO'
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query_sucesso, [json.dumps(resultado or {}, default=str), job.id, job.worker])
+        return cursor.rowcount == 1
+
+
+def excluir_em_lotes(job, passos):
+    """
+    Executa cada passo (tabela, DELETE sem LIMIT, parâmetros) em lotes de EXCLUSAO_LOTE linhas,
+    até não restarem linhas, na ordem recebida (dependentes antes das tabelas referenciadas).
+    Todos os passos rodam em todos os aliases: os das tabelas replicadas (shards.TABELAS_REPLICADAS)
+    apagam também as cópias das linhas nos shards.
+
+    Cada lote é uma transação curta (autocommit): as travas e o undo log ficam limitados ao
+    tamanho do lote e, entre um lote e outro, o job espera EXCLUSAO_PAUSA_SEGUNDOS para não
+    disputar o banco com as requisições. O total removido por tabela é gravado como progresso.
+    """
+    lote = getattr(settings, 'EXCLUSAO_LOTE', 1000)
+    pausa = getattr(settings, 'EXCLUSAO_PAUSA_SEGUNDOS', 0.1)
+    removidos = {}
+
+    for tabela, query, params in passos:
+        removidos[tabela] = 0
+        for alias in shards.aliases():
+            while True:
+                with shards.conexao(alias).cursor() as cursor:
+                    cursor.execute(query + " LIMIT %s", [*params, lote])
+                    quantidade = cursor.rowcount
+
+                removidos[tabela] += quantidade
+                job.progresso({"tabela": tabela, "removidos": removidos})
+                if quantidade < lote:
+                    break
+                time.sleep(pausa)
+
+    return removidos
+
+
+@registrar_job('excluir_template')
+def excluir_template(job):
+    """
+    Remove um template já marcado como oculto, com todas as suas versões, e tudo o que
+    depende dele (execuções, processos, fluxos, campos e etapas), em lotes.
+    """
+    id_template = job.parametros['id_template']
+    versoes = [id_template, id_template]
+    versoes_do_template = "SELECT id FROM template_processo WHERE id = %s OR id_versao_atual = %s"
+    etapas_do_template = f"SELECT id FROM etapa WHERE id_template IN ({versoes_do_template})"
+
+    return excluir_em_lotes(job, [
+        ('execucao_etapa', f"DELETE FROM execucao_etapa WHERE id_etapa IN ({etapas_do_template})", versoes),
+        ('processo', f"DELETE FROM processo WHERE id_template IN ({versoes_do_template})", versoes),
+        ('fluxo_execucao', f"DELETE FROM fluxo_execucao WHERE id_origem IN ({etapas_do_template})", versoes),
+        ('modelo_campo', f"DELETE FROM modelo_campo WHERE id_etapa IN ({etapas_do_template})", versoes),
+        ('etapa', f"DELETE FROM etapa WHERE id_template IN ({versoes_do_template})", versoes),
+        ('template_processo', "DELETE FROM template_processo WHERE (id = %s OR id_versao_atual = %s) AND oculto = TRUE", versoes),
+    ])
+
+
+@registrar_job('excluir_etapa')
+def excluir_etapa(job):
+    """
+    Remove uma etapa já marcada como oculta, suas execuções, fluxos e campos, em lotes.
+    """
+    id_etapa = job.parametros['id_etapa']
+
+    return excluir_em_lotes(job, [
+        ('execucao_etapa', "DELETE FROM execucao_etapa WHERE id_etapa = %s", [id_etapa]),
+        ('fluxo_execucao', "DELETE FROM fluxo_execucao WHERE id_origem = %s OR id_destino = %s", [id_etapa, id_etapa]),
+        ('modelo_campo', "DELETE FROM modelo_campo WHERE id_etapa = %s", [id_etapa]),
+        ('etapa', "DELETE FROM etapa WHERE id = %s AND oculto = TRUE", [id_etapa]),
+    ])
+
+
+@registrar_job('reatribuir_pendencias')
+def reatribuir_pendencias(job):
+    """
+    Passa as execuções pendentes de um usuário para outro do mesmo cargo, em lotes de
+    REATRIBUICAO_LOTE execuções, junto com o que depende do responsável da execução:
+    processo.id_usuario_atual, participacao_processo e escalonamento.
+
+    A compatibilidade de cargos é validada uma vez pela view (o trigger insertExecucao só
+    confere inserções); aqui cada lote só pega execuções de etapas cujo responsável é o cargo
+    do destino. Cada lote é uma transação curta, com pausa de REATRIBUICAO_PAUSA_SEGUNDOS.
+    Os aliases (ver shards) são percorridos um de cada vez.
+    """
+    origem = job.parametros['id_usuario_origem']
+    destino = job.parametros['id_usuario_destino']
+    cargo = job.parametros['cargo']
+    lote = getattr(settings, 'REATRIBUICAO_LOTE', 500)
+    pausa = getattr(settings, 'REATRIBUICAO_PAUSA_SEGUNDOS', 0.1)
+
+    query_lote = """
+        SELECT ee.id, ee.id_processo FROM execucao_etapa ee
+        JOIN etapa e ON e.id = ee.id_etapa
+        WHERE ee.id_usuario = %s AND ee.status_exec = 'PENDENTE' AND e.responsavel = %s
+        ORDER BY ee.id
+        LIMIT %s
+        FOR UPDATE OF ee
+    """
+
+    reatribuidas = 0
+    for alias in shards.aliases():
+        while True:
+            with transaction.atomic(using=alias), shards.conexao(alias).cursor() as cursor:
+                cursor.execute(query_lote, [origem, cargo, lote])
+                linhas = cursor.fetchall()
+                if not linhas:
+                    break
+
+                execucoes = [row[0] for row in linhas]
+                processos = sorted({row[1] for row in linhas})
+                marcadores_exec = ', '.join(['%s'] * len(execucoes))
+                marcadores_proc = ', '.join(['%s'] * len(processos))
+
+                # a reserva feita pelo usuário de origem não vale para o destino
+                cursor.execute(f"""
+                    UPDATE execucao_etapa
+                    SET id_usuario = %s,
+                        reserva_expira = IF(reservado_por = %s, NULL, reserva_expira),
+                        reservado_por = IF(reservado_por = %s, NULL, reservado_por)
+                    WHERE id IN ({marcadores_exec}) AND status_exec = 'PENDENTE'
+                """, [destino, origem, origem, *execucoes])
+                cursor.execute(f"""
+                    UPDATE processo SET id_usuario_atual = %s
+                    WHERE id IN ({marcadores_proc}) AND id_exec_atual IN ({marcadores_exec})
+                """, [destino, *processos, *execucoes])
+                cursor.execute(f"""
+                    INSERT IGNORE INTO participacao_processo (id_usuario, id_processo, data_inicio)
+                    SELECT %s, id, data_inicio FROM processo WHERE id IN ({marcadores_proc})
+                """, [destino, *processos])
+                # a origem continua participando só dos processos em que ainda tem alguma execução
+                # (a mesma regra de popular_participacao)
+                cursor.execute(f"""
+                    DELETE pp FROM participacao_processo pp
+                    WHERE pp.id_usuario = %s AND pp.id_processo IN ({marcadores_proc})
+                    AND NOT EXISTS (
+                        SELECT 1 FROM execucao_etapa ee
+                        WHERE ee.id_processo = pp.id_processo AND ee.id_usuario = pp.id_usuario
+                    )
+                """, [origem, *processos])
+                cursor.execute(f"""
+                    UPDATE escalonamento SET id_usuario = %s WHERE id_exec_etapa IN ({marcadores_exec})
+                """, [destino, *execucoes])
+
+            reatribuidas += len(execucoes)
+            job.progresso({"reatribuidas": reatribuidas})
+            if len(execucoes) < lote:
+                break
+            time.sleep(pausa)
+
+    return {"reatribuidas": reatribuidas}
+
+
+@registrar_job('prever_conclusoes')
+def prever_conclusoes(job):
+    """
+    Simula a conclusão de todos os processos abertos (processos.previsao) e regrava 'previsao_conclusao'.
+    """
+    # o NumPy só é carregado pelo worker que executa o job
+    from .previsao import prever_conclusoes as simular_conclusoes
+
+    agora, previsoes = simular_conclusoes()
+    query = """
+        INSERT INTO previsao_conclusao
+            (id_processo, id_template, id_etapa_atual, p50, p80, p95, prob_conclusao, data_previsao)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    linhas = [
+        [p['id_processo'], p['id_template'], p['id_etapa_atual'], p['p50'], p['p80'], p['p95'], p['prob_conclusao'], agora]
+        for p in previsoes
+    ]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("DELETE FROM previsao_conclusao")
+        for inicio in range(0, len(linhas), 1000):
+            cursor.executemany(query, linhas[inicio:inicio + 1000])
+
+    return {"processos": len(previsoes)}
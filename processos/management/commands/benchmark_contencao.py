@@ -0,0 +1,226 @@
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from bdedica.metricas import registro
+from processos import shards
+from processos.views import ExecucaoEtapaViewSet
+from usuarios.models import Usuario
+
+QUERY_STATUS_INNODB = """
+    SHOW GLOBAL STATUS WHERE Variable_name IN ('Innodb_row_lock_waits', 'Innodb_row_lock_time')
+"""
+QUERY_DEADLOCKS = "SELECT count FROM information_schema.INNODB_METRICS WHERE name = 'lock_deadlocks'"
+
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return 0.0
+    indice = max(0, math.ceil(p / 100 * len(valores_ordenados)) - 1)
+    return valores_ordenados[indice]
+
+
+def contadores_innodb():
+    with connection.cursor() as cursor:
+        cursor.execute(QUERY_STATUS_INNODB)
+        contadores = {nome: int(valor) for nome, valor in cursor.fetchall()}
+        cursor.execute(QUERY_DEADLOCKS)
+        linha = cursor.fetchone()
+        contadores['lock_deadlocks'] = int(linha[0]) if linha else 0
+    return contadores
+
+
+def erros_mysql():
+    return Counter({
+        dict(labels)['codigo']: valor
+        for nome, labels, valor in registro.retrato()['contadores']
+        if nome == 'bdedica_mysql_erros_total'
+    })
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark de contenção de escrita: várias threads chamam iniciar e finalizar "
+        "(as mesmas views da API) ao mesmo tempo, concentrando as finalizações em poucos processos. "
+        "Cria processos e execuções: use apenas em um banco local/de testes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help="Clientes simultâneos.")
+        parser.add_argument('--duracao', type=float, default=30.0, help="Duração da carga, em segundos.")
+        parser.add_argument('--template', type=int, default=1, help="Template usado em iniciar.")
+        parser.add_argument(
+            '--proporcao-iniciar', type=float, default=0.2,
+            help="Fração das operações que são iniciar (as demais são finalizar)."
+        )
+        parser.add_argument(
+            '--processos-quentes', type=int, default=5,
+            help="Tamanho do conjunto de processos disputados (hot spot)."
+        )
+        parser.add_argument(
+            '--skew', type=float, default=0.8,
+            help="Fração das finalizações que vão para os processos quentes (0 = uniforme)."
+        )
+        parser.add_argument('--semente', type=int, default=0, help="Semente dos sorteios.")
+        parser.add_argument(
+            '--confirmar', action='store_true',
+            help="Confirma que o banco configurado pode receber os dados gerados pelo benchmark."
+        )
+
+    def handle(self, *args, **options):
+        if not options['confirmar']:
+            raise CommandError(
+                f"O benchmark grava processos no banco '{connection.settings_dict['NAME']}'. "
+                "Rode em um banco local/de testes e passe --confirmar."
+            )
+        if connection.vendor != 'mysql':
+            raise CommandError("O benchmark precisa do MySQL (procedures e contadores do InnoDB).")
+
+        self.id_template = options['template']
+        self.usuarios, self.destinos = self._carregar_cenario()
+        processos = self._carregar_processos()
+
+        quentes = processos[:max(1, options['processos_quentes'])]
+        frios = processos[len(quentes):] or quentes
+        self.stdout.write(
+            f"{options['threads']} thread(s) por {options['duracao']}s; "
+            f"{len(quentes)} processo(s) quente(s), {len(frios)} frio(s), skew {options['skew']}."
+        )
+
+        latencias = {'iniciar': [], 'finalizar': []}
+        status_http = {'iniciar': Counter(), 'finalizar': Counter()}
+        lock = threading.Lock()
+        fim = time.monotonic() + options['duracao']
+
+        def cliente(indice):
+            sorteio = random.Random(options['semente'] + indice)
+            minhas_latencias = {'iniciar': [], 'finalizar': []}
+            meus_status = {'iniciar': Counter(), 'finalizar': Counter()}
+            try:
+                while time.monotonic() < fim:
+                    if sorteio.random() < options['proporcao_iniciar']:
+                        operacao, resultado = 'iniciar', self._iniciar
+                    else:
+                        conjunto = quentes if sorteio.random() < options['skew'] else frios
+                        operacao, resultado = 'finalizar', lambda: self._finalizar(sorteio.choice(conjunto))
+
+                    inicio = time.perf_counter()
+                    codigo = resultado()
+                    minhas_latencias[operacao].append(time.perf_counter() - inicio)
+                    meus_status[operacao][codigo] += 1
+            finally:
+                connections.close_all()
+                with lock:
+                    for operacao in latencias:
+                        latencias[operacao].extend(minhas_latencias[operacao])
+                        status_http[operacao].update(meus_status[operacao])
+
+        antes_innodb, antes_erros = contadores_innodb(), erros_mysql()
+        inicio_carga = time.monotonic()
+
+        threads = [threading.Thread(target=cliente, args=(i,)) for i in range(max(1, options['threads']))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        duracao = time.monotonic() - inicio_carga
+        depois_innodb, depois_erros = contadores_innodb(), erros_mysql()
+        self._relatorio(duracao, latencias, status_http, antes_innodb, depois_innodb, depois_erros - antes_erros)
+
+    def _carregar_cenario(self):
+        """
+        Um usuário por cargo e, para cada etapa do template, a etapa de destino usada por finalizar.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT cargo, MIN(id) FROM usuario GROUP BY cargo")
+            usuarios = {
+                cargo: Usuario(id=id_usuario, username=f"benchmark-{cargo.lower()}", cargo=cargo)
+                for cargo, id_usuario in cursor.fetchall()
+            }
+
+            cursor.execute("""
+                SELECT f.id_origem, f.id_destino, e.responsavel
+                FROM fluxo_execucao f
+                JOIN etapa e ON e.id = f.id_destino
+                JOIN etapa o ON o.id = f.id_origem
+                WHERE o.id_template = %s
+                ORDER BY f.id_origem, f.id
+            """, [self.id_template])
+            destinos = {}
+            for id_origem, id_destino, responsavel in cursor.fetchall():
+                destinos.setdefault(id_origem, (id_destino, responsavel))
+
+        if 'ORIENTADOR' not in usuarios:
+            raise CommandError("É preciso ao menos um usuário ORIENTADOR para iniciar processos.")
+        return usuarios, destinos
+
+    def _carregar_processos(self):
+        def consultar(cursor):
+            cursor.execute("""
+                SELECT id FROM processo
+                WHERE id_template = %s AND status_proc = 'PENDENTE' AND id_exec_atual IS NOT NULL
+            """, [self.id_template])
+            return [row[0] for row in cursor.fetchall()]
+
+        processos = sorted(id_processo for ids in shards.em_todos(consultar) for id_processo in ids)
+
+        if not processos:
+            raise CommandError(f"O template {self.id_template} não tem processos pendentes para finalizar.")
+        return processos
+
+    def _iniciar(self):
+        requisicao = APIRequestFactory().post(
+            '/api/processos/exec_etapas/iniciar/', {"id_template": self.id_template}, format='json'
+        )
+        force_authenticate(requisicao, user=self.usuarios['ORIENTADOR'])
+        return ExecucaoEtapaViewSet.as_view({'post': 'iniciar_processo'})(requisicao).status_code
+
+    def _finalizar(self, id_processo):
+        with shards.conexao(shards.alias_do_registro(id_processo)).cursor() as cursor:
+            cursor.execute(
+                "SELECT id_exec_atual, id_etapa_atual FROM processo WHERE id = %s AND status_proc = 'PENDENTE'",
+                [id_processo]
+            )
+            atual = cursor.fetchone()
+
+        destino = atual and self.destinos.get(atual[1])
+        if not destino or destino[1] not in self.usuarios:
+            return 'sem etapa pendente'
+
+        requisicao = APIRequestFactory().post(
+            f'/api/processos/exec_etapas/{atual[0]}/finalizar/', {"observacoes": "benchmark"}, format='json'
+        )
+        force_authenticate(requisicao, user=self.usuarios[destino[1]])
+        return ExecucaoEtapaViewSet.as_view({'post': 'finalizar_execucao'})(requisicao, pk=atual[0]).status_code
+
+    def _relatorio(self, duracao, latencias, status_http, antes, depois, erros):
+        total = sum(len(valores) for valores in latencias.values())
+        self.stdout.write(f"\n{total} operações em {duracao:.1f}s ({total / duracao:.1f} op/s)\n")
+
+        self.stdout.write(f"{'operação':<10} {'qtd':>7} {'op/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'máx ms':>8}  status")
+        for operacao, valores in latencias.items():
+            valores.sort()
+            ms = [percentil(valores, p) * 1000 for p in (50, 95, 99, 100)]
+            status_texto = ', '.join(f"{codigo}: {qtd}" for codigo, qtd in sorted(status_http[operacao].items(), key=str))
+            self.stdout.write(
+                f"{operacao:<10} {len(valores):>7} {len(valores) / duracao:>8.1f} "
+                f"{ms[0]:>8.1f} {ms[1]:>8.1f} {ms[2]:>8.1f} {ms[3]:>8.1f}  {status_texto}"
+            )
+
+        esperas = depois['Innodb_row_lock_waits'] - antes['Innodb_row_lock_waits']
+        tempo_espera = depois['Innodb_row_lock_time'] - antes['Innodb_row_lock_time']
+        self.stdout.write("\nInnoDB (diferença no período, servidor inteiro):")
+        self.stdout.write(f"  esperas por lock de linha: {esperas}")
+        self.stdout.write(f"  tempo total de espera: {tempo_espera} ms (média {tempo_espera / esperas if esperas else 0:.1f} ms)")
+        self.stdout.write(f"  deadlocks: {depois['lock_deadlocks'] - antes['lock_deadlocks']}")
+
+        if erros:
+            texto = ', '.join(f"{codigo}: {qtd}" for codigo, qtd in sorted(erros.items()))
+            self.stdout.write(f"  erros do MySQL nas procedures (código: qtd): {texto}")
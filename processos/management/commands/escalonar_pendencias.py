@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from processos import shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Registra em 'escalonamento' as execuções pendentes além do prazo da etapa (etapa.prazo_horas). "
+        "Incremental: cada execução é lida uma única vez. Percorre todos os aliases (shards). "
+        "Agende a cada poucos minutos (cron)."
+    )
+
+    def handle(self, *args, **options):
+        # Para uma etapa com prazo P, as execuções iniciadas até (agora - P) já venceram. A marca d'água
+        # de cada etapa guarda até onde isso já foi verificado: cada execução é lida uma única vez, por
+        # uma faixa do índice idx_exec_fila (status_exec, id_etapa, data_inicio). As que ainda estão
+        # pendentes na faixa são escalonadas; as concluídas nunca mais são lidas.
+        query_escalonar = """
+            INSERT IGNORE INTO escalonamento (id_exec_etapa, id_processo, id_etapa, id_usuario, prazo)
+            SELECT ee.id, ee.id_processo, ee.id_etapa, ee.id_usuario,
+                ee.data_inicio + INTERVAL e.prazo_horas HOUR
+            FROM etapa e
+            LEFT JOIN marca_escalonamento m ON m.id_etapa = e.id
+            JOIN execucao_etapa ee ON ee.status_exec = 'PENDENTE' AND ee.id_etapa = e.id
+                AND ee.data_inicio > COALESCE(m.ate, '1000-01-01')
+                AND ee.data_inicio <= %s - INTERVAL e.prazo_horas HOUR
+            WHERE e.prazo_horas IS NOT NULL AND e.oculto = FALSE
+        """
+        query_marca = """
+            INSERT INTO marca_escalonamento (id_etapa, ate)
+            SELECT id, %s - INTERVAL prazo_horas HOUR
+            FROM etapa
+            WHERE prazo_horas IS NOT NULL AND oculto = FALSE
+            ON DUPLICATE KEY UPDATE ate = GREATEST(ate, VALUES(ate))
+        """
+
+        # cada alias guarda as suas execuções, escalonamentos e marcas d'água
+        escalonadas = 0
+        for alias in shards.aliases():
+            with transaction.atomic(using=alias), shards.conexao(alias).cursor() as cursor:
+                # o mesmo instante nas duas consultas: a marca avança exatamente até onde foi verificado
+                cursor.execute("SELECT NOW()")
+                agora = cursor.fetchone()[0]
+
+                cursor.execute(query_escalonar, [agora])
+                escalonadas += cursor.rowcount
+                cursor.execute(query_marca, [agora])
+
+        self.stdout.write(self.style.SUCCESS(f"{escalonadas} execuções escalonadas."))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from processos import shards
+
+
+class Command(BaseCommand):
+    help = "Remove as chaves de idempotência expiradas (tabela chave_idempotencia)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lote', type=int, default=5000,
+            help="Quantidade máxima de linhas removidas por comando DELETE."
+        )
+
+    def handle(self, *args, **options):
+        lote = max(1, options['lote'])
+        total = 0
+
+        # a chave fica no alias da operação (ver idempotencia.idempotente)
+        for alias in shards.aliases():
+            with shards.conexao(alias).cursor() as cursor:
+                while True:
+                    cursor.execute("DELETE FROM chave_idempotencia WHERE expira_em <= NOW() LIMIT %s", [lote])
+                    total += cursor.rowcount
+                    if cursor.rowcount < lote:
+                        break
+
+        self.stdout.write(self.style.SUCCESS(f"{total} chaves expiradas removidas."))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from processos import shards
+
+
+class Command(BaseCommand):
+    help = "Preenche a etapa atual de cada processo (id_exec_atual, id_etapa_atual, id_usuario_atual) a partir de execucao_etapa."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lote', type=int, default=1000,
+            help="Quantidade de processos (faixa de ids) processados por transação."
+        )
+
+    def handle(self, *args, **options):
+        lote = max(1, options['lote'])
+
+        # a etapa atual é a execução mais recente do processo (mesmo critério do histórico)
+        query_backfill = """
+            UPDATE processo p
+            JOIN (
+                SELECT id, id_processo, id_etapa, id_usuario,
+                    ROW_NUMBER() OVER (PARTITION BY id_processo ORDER BY data_inicio DESC, id DESC) AS posicao
+                FROM execucao_etapa
+                WHERE id_processo > %s AND id_processo <= %s
+            ) ee ON ee.id_processo = p.id AND ee.posicao = 1
+            SET p.id_exec_atual = ee.id, p.id_etapa_atual = ee.id_etapa, p.id_usuario_atual = ee.id_usuario
+        """
+
+        total = 0
+        for alias in shards.aliases():
+            conexao = shards.conexao(alias)
+            with conexao.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM processo")
+                id_min, id_max = cursor.fetchone()
+
+            inicio = id_min - 1
+            while inicio < id_max:
+                fim = inicio + lote
+                with transaction.atomic(using=alias), conexao.cursor() as cursor:
+                    cursor.execute(query_backfill, [inicio, fim])
+                    total += cursor.rowcount
+                inicio = fim
+
+        self.stdout.write(self.style.SUCCESS(f"{total} processos atualizados."))
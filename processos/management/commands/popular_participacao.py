@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from processos import shards
+
+
+class Command(BaseCommand):
+    help = "Preenche participacao_processo a partir do histórico existente em execucao_etapa."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lote', type=int, default=1000,
+            help="Quantidade de processos (faixa de ids) processados por transação."
+        )
+
+    def handle(self, *args, **options):
+        lote = max(1, options['lote'])
+
+        query_backfill = """
+            INSERT IGNORE INTO participacao_processo (id_usuario, id_processo, data_inicio)
+            SELECT DISTINCT ee.id_usuario, ee.id_processo, p.data_inicio
+            FROM execucao_etapa ee
+            JOIN processo p ON p.id = ee.id_processo
+            WHERE ee.id_processo > %s AND ee.id_processo <= %s
+        """
+
+        total = 0
+        for alias in shards.aliases():
+            conexao = shards.conexao(alias)
+            with conexao.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM processo")
+                id_min, id_max = cursor.fetchone()
+
+            inicio = id_min - 1
+            while inicio < id_max:
+                fim = inicio + lote
+                with transaction.atomic(using=alias), conexao.cursor() as cursor:
+                    cursor.execute(query_backfill, [inicio, fim])
+                    total += cursor.rowcount
+                inicio = fim
+
+        self.stdout.write(self.style.SUCCESS(f"{total} participações inseridas."))
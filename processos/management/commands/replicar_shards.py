@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from processos import shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Copia do 'default' para cada shard os usuários e o grafo (todas as versões) dos templates do shard. "
+        "Rodar ao criar um shard ou ao mover um template para ele em SHARDS; depois disso as escritas são "
+        "copiadas pelas próprias views (ver processos.shards)."
+    )
+
+    def handle(self, *args, **options):
+        if not shards.fragmentado():
+            self.stdout.write("Sem SHARDS: nada a replicar.")
+            return
+
+        shards.replicar_usuario()
+        templates = 0
+        for shard in shards.configuracao().values():
+            for id_template in shard.get('templates', ()):
+                shards.replicar_template(id_template)
+                templates += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Usuários e {templates} templates replicados em {len(shards.configuracao())} shards."
+        ))
@@ -0,0 +1,110 @@
+import multiprocessing
+import signal
+import threading
+import time
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+INTERVALO_LIMPEZA_SEGUNDOS = 60
+
+
+def executar_threads(num_threads, intervalo, uma_vez):
+    """
+    Executa 'num_threads' threads consumindo a fila de jobs no processo atual.
+    Cada thread usa a sua própria conexão com o banco (conexões do Django são por thread).
+    """
+    if not apps.ready:
+        django.setup()
+
+    # conexões herdadas do processo pai (fork) não podem ser reaproveitadas
+    connections.close_all()
+
+    from processos.jobs import executar_job, liberar_jobs_expirados, nome_worker, reservar_job
+
+    parar = threading.Event()
+
+    def sinal_parada(signum, frame):
+        parar.set()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, sinal_parada)
+        signal.signal(signal.SIGINT, sinal_parada)
+
+    def loop(indice):
+        worker = f"{nome_worker()}:{indice}"
+        ultima_limpeza = 0
+        try:
+            while not parar.is_set():
+                if indice == 0 and time.monotonic() - ultima_limpeza > INTERVALO_LIMPEZA_SEGUNDOS:
+                    liberar_jobs_expirados()
+                    ultima_limpeza = time.monotonic()
+
+                job = reservar_job(worker)
+                if job is None:
+                    if uma_vez:
+                        break
+                    parar.wait(intervalo)
+                    continue
+
+                executar_job(job)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=loop, args=(i,), daemon=True) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=0.5)
+
+
+class Command(BaseCommand):
+    help = "Executa o worker da fila de jobs em segundo plano (tabela 'job')."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processos', type=int, default=getattr(settings, 'JOBS_PROCESSOS', 1),
+            help="Quantidade de processos do pool de workers."
+        )
+        parser.add_argument(
+            '--threads', type=int, default=getattr(settings, 'JOBS_THREADS', 2),
+            help="Quantidade de threads por processo."
+        )
+        parser.add_argument(
+            '--intervalo', type=float, default=getattr(settings, 'JOBS_INTERVALO_SEGUNDOS', 1.0),
+            help="Segundos de espera quando a fila está vazia."
+        )
+        parser.add_argument(
+            '--uma-vez', action='store_true',
+            help="Esvazia a fila e encerra, em vez de ficar aguardando novos jobs."
+        )
+
+    def handle(self, *args, **options):
+        num_processos = max(1, options['processos'])
+        num_threads = max(1, options['threads'])
+        args_worker = (num_threads, options['intervalo'], options['uma_vez'])
+
+        self.stdout.write(f"Iniciando worker de jobs: {num_processos} processo(s) x {num_threads} thread(s).")
+
+        if num_processos == 1:
+            executar_threads(*args_worker)
+            return
+
+        connections.close_all()
+        filhos = [multiprocessing.Process(target=executar_threads, args=args_worker) for _ in range(num_processos)]
+        for filho in filhos:
+            filho.start()
+
+        try:
+            for filho in filhos:
+                filho.join()
+        except KeyboardInterrupt:
+            for filho in filhos:
+                filho.terminate()
+            for filho in filhos:
+                filho.join()
@@ -5,6 +5,9 @@ class TemplateProcesso(models.Model):
     id = models.AutoField(primary_key=True)
     nome = models.CharField(max_length=255)
     descricao = models.TextField(blank=True, null=True)
+    oculto = models.BooleanField(default=False)
+    versao = models.IntegerField(default=1)
+    id_versao_atual = models.BigIntegerField(blank=True, null=True)
 
     class Meta:
         managed = False
@@ -22,6 +25,8 @@ class Etapa(models.Model):
     nome = models.CharField(max_length=255)
     ordem = models.IntegerField()
     responsavel = models.CharField(max_length=100) 
+    prazo_horas = models.IntegerField(blank=True, null=True)
+    oculto = models.BooleanField(default=False)
 
     class Meta:
         managed = False
@@ -66,6 +71,33 @@ class Processo(models.Model):
     )
     status = models.CharField(max_length=100)
     data_inicio = models.DateTimeField(auto_now_add=True)
+    id_exec_atual = models.ForeignKey(
+        'ExecucaoEtapa',
+        on_delete=models.DO_NOTHING,
+        db_column='id_exec_atual',
+        db_constraint=False,
+        related_name='+',
+        blank=True,
+        null=True
+    )
+    id_etapa_atual = models.ForeignKey(
+        Etapa,
+        on_delete=models.DO_NOTHING,
+        db_column='id_etapa_atual',
+        db_constraint=False,
+        related_name='+',
+        blank=True,
+        null=True
+    )
+    id_usuario_atual = models.ForeignKey(
+        Usuario,
+        on_delete=models.DO_NOTHING,
+        db_column='id_usuario_atual',
+        db_constraint=False,
+        related_name='+',
+        blank=True,
+        null=True
+    )
 
     class Meta:
         managed = False
@@ -115,6 +147,7 @@ class ModeloCampo(models.Model):
     nome = models.CharField(max_length=255)
     tipo = models.CharField(max_length=100)
     obrigatorio = models.BooleanField(default=False)
+    ordem = models.IntegerField(default=0)
 
     class Meta:
         managed = False
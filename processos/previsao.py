@@ -0,0 +1,240 @@
+"""
+Previsão de conclusão dos processos abertos por simulação de Monte Carlo (job prever_conclusoes).
+
+O modelo é ajustado com o histórico de execucao_etapa:
+- transições: para cada etapa, quantas vezes cada destino de fluxo_execucao foi seguido (LEAD por processo),
+  mais PREVISAO_PESO_FLUXO para cada destino do grafo (os nunca seguidos continuam possíveis);
+  o laço da etapa para ela mesma é a conclusão do processo, como em validacaoEtapas;
+- durações: as durações observadas de cada etapa (distribuição empírica); etapas sem histórico usam
+  as durações de todas as etapas.
+
+Todos os processos abertos são simulados juntos, PREVISAO_SIMULACOES vezes cada, com arrays do NumPy:
+cada passo sorteia, ao mesmo tempo para todas as simulações ainda ativas, a próxima etapa e a sua duração.
+A primeira duração é sorteada entre as maiores que o tempo já decorrido na etapa atual.
+"""
+import datetime
+import warnings
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from . import shards
+
+# destinos especiais das transições
+FIM = -1
+SEM_SAIDA = -2
+
+PERCENTIS = (50, 80, 95)
+
+QUERY_TRANSICOES = """
+    SELECT origem, destino, COUNT(*)
+    FROM (
+        SELECT ee.id_etapa AS origem,
+            LEAD(ee.id_etapa) OVER (PARTITION BY ee.id_processo ORDER BY ee.data_inicio, ee.id) AS destino,
+            ee.status_exec, p.status_proc
+        FROM processo p
+        JOIN execucao_etapa ee ON ee.id_processo = p.id
+        WHERE p.data_inicio >= NOW() - INTERVAL %s DAY
+    ) t
+    WHERE destino IS NOT NULL OR (status_exec = 'CONCLUIDO' AND status_proc = 'CONCLUIDO')
+    GROUP BY origem, destino
+"""
+
+QUERY_DURACOES = """
+    SELECT id_etapa, TIMESTAMPDIFF(SECOND, data_inicio, data_fim)
+    FROM execucao_etapa
+    WHERE status_exec = 'CONCLUIDO' AND data_fim IS NOT NULL
+    AND data_inicio >= NOW() - INTERVAL %s DAY
+"""
+
+QUERY_ABERTOS = """
+    SELECT p.id, p.id_template, p.id_etapa_atual, GREATEST(TIMESTAMPDIFF(SECOND, ee.data_inicio, NOW()), 0)
+    FROM processo p
+    JOIN execucao_etapa ee ON ee.id = p.id_exec_atual
+    WHERE p.status_proc = 'PENDENTE'
+"""
+
+QUERY_FLUXOS = """
+    SELECT f.id_origem, f.id_destino
+    FROM fluxo_execucao f
+    JOIN etapa e ON e.id = f.id_destino
+    WHERE e.oculto = FALSE
+"""
+
+
+class Modelo:
+    """
+    Transições e durações ajustadas, em arrays indexados pela posição de cada etapa em 'indice'.
+
+    As linhas das duas tabelas ficam concatenadas (formato CSR) para que um único np.searchsorted
+    sorteie o próximo passo de todas as simulações: a chave de cada transição é a linha + a probabilidade
+    acumulada, e a de cada duração é o segmento * escala + a duração (segmentos ordenados).
+    """
+
+    def __init__(self, fluxos, transicoes, duracoes, etapas=()):
+        etapas = set(etapas) | {origem for origem, _ in fluxos} | {destino for _, destino in fluxos} | set(duracoes)
+        self.indice = {id_etapa: i for i, id_etapa in enumerate(sorted(etapas))}
+        self._ajustar_transicoes(fluxos, transicoes)
+        self._ajustar_duracoes(duracoes)
+
+    def _ajustar_transicoes(self, fluxos, transicoes):
+        peso = getattr(settings, 'PREVISAO_PESO_FLUXO', 1.0)
+        destinos_do_grafo = {}
+        for origem, destino in fluxos:
+            destinos_do_grafo.setdefault(origem, set()).add(destino)
+
+        chaves, destinos = [], []
+        for id_etapa, linha in self.indice.items():
+            candidatos = sorted(destinos_do_grafo.get(id_etapa, ()))
+            if not candidatos:
+                # beco sem saída (ou etapa removida do grafo): o processo não conclui
+                chaves.append(linha + 1.0)
+                destinos.append(SEM_SAIDA)
+                continue
+
+            pesos = np.array([transicoes.get((id_etapa, destino), 0) + peso for destino in candidatos], dtype=float)
+            acumulado = np.cumsum(pesos / pesos.sum())
+            acumulado[-1] = 1.0
+            chaves.extend(linha + acumulado)
+            destinos.extend(FIM if destino == id_etapa else self.indice[destino] for destino in candidatos)
+
+        self.chaves_transicao = np.array(chaves)
+        self.destinos = np.array(destinos, dtype=np.int64)
+
+    def _ajustar_duracoes(self, duracoes):
+        todas = np.sort(np.concatenate([np.asarray(valores, dtype=float) for valores in duracoes.values()])) \
+            if duracoes else np.zeros(1)
+
+        segmentos = [todas]
+        self.segmento = np.zeros(len(self.indice), dtype=np.int64)
+        for id_etapa, linha in self.indice.items():
+            if duracoes.get(id_etapa):
+                self.segmento[linha] = len(segmentos)
+                segmentos.append(np.sort(np.asarray(duracoes[id_etapa], dtype=float)))
+
+        tamanhos = np.array([len(segmento) for segmento in segmentos])
+        self.inicio_segmento = np.concatenate([[0], np.cumsum(tamanhos)[:-1]])
+        self.tamanho_segmento = tamanhos
+        self.duracoes = np.concatenate(segmentos)
+        self.escala = float(self.duracoes.max()) + 1.0
+        self.chaves_duracao = np.repeat(np.arange(len(segmentos)), tamanhos) * self.escala + self.duracoes
+
+    def sortear_transicoes(self, linhas, rng):
+        posicoes = np.searchsorted(self.chaves_transicao, linhas + rng.random(len(linhas)), side='right')
+        return self.destinos[posicoes]
+
+    def sortear_duracoes(self, linhas, rng):
+        segmentos = self.segmento[linhas]
+        sorteio = (rng.random(len(linhas)) * self.tamanho_segmento[segmentos]).astype(np.int64)
+        return self.duracoes[self.inicio_segmento[segmentos] + sorteio]
+
+    def sortear_restantes(self, linhas, decorrido, rng):
+        """
+        Tempo restante da etapa atual: uma duração maior que 'decorrido', menos o decorrido.
+        Se a etapa já passou de todas as durações do histórico, sorteia uma duração inteira.
+        """
+        segmentos = self.segmento[linhas]
+        fim = self.inicio_segmento[segmentos] + self.tamanho_segmento[segmentos]
+        chaves = segmentos * self.escala + np.minimum(decorrido, self.escala - 1)
+        primeiro = np.searchsorted(self.chaves_duracao, chaves, side='right')
+        disponiveis = fim - primeiro
+
+        restantes = self.sortear_duracoes(linhas, rng)
+        condicionadas = disponiveis > 0
+        sorteio = (rng.random(int(condicionadas.sum())) * disponiveis[condicionadas]).astype(np.int64)
+        restantes[condicionadas] = self.duracoes[primeiro[condicionadas] + sorteio] - decorrido[condicionadas]
+        return restantes
+
+
+def simular(modelo, linhas, decorrido, simulacoes, rng):
+    """
+    Segundos até a conclusão de cada processo em cada simulação: matriz (processos, simulações),
+    com NaN nas simulações que não concluíram (beco sem saída ou mais de PREVISAO_MAX_PASSOS etapas).
+    """
+    estado = np.repeat(linhas, simulacoes)
+    tempo = modelo.sortear_restantes(estado, np.repeat(decorrido, simulacoes), rng)
+    ativas = np.arange(len(estado))
+
+    for _ in range(getattr(settings, 'PREVISAO_MAX_PASSOS', 200)):
+        if not len(ativas):
+            break
+        proximos = modelo.sortear_transicoes(estado[ativas], rng)
+
+        tempo[ativas[proximos == SEM_SAIDA]] = np.nan
+        continuam = proximos >= 0
+        ativas, proximos = ativas[continuam], proximos[continuam]
+
+        estado[ativas] = proximos
+        tempo[ativas] += modelo.sortear_duracoes(proximos, rng)
+
+    tempo[ativas] = np.nan
+    return tempo.reshape(len(linhas), simulacoes)
+
+
+def _consultar(query, params=()):
+    def consulta(cursor):
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    return [linha for resultado in shards.em_todos(consulta) for linha in resultado]
+
+
+def ajustar_modelo(etapas=()):
+    dias = getattr(settings, 'PREVISAO_HISTORICO_DIAS', 365)
+
+    with connection.cursor() as cursor:
+        cursor.execute(QUERY_FLUXOS)
+        fluxos = cursor.fetchall()
+
+    transicoes = {}
+    for origem, destino, quantidade in _consultar(QUERY_TRANSICOES, [dias]):
+        # sem próxima execução em um processo concluído: a etapa concluiu o processo (laço origem -> origem)
+        chave = (origem, origem if destino is None else destino)
+        transicoes[chave] = transicoes.get(chave, 0) + quantidade
+
+    duracoes = {}
+    for id_etapa, segundos in _consultar(QUERY_DURACOES, [dias]):
+        duracoes.setdefault(id_etapa, []).append(segundos)
+
+    return Modelo(fluxos, transicoes, duracoes, etapas)
+
+
+def prever_conclusoes(semente=None):
+    """
+    Previsões de todos os processos abertos: lista de dicionários com as datas dos percentis
+    PERCENTIS da conclusão e a fração das simulações em que o processo conclui.
+    """
+    abertos = [linha for linha in _consultar(QUERY_ABERTOS) if linha[2] is not None]
+    modelo = ajustar_modelo({linha[2] for linha in abertos})
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT NOW()")
+        agora = cursor.fetchone()[0]
+
+    simulacoes = getattr(settings, 'PREVISAO_SIMULACOES', 500)
+    lote = max(1, getattr(settings, 'PREVISAO_LOTE_PROCESSOS', 2000))
+    rng = np.random.default_rng(semente)
+    previsoes = []
+
+    # em lotes de processos, para limitar a memória a lote * simulações posições por array
+    for inicio in range(0, len(abertos), lote):
+        parte = abertos[inicio:inicio + lote]
+        linhas = np.array([modelo.indice[linha[2]] for linha in parte], dtype=np.int64)
+        decorrido = np.array([float(linha[3]) for linha in parte])
+
+        tempos = simular(modelo, linhas, decorrido, simulacoes, rng)
+        concluidas = np.mean(~np.isnan(tempos), axis=1)
+        with warnings.catch_warnings():
+            # processos que não concluem em nenhuma simulação ficam sem percentis
+            warnings.simplefilter('ignore', RuntimeWarning)
+            percentis = np.nanpercentile(tempos, PERCENTIS, axis=1)
+
+        for i, (id_processo, id_template, id_etapa, _) in enumerate(parte):
+            previsao = {'id_processo': id_processo, 'id_template': id_template, 'id_etapa_atual': id_etapa}
+            for percentil, valores in zip(PERCENTIS, percentis):
+                segundos = valores[i]
+                previsao[f'p{percentil}'] = None if np.isnan(segundos) else agora + datetime.timedelta(seconds=float(segundos))
+            previsao['prob_conclusao'] = round(float(concluidas[i]), 4)
+            previsoes.append(previsao)
+
+    return agora, previsoes
@@ -0,0 +1,76 @@
+import random
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.utils import OperationalError
+
+from bdedica.metricas import codigo_erro_mysql, registro, registrar_erro_mysql
+
+# deadlock e lock wait timeout: a transação inteira foi (ou pode ser) desfeita e pode ser repetida
+ERROS_TRANSITORIOS = {1213, 1205}
+
+
+def erro_transitorio(erro):
+    return isinstance(erro, OperationalError) and codigo_erro_mysql(erro) in ERROS_TRANSITORIOS
+
+
+def chamar_procedure(cursor, nome, params):
+    """
+    Executa uma stored procedure registrando a sua latência e os erros do MySQL
+    nas métricas (cursor.callproc não passa pelos execute_wrappers do Django).
+    """
+    inicio = time.perf_counter()
+    try:
+        return cursor.callproc(nome, params)
+    except Exception as e:
+        registrar_erro_mysql(e)
+        raise
+    finally:
+        registro.observar('bdedica_procedure_segundos', {'procedure': nome}, time.perf_counter() - inicio)
+
+
+def prazo_retentativas():
+    """
+    Tempo, desde a primeira tentativa, depois do qual nenhuma nova tentativa começa: RETENTATIVA_PRAZO_SEGUNDOS,
+    limitado à metade da reserva de uma Idempotency-Key (IDEMPOTENCIA_ABANDONO_SEGUNDOS). Assim, enquanto uma
+    requisição ainda repete a transação, as repetições do cliente com a mesma chave recebem 409 em vez de
+    assumir a chave (ver idempotencia.ReservaChave).
+    """
+    prazo = getattr(settings, 'RETENTATIVA_PRAZO_SEGUNDOS', 10)
+    return min(prazo, getattr(settings, 'IDEMPOTENCIA_ABANDONO_SEGUNDOS', 60) / 2)
+
+
+def com_retentativa(nome, transacao, conexao=None):
+    """
+    Executa transacao() e a repete quando o MySQL retorna deadlock (1213) ou lock wait timeout (1205),
+    até RETENTATIVA_MAX_TENTATIVAS vezes, esperando um tempo aleatório entre 0 e
+    RETENTATIVA_ESPERA_BASE_SEGUNDOS * 2^(tentativa - 1) antes de cada repetição. Uma repetição que
+    começaria depois de prazo_retentativas() não é feita.
+
+    'transacao' deve ser uma transação completa (um bloco atomic ou uma procedure que faz o próprio
+    COMMIT/ROLLBACK): repeti-la só é seguro se a falha desfez tudo o que ela já tinha gravado.
+    Dentro de um atomic externo (ex.: batch transacional) o erro é repassado sem repetição;
+    'conexao' é a conexão da transação, quando não é a do 'default' (ex.: um shard).
+    """
+    conexao = conexao or connection
+    max_tentativas = max(1, getattr(settings, 'RETENTATIVA_MAX_TENTATIVAS', 3))
+    espera_base = getattr(settings, 'RETENTATIVA_ESPERA_BASE_SEGUNDOS', 0.05)
+    prazo = prazo_retentativas()
+    inicio = time.monotonic()
+
+    for tentativa in range(1, max_tentativas + 1):
+        try:
+            return transacao()
+        except OperationalError as e:
+            if not erro_transitorio(e) or conexao.in_atomic_block:
+                raise
+
+            labels = {'operacao': nome, 'codigo': str(codigo_erro_mysql(e))}
+            espera = random.uniform(0, espera_base * 2 ** (tentativa - 1))
+            if tentativa == max_tentativas or time.monotonic() - inicio + espera >= prazo:
+                registro.incrementar('bdedica_retentativas_esgotadas_total', labels)
+                raise
+
+            registro.incrementar('bdedica_retentativas_total', labels)
+            time.sleep(espera)
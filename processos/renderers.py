@@ -0,0 +1,19 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class ColunarRenderer(JSONRenderer):
+    """
+    ?format=columnar: as listas de linhas retornadas pelas views (dictfetchall) são enviadas como
+    {"colunas": [...], "linhas": [[...], ...]}, com o nome de cada coluna uma única vez.
+    Respostas que não são listas de linhas (detalhes, erros) são enviadas como no JSON comum.
+    """
+    format = 'columnar'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        colunas = getattr(data, 'colunas', None)
+        if colunas is not None:
+            data = {
+                "colunas": colunas,
+                "linhas": [[linha[coluna] for coluna in colunas] for linha in data],
+            }
+        return super().render(data, accepted_media_type, renderer_context)
@@ -0,0 +1,23 @@
+"""
+Seleção das colunas das listagens pelo parâmetro ?fields=.
+"""
+
+
+def colunas_selecionadas(request, colunas):
+    """
+    Monta a lista do SELECT com as colunas pedidas em ?fields=nome1,nome2 (todas, sem o parâmetro).
+    'colunas' mapeia o nome na resposta para a expressão SQL, na ordem padrão da resposta.
+
+    Retorna (lista do SELECT, nomes selecionados, erro); erro é uma mensagem ou None.
+    """
+    pedidos = request.query_params.get('fields')
+    if not pedidos:
+        nomes = list(colunas)
+    else:
+        nomes = list(dict.fromkeys(nome.strip() for nome in pedidos.split(',') if nome.strip()))
+        invalidos = [nome for nome in nomes if nome not in colunas]
+        if invalidos or not nomes:
+            return None, None, f"Campos inválidos em 'fields': {invalidos}. Disponíveis: {list(colunas)}."
+
+    lista = ', '.join(f"{colunas[nome]} AS `{nome}`" for nome in nomes)
+    return lista, nomes, None
@@ -1,5 +1,8 @@
 from rest_framework import serializers
 
+CARGOS = ['ORIENTADOR', 'COORDENADOR', 'JIJ']
+TIPOS_CAMPO = ['TEXTO', 'NUMERO', 'DATA', 'BOOLEANO']
+
 class TemplateProcessoSerializer(serializers.Serializer):
     """
     Valida os dados para criação e atualização de um TemplateProcesso.
@@ -30,6 +33,7 @@ class EtapaSerializer(serializers.Serializer):
     ordem = serializers.IntegerField()
     responsavel = serializers.CharField(max_length=100)
     campo_anexo = serializers.BooleanField(default=False)
+    prazo_horas = serializers.IntegerField(min_value=1, required=False, allow_null=True, default=None)
 
 
 class FluxoExecucaoSerializer(serializers.Serializer):
@@ -52,4 +56,93 @@ class ExecucaoEtapaSerializer(serializers.Serializer):
     observacoes = serializers.CharField(allow_blank=True, required=False)
     data_inicio = serializers.DateTimeField(allow_null=True, required=False)
     data_fim = serializers.DateTimeField(allow_null=True, required=False)
-    status = serializers.CharField(max_length=100)
\ No newline at end of file
+    status = serializers.CharField(max_length=100)
+
+
+class EtapaImportacaoSerializer(serializers.Serializer):
+    """
+    Etapa dentro de uma importação de template. A 'chave' é definida pelo cliente
+    e só serve para referenciar a etapa nos fluxos da mesma importação.
+    """
+    chave = serializers.CharField(max_length=100)
+    nome = serializers.CharField(max_length=100)
+    ordem = serializers.IntegerField()
+    responsavel = serializers.ChoiceField(choices=CARGOS)
+    campo_anexo = serializers.BooleanField(default=False)
+    prazo_horas = serializers.IntegerField(min_value=1, required=False, allow_null=True, default=None)
+
+
+class FluxoImportacaoSerializer(serializers.Serializer):
+    """
+    Fluxo (origem -> destino) entre chaves de etapas da mesma importação.
+    """
+    origem = serializers.CharField(max_length=100)
+    destino = serializers.CharField(max_length=100)
+
+
+class TemplateImportacaoSerializer(serializers.Serializer):
+    """
+    Valida em memória o grafo completo de um template antes de gravá-lo.
+    """
+    nome = serializers.CharField(max_length=100)
+    descricao = serializers.CharField(allow_blank=True, required=False, default='')
+    etapas = EtapaImportacaoSerializer(many=True, allow_empty=False)
+    fluxos = FluxoImportacaoSerializer(many=True, allow_empty=False)
+
+    def validate(self, data):
+        chaves = [etapa['chave'] for etapa in data['etapas']]
+        if len(chaves) != len(set(chaves)):
+            raise serializers.ValidationError({"etapas": "Existem etapas com a mesma chave."})
+
+        primeiras = [etapa['chave'] for etapa in data['etapas'] if etapa['ordem'] == 1]
+        if len(primeiras) != 1:
+            raise serializers.ValidationError({"etapas": "O template deve ter exatamente uma etapa com 'ordem = 1'."})
+
+        vizinhos = {chave: set() for chave in chaves}
+        for fluxo in data['fluxos']:
+            origem, destino = fluxo['origem'], fluxo['destino']
+            if origem not in vizinhos or destino not in vizinhos:
+                raise serializers.ValidationError({"fluxos": f"Fluxo {origem} -> {destino} referencia uma etapa inexistente."})
+            if destino in vizinhos[origem]:
+                raise serializers.ValidationError({"fluxos": f"Fluxo {origem} -> {destino} duplicado."})
+            vizinhos[origem].add(destino)
+
+        if not any(chave in destinos for chave, destinos in vizinhos.items()):
+            raise serializers.ValidationError({"fluxos": "O template deve ter uma etapa final (fluxo da etapa para ela mesma)."})
+
+        sem_saida = [chave for chave, destinos in vizinhos.items() if not destinos]
+        if sem_saida:
+            raise serializers.ValidationError({"fluxos": f"Etapas sem fluxo de saída: {', '.join(sem_saida)}."})
+
+        alcancadas = {primeiras[0]}
+        pendentes = [primeiras[0]]
+        while pendentes:
+            for destino in vizinhos[pendentes.pop()]:
+                if destino not in alcancadas:
+                    alcancadas.add(destino)
+                    pendentes.append(destino)
+
+        inalcancaveis = [chave for chave in chaves if chave not in alcancadas]
+        if inalcancaveis:
+            raise serializers.ValidationError({"fluxos": f"Etapas inalcançáveis a partir da primeira etapa: {', '.join(inalcancaveis)}."})
+
+        return data
+
+
+class ModeloCampoSerializer(serializers.Serializer):
+    """
+    Valida a definição de um campo dinâmico de uma etapa.
+    """
+    id = serializers.IntegerField(read_only=True)
+    nome = serializers.CharField(max_length=100)
+    tipo = serializers.ChoiceField(choices=TIPOS_CAMPO, default='TEXTO')
+    obrigatorio = serializers.BooleanField(default=False)
+    ordem = serializers.IntegerField(default=0)
+
+
+class CampoSerializer(serializers.Serializer):
+    """
+    Valida o valor de um campo dinâmico preenchido em uma execução de etapa.
+    """
+    id_modelo = serializers.IntegerField()
+    dados = serializers.CharField(allow_blank=True, allow_null=True)
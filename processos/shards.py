@@ -0,0 +1,266 @@
+"""
+Sharding dos dados de processo (processo, execucao_etapa, participacao_processo, campo, ...) por template.
+
+SHARDS mapeia cada alias de DATABASES (além do 'default') para o seu auto_increment_offset e para os
+templates cujos processos ele guarda (pelo id da versão original do template). Os demais templates
+ficam no 'default'. template_processo, etapa, fluxo_execucao, modelo_campo e usuario são lidos e
+gravados no 'default', e cada escrita é copiada, com os mesmos ids, para os shards que precisam das
+linhas (replicar_template, replicar_usuario): as consultas, triggers e procedures de um shard podem
+fazer join com elas. O comando replicar_shards faz a cópia inicial de um shard novo.
+
+Todas as conexões usam auto_increment_increment = SHARDS_INCREMENTO e o offset do seu alias: os ids
+gerados em shards diferentes nunca colidem e o shard de um processo ou execução sai do próprio id.
+Sem SHARDS, tudo fica no 'default' e nada disso é feito.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, connection, connections, transaction
+from django.db.backends.signals import connection_created
+
+# tabelas lidas e gravadas só no 'default' (replicadas para os shards)
+MODELOS_REPLICADOS = {'templateprocesso', 'etapa', 'fluxoexecucao', 'modelocampo', 'usuario'}
+TABELAS_REPLICADAS = {'template_processo', 'etapa', 'fluxo_execucao', 'modelo_campo', 'usuario'}
+
+# grafo de um template nas tabelas replicadas, na ordem das chaves estrangeiras:
+# (tabela, condição das linhas das versões {versoes})
+GRAFO_REPLICADO = (
+    ('template_processo', "id IN ({versoes})"),
+    ('etapa', "id_template IN ({versoes})"),
+    ('fluxo_execucao', "id_origem IN (SELECT id FROM etapa WHERE id_template IN ({versoes}))"),
+    ('modelo_campo', "id_etapa IN (SELECT id FROM etapa WHERE id_template IN ({versoes}))"),
+)
+
+# todas as versões do template de uma delas (a menor é a original, ver grafo.SUBQUERY_ORIGINAL)
+QUERY_VERSOES = """
+    SELECT v.id
+    FROM template_processo t
+    JOIN template_processo v
+        ON v.id = t.id OR v.id = t.id_versao_atual OR v.id_versao_atual = COALESCE(t.id_versao_atual, t.id)
+    WHERE t.id = %s
+"""
+
+# threads que consultam os shards em em_todos: criadas uma vez por processo e reaproveitadas,
+# cada uma com as suas conexões (mantidas entre as chamadas conforme CONN_MAX_AGE)
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def configuracao():
+    return getattr(settings, 'SHARDS', {})
+
+
+def fragmentado():
+    return bool(configuracao())
+
+
+def aliases():
+    """
+    Aliases que guardam dados de processo: 'default' primeiro, depois os shards.
+    """
+    return ['default', *configuracao()]
+
+
+def incremento():
+    return getattr(settings, 'SHARDS_INCREMENTO', 10)
+
+
+def offsets():
+    """
+    auto_increment_offset de cada alias ('default' = 1). Falha se dois aliases dividem um offset
+    ou se algum offset não cabe no incremento (os ids de shards diferentes colidiriam).
+    """
+    resultado = {'default': 1}
+    for alias, shard in configuracao().items():
+        resultado[alias] = shard['offset']
+
+    if len(set(resultado.values())) != len(resultado) or not all(1 <= o <= incremento() for o in resultado.values()):
+        raise ImproperlyConfigured(
+            f"SHARDS: os offsets devem ser distintos e estar entre 1 e SHARDS_INCREMENTO ({incremento()})."
+        )
+    return resultado
+
+
+def alias_do_template(id_template_original):
+    """
+    Alias onde ficam os processos do template (id da versão original, ver grafo.criar_versao).
+    """
+    for alias, shard in configuracao().items():
+        if int(id_template_original) in shard.get('templates', ()):
+            return alias
+    return 'default'
+
+
+def alias_do_registro(id_registro):
+    """
+    Alias de um processo ou execução pelo id (o resto da divisão pelo incremento é o offset do alias).
+    """
+    if not fragmentado():
+        return 'default'
+    offset = (int(id_registro) - 1) % incremento() + 1
+    for alias, offset_alias in offsets().items():
+        if offset_alias == offset:
+            return alias
+    return 'default'
+
+
+def conexao(alias):
+    return connection if alias == 'default' else connections[alias]
+
+
+def _copiar(alias, grafo, params):
+    """
+    Deixa as linhas de cada (tabela, condição) de 'grafo' no alias iguais às do 'default': apaga lá as que
+    não existem mais (dependentes antes) e grava as demais com INSERT ... ON DUPLICATE KEY UPDATE.
+    """
+    linhas = []
+    with connection.cursor() as cursor:
+        for tabela, condicao in grafo:
+            cursor.execute(f"SELECT * FROM {tabela} WHERE {condicao}", params)
+            linhas.append((tabela, condicao, [coluna[0] for coluna in cursor.description], cursor.fetchall()))
+
+    with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+        for tabela, condicao, _, resultado in reversed(linhas):
+            query = f"DELETE FROM {tabela} WHERE {condicao}"
+            ids = [row[0] for row in resultado]
+            if ids:
+                query += f" AND id NOT IN ({', '.join(['%s'] * len(ids))})"
+            cursor.execute(query, [*params, *ids])
+
+        for tabela, _, colunas, resultado in linhas:
+            if not resultado:
+                continue
+            atualizacao = ', '.join(f"{coluna} = VALUES({coluna})" for coluna in colunas[1:])
+            cursor.executemany(
+                f"INSERT INTO {tabela} ({', '.join(colunas)}) VALUES ({', '.join(['%s'] * len(colunas))})"
+                f" ON DUPLICATE KEY UPDATE {atualizacao}",
+                resultado
+            )
+
+
+def replicar_template(id_template):
+    """
+    Copia para o shard dos processos do template (alias_do_template) as linhas de GRAFO_REPLICADO de todas
+    as versões dele, como estão no 'default' na transação em andamento. Deve rodar depois de cada escrita
+    nessas tabelas, na mesma transação (grafo.transacao_de_edicao já chama). Sem efeito se o template
+    (qualquer versão) não existe no 'default' ou se os seus processos ficam no 'default'.
+    """
+    if not fragmentado():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(QUERY_VERSOES, [id_template])
+        versoes = sorted(row[0] for row in cursor.fetchall())
+    if not versoes or alias_do_template(versoes[0]) == 'default':
+        return
+
+    marcadores = ', '.join(['%s'] * len(versoes))
+    grafo = [(tabela, condicao.format(versoes=marcadores)) for tabela, condicao in GRAFO_REPLICADO]
+    _copiar(alias_do_template(versoes[0]), grafo, versoes)
+
+
+def replicar_usuario(id_usuario=None):
+    """
+    Copia o usuário (ou todos, sem id_usuario) do 'default' para todos os shards: as chaves estrangeiras
+    de processo e o trigger insertExecucao leem a tabela usuario no próprio shard.
+    """
+    condicao, params = ("id = %s", [id_usuario]) if id_usuario is not None else ("TRUE", [])
+    for alias in configuracao():
+        _copiar(alias, [('usuario', condicao)], params)
+
+
+def _executor_shards():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, len(configuracao())), thread_name_prefix='shards'
+            )
+        return _executor
+
+
+def _consultar_shard(alias, consulta):
+    # como o Django faz no início e no fim de cada requisição: descarta a conexão da thread
+    # se ela caiu ou passou de CONN_MAX_AGE
+    close_old_connections()
+    try:
+        with connections[alias].cursor() as cursor:
+            return consulta(cursor)
+    finally:
+        close_old_connections()
+
+
+def em_todos(consulta, incluir_default=True):
+    """
+    Executa consulta(cursor) em todos os aliases e retorna a lista de resultados, na ordem de aliases()
+    (sem o 'default' se incluir_default for False). O 'default' é consultado na thread atual (na
+    transação em andamento, se houver); com shards, cada shard é consultado ao mesmo tempo por uma
+    das threads de _executor_shards(), exceto os que estão em uma transação da thread atual (ex.: batch
+    transacional), consultados nela para que a consulta veja as escritas ainda não confirmadas.
+    """
+    if not fragmentado():
+        if not incluir_default:
+            return []
+        with connection.cursor() as cursor:
+            return [consulta(cursor)]
+
+    futuros = {
+        alias: _executor_shards().submit(_consultar_shard, alias, consulta)
+        for alias in configuracao() if not connections[alias].in_atomic_block
+    }
+    resultados = []
+    if incluir_default:
+        with connection.cursor() as cursor:
+            resultados.append(consulta(cursor))
+    for alias in configuracao():
+        if alias in futuros:
+            resultados.append(futuros[alias].result())
+        else:
+            with connections[alias].cursor() as cursor:
+                resultados.append(consulta(cursor))
+    return resultados
+
+
+class ShardRouter:
+    """
+    DATABASE_ROUTERS: leva as consultas do ORM aos dados de processo para o shard da instância
+    (pelo id ou, antes de salvar, pelo template). As tabelas replicadas ficam sempre no 'default'.
+    """
+
+    def _alias(self, model, instancia):
+        if model._meta.model_name in MODELOS_REPLICADOS or instancia is None:
+            return 'default'
+        if instancia.pk is not None:
+            return alias_do_registro(instancia.pk)
+        id_template = getattr(instancia, 'id_template_id', None)
+        return alias_do_template(id_template) if id_template is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self._alias(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self._alias(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+
+def configurar_sessao(conexao_alias):
+    """
+    Aplica à conexão o auto_increment_increment/offset do seu alias (1/1 sem shards).
+    """
+    if fragmentado():
+        valores = [incremento(), offsets()[conexao_alias.alias]]
+    else:
+        valores = [1, 1]
+    with conexao_alias.cursor() as cursor:
+        cursor.execute("SET SESSION auto_increment_increment = %s, auto_increment_offset = %s", valores)
+
+
+def _conexao_criada(sender, connection, **kwargs):
+    if connection.vendor == 'mysql' and fragmentado() and connection.alias in aliases():
+        configurar_sessao(connection)
+
+
+connection_created.connect(_conexao_criada)
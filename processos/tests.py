@@ -1,3 +1,1948 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import tempfile
+import time
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.conf import settings
+from django.db import connection, connections
+from django.db.utils import OperationalError
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.request import Request
+
+from bdedica import metricas
+from bdedica.batch import BatchSerializer
+from bdedica.perfil import perfil_pedido
+from bdedica.testes import OrcamentoTestCase, carregar_dados
+from processos import anexos, shards
+from processos.documentos import data_iso, lista_json, objeto_json
+from processos.renderers import ColunarRenderer
+from processos.selecao import colunas_selecionadas
+from processos.views import Linhas, intercalar_shards
+from processos.serializers import TemplateImportacaoSerializer
+from processos.procedures import com_retentativa, prazo_retentativas
+from processos.jobs import enfileirar_job, executar_job, liberar_jobs_expirados, registrar_job, reservar_job
+from processos.management.commands.benchmark_contencao import percentil
+from processos.previsao import FIM, SEM_SAIDA, Modelo, simular
+
+ORIENTADOR = 1
+COORDENADOR = 3
+
+
+@registrar_job('teste_eco')
+def job_eco(job):
+    return job.parametros
+
+
+@registrar_job('teste_lento')
+def job_lento(job):
+    # passa da reserva inicial sem registrar progresso
+    time.sleep(job.parametros['segundos'])
+    return {"liberados": liberar_jobs_expirados()}
+
+
+class TemplateProcessoOrcamentoTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.autenticar(COORDENADOR)
+
+    def test_list(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/templates/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 2)
+
+    def test_create(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.post('/api/processos/templates/', {"nome": "Novo", "descricao": "x"}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_retrieve(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/templates/1/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_update(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.put('/api/processos/templates/1/', {"nome": "Renomeado", "descricao": "x"}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_destroy_nao_depende_do_historico(self):
+        with self.orcamento(max_sql=3):
+            response = self.client.delete('/api/processos/templates/2/')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(self.client.get('/api/processos/templates/').data), 1)
+
+    def test_processo_completo(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/templates/1/processo-completo/')
+        self.assertEqual(response.status_code, 200)
+        documento = response.json()
+        self.assertEqual([etapa['ordem'] for etapa in documento['etapas']], [1, 2, 3, 4])
+        self.assertEqual(len(documento['fluxos']), 5)
+
+    def test_clonar_nao_depende_do_tamanho_do_grafo(self):
+        with self.orcamento(max_sql=4):
+            response = self.client.post('/api/processos/templates/1/clonar/', {}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['etapas_copiadas'], 4)
+        self.assertEqual(response.data['fluxos_copiados'], 5)
+
+    def test_importar_nao_depende_do_tamanho_do_grafo(self):
+        etapas = [
+            {"chave": f"e{i}", "nome": f"Etapa {i}", "ordem": i, "responsavel": "COORDENADOR"}
+            for i in range(1, 31)
+        ]
+        fluxos = [{"origem": f"e{i}", "destino": f"e{i + 1}"} for i in range(1, 30)]
+        fluxos.append({"origem": "e30", "destino": "e30"})
+
+        with self.orcamento(max_sql=4):
+            response = self.client.post(
+                '/api/processos/templates/importar/',
+                {"nome": "Grande", "etapas": etapas, "fluxos": fluxos},
+                format='json'
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['etapas']), 30)
+
+
+class ClonarTemplateTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.autenticar(COORDENADOR)
+
+    def grafo(self, id_template):
+        """
+        Etapas (nome, ordem, responsavel) e fluxos pelas posições das etapas, sem os ids.
+        """
+        documento = self.client.get(f'/api/processos/templates/{id_template}/processo-completo/').json()
+        etapas = sorted(documento['etapas'], key=lambda etapa: etapa['id'])
+        posicao = {etapa['id']: i for i, etapa in enumerate(etapas)}
+        return (
+            [(etapa['nome'], etapa['ordem'], etapa['responsavel']) for etapa in etapas],
+            sorted((posicao[fluxo['id_origem']], posicao[fluxo['id_destino']]) for fluxo in documento['fluxos']),
+            set(posicao),
+        )
+
+    def test_clone_tem_o_mesmo_grafo_com_etapas_novas(self):
+        response = self.client.post('/api/processos/templates/1/clonar/', {"nome": "Cópia"}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        etapas, fluxos, ids = self.grafo(1)
+        etapas_copia, fluxos_copia, ids_copia = self.grafo(response.data['id'])
+        self.assertEqual(etapas_copia, etapas)
+        self.assertEqual(fluxos_copia, fluxos)
+        self.assertFalse(ids & ids_copia)
+        self.assertEqual(self.client.get(f"/api/processos/templates/{response.data['id']}/").data['nome'], 'Cópia')
+
+    def test_clone_sem_etapas_ocultas(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE etapa SET oculto = TRUE WHERE id = 4")
+        response = self.client.post('/api/processos/templates/1/clonar/', {}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['etapas_copiadas'], 3)
+        # os fluxos de e para a etapa oculta também ficam de fora
+        self.assertEqual(response.data['fluxos_copiados'], 3)
+
+    def test_clonar_inexistente(self):
+        response = self.client.post('/api/processos/templates/999/clonar/', {}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+
+def grafo_importacao(fluxos, etapas=None):
+    if etapas is None:
+        etapas = [
+            {"chave": "a", "nome": "A", "ordem": 1, "responsavel": "ORIENTADOR"},
+            {"chave": "b", "nome": "B", "ordem": 2, "responsavel": "COORDENADOR"},
+            {"chave": "c", "nome": "C", "ordem": 3, "responsavel": "JIJ"},
+        ]
+    return {"nome": "Importado", "etapas": etapas, "fluxos": [{"origem": o, "destino": d} for o, d in fluxos]}
+
+
+class TemplateImportacaoSerializerTests(SimpleTestCase):
+    """
+    Validação do grafo em memória, antes de qualquer escrita (não precisa do banco).
+    """
+
+    def erro(self, dados):
+        serializer = TemplateImportacaoSerializer(data=dados)
+        self.assertFalse(serializer.is_valid())
+        return str(serializer.errors)
+
+    def test_grafo_valido(self):
+        serializer = TemplateImportacaoSerializer(data=grafo_importacao([("a", "b"), ("b", "c"), ("b", "a"), ("c", "c")]))
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+
+    def test_chave_repetida(self):
+        etapas = [
+            {"chave": "a", "nome": "A", "ordem": 1, "responsavel": "ORIENTADOR"},
+            {"chave": "a", "nome": "B", "ordem": 2, "responsavel": "JIJ"},
+        ]
+        self.assertIn("mesma chave", self.erro(grafo_importacao([("a", "a")], etapas)))
+
+    def test_primeira_etapa(self):
+        etapas = [
+            {"chave": "a", "nome": "A", "ordem": 1, "responsavel": "ORIENTADOR"},
+            {"chave": "b", "nome": "B", "ordem": 1, "responsavel": "JIJ"},
+        ]
+        self.assertIn("ordem = 1", self.erro(grafo_importacao([("a", "b"), ("b", "b")], etapas)))
+
+    def test_fluxo_para_etapa_inexistente(self):
+        self.assertIn("inexistente", self.erro(grafo_importacao([("a", "b"), ("b", "x"), ("c", "c")])))
+
+    def test_fluxo_duplicado(self):
+        self.assertIn("duplicado", self.erro(grafo_importacao([("a", "b"), ("a", "b"), ("b", "c"), ("c", "c")])))
+
+    def test_sem_etapa_final(self):
+        self.assertIn("etapa final", self.erro(grafo_importacao([("a", "b"), ("b", "c"), ("c", "a")])))
+
+    def test_etapa_sem_saida(self):
+        self.assertIn("sem fluxo de saída: b", self.erro(grafo_importacao([("a", "b"), ("a", "c"), ("c", "c")])))
+
+    def test_etapa_inalcancavel(self):
+        self.assertIn("inalcançáveis a partir da primeira etapa: b, c.", self.erro(grafo_importacao([("a", "a"), ("b", "b"), ("c", "b")])))
+
+    def test_cargo_invalido(self):
+        etapas = [{"chave": "a", "nome": "A", "ordem": 1, "responsavel": "DIRETOR"}]
+        self.assertIn("responsavel", self.erro(grafo_importacao([("a", "a")], etapas)))
+
+
+class ImportarTemplateTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.autenticar(COORDENADOR)
+
+    def test_fluxos_gravados_entre_as_etapas_das_chaves(self):
+        fluxos = [("a", "b"), ("b", "c"), ("b", "a"), ("c", "c")]
+        response = self.client.post('/api/processos/templates/importar/', grafo_importacao(fluxos), format='json')
+        self.assertEqual(response.status_code, 201)
+        ids = response.data['etapas']
+
+        documento = self.client.get(f"/api/processos/templates/{response.data['id']}/processo-completo/").json()
+        nomes = {etapa['id']: etapa['nome'] for etapa in documento['etapas']}
+        self.assertEqual([nomes[ids[chave]] for chave in "abc"], ["A", "B", "C"])
+        self.assertEqual(
+            sorted((fluxo['id_origem'], fluxo['id_destino']) for fluxo in documento['fluxos']),
+            sorted((ids[origem], ids[destino]) for origem, destino in fluxos)
+        )
+
+    def test_grafo_invalido_nao_grava_nada(self):
+        response = self.client.post('/api/processos/templates/importar/', grafo_importacao([("a", "b")]), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.client.get('/api/processos/templates/').data), 2)
+
+
+class EtapaOrcamentoTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.autenticar(COORDENADOR)
+
+    def test_list(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/etapas/?id_template=1')
+        self.assertEqual(response.status_code, 200)
+
+    # o template 1 já tem processos (versão publicada): as edições são feitas em uma nova versão,
+    # com um número constante de comandos (trava, verificação, cópia do grafo, mapeamento e a edição)
+
+    def test_create(self):
+        dados = {"id_template": 1, "nome": "Nova", "ordem": 5, "responsavel": "JIJ"}
+        with self.orcamento(max_sql=8):
+            response = self.client.post('/api/processos/etapas/', dados, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotEqual(response.data['id_template'], 1)
+
+    def test_create_em_rascunho(self):
+        id_template = self.client.post('/api/processos/templates/', {"nome": "Rascunho", "descricao": "x"}, format='json').data['id']
+        dados = {"id_template": id_template, "nome": "Nova", "ordem": 1, "responsavel": "JIJ"}
+        with self.orcamento(max_sql=3):
+            response = self.client.post('/api/processos/etapas/', dados, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['id_template'], id_template)
+
+    def test_retrieve(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/etapas/1/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_update(self):
+        dados = {"id_template": 1, "nome": "Renomeada", "ordem": 1, "responsavel": "ORIENTADOR"}
+        with self.orcamento(max_sql=9):
+            response = self.client.put('/api/processos/etapas/1/', dados, format='json')
+        self.assertEqual(response.status_code, 200)
+        id_versao = response.data['id_template']
+
+        # a versão publicada não muda: os processos em andamento seguem nela
+        self.assertEqual(self.client.get('/api/processos/etapas/1/').data['nome'], 'Processo criado')
+        self.assertEqual(self.client.get(f"/api/processos/etapas/{response.data['id']}/").data['nome'], 'Renomeada')
+        self.assertEqual(self.client.get('/api/processos/templates/1/').data['id_versao_atual'], id_versao)
+
+        # a versão antiga não aceita mais edições
+        response = self.client.put('/api/processos/etapas/1/', dados, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['id_versao_atual'], id_versao)
+
+        # processos novos começam na versão atual, mesmo pelo id antigo
+        self.autenticar(ORIENTADOR)
+        id_processo = self.client.post(
+            '/api/processos/exec_etapas/iniciar/', {"id_template": 1}, format='json'
+        ).data['id_processo_criado']
+        self.assertEqual(self.client.get(f'/api/processos/processos/{id_processo}/').json()['id_template'], id_versao)
+
+    def test_destroy(self):
+        with self.orcamento(max_sql=9):
+            response = self.client.delete('/api/processos/etapas/7/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/processos/etapas/7/').status_code, 200)
+
+        etapas = self.client.get(f"/api/processos/etapas/?id_template={response.data['id_template']}").data
+        self.assertEqual(len(etapas), 3)
+        self.assertNotIn('Solicita dados ao orientador', [etapa['nome'] for etapa in etapas])
+
+    def test_destroy_em_rascunho(self):
+        id_template = self.client.post('/api/processos/templates/', {"nome": "Rascunho", "descricao": "x"}, format='json').data['id']
+        dados = {"id_template": id_template, "nome": "Nova", "ordem": 1, "responsavel": "JIJ"}
+        id_etapa = self.client.post('/api/processos/etapas/', dados, format='json').data['id']
+
+        with self.orcamento(max_sql=4):
+            response = self.client.delete(f'/api/processos/etapas/{id_etapa}/')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.client.get(f'/api/processos/etapas/{id_etapa}/').status_code, 404)
+
+    def test_vincular_etapa(self):
+        with self.orcamento(max_sql=9):
+            response = self.client.post('/api/processos/etapas/1/vincular-etapa/', {"id_destino": 3}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotEqual(response.data['id_origem'], 1)
+
+    def test_vincular_etapa_de_outro_template(self):
+        response = self.client.post('/api/processos/etapas/1/vincular-etapa/', {"id_destino": 5}, format='json')
+        self.assertEqual(response.status_code, 400)
+        # a edição recusada não deixa uma nova versão para trás
+        self.assertIsNone(self.client.get('/api/processos/templates/1/').data['id_versao_atual'])
+
+    def test_update_para_outro_template(self):
+        dados = {"id_template": 2, "nome": "Movida", "ordem": 1, "responsavel": "ORIENTADOR"}
+        response = self.client.put('/api/processos/etapas/1/', dados, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(self.client.get('/api/processos/templates/1/').data['id_versao_atual'])
+
+    def test_campos(self):
+        campos = [{"nome": f"Campo {i}", "obrigatorio": i % 2 == 0, "ordem": i} for i in range(40)]
+        with self.orcamento(max_sql=9):
+            response = self.client.post('/api/processos/etapas/2/campos/', campos, format='json')
+        self.assertEqual(response.status_code, 201)
+        id_etapa = response.data['id_etapa']
+
+        with self.orcamento(max_sql=1):
+            response = self.client.get(f'/api/processos/etapas/{id_etapa}/campos/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 40)
+        self.assertEqual(len(self.client.get('/api/processos/etapas/2/campos/').data), 0)
+
+
+class FluxoExecucaoOrcamentoTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.autenticar(ORIENTADOR)
+
+    def test_list(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/fluxos/?id_template=1')
+        self.assertEqual(response.status_code, 200)
+
+    def test_retrieve(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/fluxos/1/')
+        self.assertEqual(response.status_code, 200)
+
+
+class ProcessoOrcamentoTests(OrcamentoTestCase):
+
+    def test_list_coordenador(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/processos/?status_proc=PENDENTE')
+        self.assertEqual(response.status_code, 200)
+
+    def test_list_orientador(self):
+        self.autenticar(ORIENTADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/processos/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data)
+
+    def test_list_por_etapa_atual(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/processos/?id_etapa_atual=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(processo['id'] for processo in response.data), [2, 5, 8])
+
+    def test_popular_etapa_atual(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE processo SET id_exec_atual = NULL, id_etapa_atual = NULL, id_usuario_atual = NULL")
+        call_command('popular_etapa_atual', '--lote', '4', stdout=StringIO())
+
+        self.autenticar(COORDENADOR)
+        response = self.client.get('/api/processos/processos/?id_etapa_atual=3')
+        self.assertEqual(sorted(processo['id'] for processo in response.data), [2, 5, 8])
+
+    def test_etapa_atual_acompanha_a_transicao(self):
+        self.autenticar(COORDENADOR)
+        self.client.post('/api/processos/exec_etapas/2/finalizar/', {"observacoes": "ok"}, format='json')
+
+        response = self.client.get('/api/processos/processos/?id_etapa_atual=3')
+        self.assertEqual(sorted(processo['id'] for processo in response.data), [1, 2, 5, 8])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id_exec_atual FROM processo WHERE id = 1")
+            id_exec_atual = cursor.fetchone()[0]
+            cursor.execute("SELECT MAX(id) FROM execucao_etapa WHERE id_processo = 1")
+            self.assertEqual(id_exec_atual, cursor.fetchone()[0])
+
+    def test_list_campos_selecionados_colunar(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/processos/?fields=id,etapa_atual&format=columnar')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['colunas'], ['id', 'etapa_atual'])
+        self.assertEqual(len(response.json()['linhas']), 15)
+
+    def test_retrieve(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/processos/2/')
+        self.assertEqual(response.status_code, 200)
+        historico = response.json()['historico_etapas']
+        self.assertEqual(
+            [etapa['Etapa'] for etapa in historico],
+            ['Processo criado', 'Aguarda parecer do coordenador', 'Aguarda correções no relatório']
+        )
+        self.assertEqual(historico[0]['Data_Inicio'], '2025-09-28T10:00:00')
+
+    def test_retrieve_sem_execucoes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO processo (id_template, id_usuario) VALUES (1, 1)")
+            id_processo = cursor.lastrowid
+
+        self.autenticar(COORDENADOR)
+        documento = self.client.get(f'/api/processos/processos/{id_processo}/').json()
+        self.assertEqual(documento['id'], id_processo)
+        self.assertEqual(documento['historico_etapas'], [])
+
+        self.assertEqual(self.client.get('/api/processos/processos/999/').status_code, 404)
+        self.assertEqual(self.client.get('/api/processos/processos/2/?fields=Senha').status_code, 400)
+
+    def test_retrieve_campos_selecionados(self):
+        self.autenticar(COORDENADOR)
+        response = self.client.get('/api/processos/processos/2/?fields=Etapa,Status')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()['historico_etapas'][0]), {'Etapa', 'Status'})
+
+    @override_settings(PREVISAO_SIMULACOES=200)
+    def test_previsao(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.post('/api/processos/processos/previsao/')
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(executar_job(reservar_job('teste')))
+
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/processos/previsao/')
+        self.assertEqual(response.status_code, 200)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM processo WHERE status_proc = 'PENDENTE'")
+            self.assertEqual(len(response.data), cursor.fetchone()[0])
+        for previsao in response.data:
+            if previsao['p50'] is not None:
+                self.assertLessEqual(previsao['p50'], previsao['p95'])
+
+
+class PrevisaoTests(SimpleTestCase):
+    """
+    Modelo e simulação de Monte Carlo (sem banco), com grafos cujo resultado é conhecido.
+    """
+
+    def simular(self, fluxos, duracoes, linhas, decorrido, simulacoes=50, transicoes=None, semente=0):
+        modelo = Modelo(fluxos, transicoes or {}, duracoes, {id_etapa for id_etapa, _ in linhas})
+        tempos = simular(
+            modelo,
+            np.array([modelo.indice[id_etapa] for id_etapa, _ in linhas], dtype=np.int64),
+            np.array(decorrido, dtype=float),
+            simulacoes,
+            np.random.default_rng(semente)
+        )
+        return modelo, tempos
+
+    def test_formato_e_tempos_de_um_grafo_linear(self):
+        # 1 -> 2 e o laço 2 -> 2 conclui o processo; uma duração possível por etapa
+        _, tempos = self.simular([(1, 2), (2, 2)], {1: [10], 2: [20]}, [(1, None), (2, None)], [0, 5])
+        self.assertEqual(tempos.shape, (2, 50))
+        np.testing.assert_array_equal(tempos[0], np.full(50, 30.0))
+        # na etapa 2 há 5 segundos: restam 15
+        np.testing.assert_array_equal(tempos[1], np.full(50, 15.0))
+
+    def test_sem_processos(self):
+        _, tempos = self.simular([(1, 1)], {1: [10]}, [], [], simulacoes=20)
+        self.assertEqual(tempos.shape, (0, 20))
+
+    def test_beco_sem_saida_nao_conclui(self):
+        modelo, tempos = self.simular([(1, 2)], {1: [10], 2: [20]}, [(1, None)], [0])
+        self.assertEqual(modelo.destinos[modelo.indice[2]], SEM_SAIDA)
+        self.assertTrue(np.isnan(tempos).all())
+
+    @override_settings(PREVISAO_MAX_PASSOS=5)
+    def test_ciclo_sem_fim_para_no_limite_de_passos(self):
+        _, tempos = self.simular([(1, 2), (2, 1)], {1: [10], 2: [20]}, [(1, None)], [0], simulacoes=10)
+        self.assertEqual(tempos.shape, (1, 10))
+        self.assertTrue(np.isnan(tempos).all())
+
+    def test_decorrido_alem_do_historico(self):
+        # a etapa já passou de todas as durações observadas: sorteia uma duração inteira
+        _, tempos = self.simular([(1, 1)], {1: [10]}, [(1, None)], [100])
+        np.testing.assert_array_equal(tempos, np.full((1, 50), 10.0))
+
+    @override_settings(PREVISAO_PESO_FLUXO=1.0)
+    def test_transicoes_acumuladas(self):
+        # de 1: 3 transições observadas para 2 e nenhuma para 3, mais o peso do grafo -> 4:1
+        modelo = Modelo([(1, 2), (1, 3), (2, 2), (3, 3)], {(1, 2): 3}, {1: [10]})
+        np.testing.assert_allclose(modelo.chaves_transicao, [0.8, 1.0, 2.0, 3.0])
+        self.assertEqual(modelo.destinos.tolist(), [modelo.indice[2], modelo.indice[3], FIM, FIM])
+
+    def test_misturas_e_semente(self):
+        fluxos = [(1, 2), (1, 3), (2, 2), (3, 1)]
+        duracoes = {1: [5, 10, 15], 2: [1, 2], 3: [30]}
+        _, tempos = self.simular(fluxos, duracoes, [(1, None), (3, None)], [0, 0], simulacoes=200)
+        _, repetidos = self.simular(fluxos, duracoes, [(1, None), (3, None)], [0, 0], simulacoes=200)
+        np.testing.assert_array_equal(tempos, repetidos)
+
+        # todas concluem (o laço 3 -> 1 sempre volta para uma etapa com saída para 2) e nenhum tempo é menor
+        # que o caminho mais curto: 5 + 1 a partir de 1 e 30 + 5 + 1 a partir de 3
+        self.assertFalse(np.isnan(tempos).any())
+        self.assertGreaterEqual(tempos[0].min(), 6)
+        self.assertGreaterEqual(tempos[1].min(), 36)
+
+
+class IntervaloAnexoTests(SimpleTestCase):
+    """
+    Cabeçalho Range do download de anexos (anexos.intervalo).
+    """
+
+    def test_sem_range_ou_com_varios_intervalos(self):
+        self.assertIsNone(anexos.intervalo(None, 100))
+        self.assertIsNone(anexos.intervalo('', 100))
+        self.assertIsNone(anexos.intervalo('bytes=0-9,20-29', 100))
+        self.assertIsNone(anexos.intervalo('bytes=-', 100))
+        self.assertIsNone(anexos.intervalo('itens=0-9', 100))
+
+    def test_intervalos(self):
+        self.assertEqual(anexos.intervalo('bytes=0-9', 100), (0, 9))
+        self.assertEqual(anexos.intervalo(' bytes=90- ', 100), (90, 99))
+        # o fim passa do arquivo: vai até o último byte
+        self.assertEqual(anexos.intervalo('bytes=50-500', 100), (50, 99))
+
+    def test_sufixo(self):
+        self.assertEqual(anexos.intervalo('bytes=-10', 100), (90, 99))
+        self.assertEqual(anexos.intervalo('bytes=-500', 100), (0, 99))
+        self.assertIs(anexos.intervalo('bytes=-0', 100), False)
+
+    def test_intervalos_que_nao_podem_ser_atendidos(self):
+        self.assertIs(anexos.intervalo('bytes=100-', 100), False)
+        self.assertIs(anexos.intervalo('bytes=10-5', 100), False)
+
+    def test_arquivo_vazio(self):
+        # nenhum intervalo de um arquivo vazio pode ser atendido (nem "bytes 0--1/0")
+        self.assertIs(anexos.intervalo('bytes=-10', 0), False)
+        self.assertIs(anexos.intervalo('bytes=0-', 0), False)
+        self.assertIs(anexos.intervalo('bytes=0-0', 0), False)
+        self.assertIsNone(anexos.intervalo(None, 0))
+
+
+class DocumentoTests(SimpleTestCase):
+
+    def test_objeto_json(self):
+        colunas = {'id': 'p.id', 'status': 'p.status_proc'}
+        self.assertEqual(objeto_json(colunas), "JSON_OBJECT('id', p.id, 'status', p.status_proc)")
+        self.assertEqual(objeto_json(colunas, ['status']), "JSON_OBJECT('status', p.status_proc)")
+
+    def test_lista_json(self):
+        sem_ordem = lista_json("JSON_OBJECT('id', e.id)", "FROM etapa e")
+        self.assertEqual(sem_ordem, "CAST(COALESCE((SELECT JSON_ARRAYAGG(JSON_OBJECT('id', e.id)) FROM etapa e), JSON_ARRAY()) AS JSON)")
+
+        # ordenada: janela sobre todas as linhas, e só a primeira linha é lida
+        ordenada = lista_json("JSON_OBJECT('id', e.id)", "FROM etapa e", ordem="e.ordem")
+        self.assertIn("OVER (", ordenada)
+        self.assertIn("ORDER BY e.ordem ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING", ordenada)
+        self.assertIn("LIMIT 1", ordenada)
+
+    def test_data_iso_escapa_os_parametros(self):
+        self.assertEqual(data_iso("p.data_inicio"), "DATE_FORMAT(p.data_inicio, '%%Y-%%m-%%dT%%H:%%i:%%s')")
+
+
+class SelecaoColunasTests(SimpleTestCase):
+    colunas = {'id': 'p.id', 'status': 'p.status_proc', 'etapa_atual': 'p.id_etapa_atual'}
+
+    def selecionar(self, url):
+        return colunas_selecionadas(Request(RequestFactory().get(url)), self.colunas)
+
+    def test_sem_parametro(self):
+        lista, nomes, erro = self.selecionar('/')
+        self.assertIsNone(erro)
+        self.assertEqual(nomes, ['id', 'status', 'etapa_atual'])
+        self.assertEqual(lista, "p.id AS `id`, p.status_proc AS `status`, p.id_etapa_atual AS `etapa_atual`")
+
+    def test_campos_pedidos_na_ordem_sem_repeticao(self):
+        lista, nomes, erro = self.selecionar('/?fields=etapa_atual, id,etapa_atual')
+        self.assertIsNone(erro)
+        self.assertEqual(nomes, ['etapa_atual', 'id'])
+        self.assertEqual(lista, "p.id_etapa_atual AS `etapa_atual`, p.id AS `id`")
+
+    def test_campo_invalido(self):
+        # o nome nunca chega ao SQL
+        _, _, erro = self.selecionar('/?fields=id,p.senha')
+        self.assertIn("['p.senha']", erro)
+        self.assertIsNotNone(self.selecionar('/?fields=,')[2])
+
+    def test_colunar(self):
+        linhas = Linhas([{'id': 1, 'status': 'PENDENTE'}, {'id': 2, 'status': 'CONCLUIDO'}], ['id', 'status'])
+        self.assertEqual(
+            json.loads(ColunarRenderer().render(linhas)),
+            {"colunas": ['id', 'status'], "linhas": [[1, 'PENDENTE'], [2, 'CONCLUIDO']]}
+        )
+        self.assertEqual(json.loads(ColunarRenderer().render(Linhas([], ['id']))), {"colunas": ['id'], "linhas": []})
+        # respostas que não são listas de linhas saem como no JSON comum
+        self.assertEqual(json.loads(ColunarRenderer().render({"detail": "x"})), {"detail": "x"})
+
+
+class FilaDeTarefasTests(OrcamentoTestCase):
+    """
+    Fila compartilhada do cargo: na ordem de data_inicio, as pendências de COORDENADOR são 33, 35, 2, ...
+    """
+
+    def reservar(self, id_usuario):
+        self.autenticar(id_usuario)
+        return self.client.post('/api/processos/exec_etapas/reservar/')
+
+    def test_usuarios_do_mesmo_cargo_recebem_tarefas_diferentes(self):
+        self.assertEqual(self.reservar(COORDENADOR).data['id'], 33)
+        self.assertEqual(self.reservar(4).data['id'], 35)
+
+        # a reserva é só de quem a fez
+        self.autenticar(COORDENADOR)
+        self.assertEqual(self.client.post('/api/processos/exec_etapas/35/renovar-reserva/').status_code, 409)
+        self.assertEqual(self.client.post('/api/processos/exec_etapas/35/liberar-reserva/').status_code, 404)
+        response = self.client.post('/api/processos/exec_etapas/35/finalizar/', {"observacoes": "ok"}, format='json')
+        self.assertEqual(response.status_code, 409)
+
+    def test_reserva_pula_tarefas_travadas(self):
+        outra = connections.create_connection('default')
+        try:
+            outra.set_autocommit(False)
+            with outra.cursor() as cursor:
+                cursor.execute("SELECT id FROM execucao_etapa WHERE id = 33 FOR UPDATE")
+
+            # a primeira da fila está travada por outra transação: a reserva pega a seguinte, sem esperar
+            self.assertEqual(self.reservar(COORDENADOR).data['id'], 35)
+        finally:
+            outra.rollback()
+            outra.close()
+
+    def test_reserva_expirada_volta_para_a_fila(self):
+        self.assertEqual(self.reservar(COORDENADOR).data['id'], 33)
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE execucao_etapa SET reserva_expira = NOW() - INTERVAL 1 SECOND WHERE id = 33")
+
+        self.assertEqual(self.reservar(4).data['id'], 33)
+        self.autenticar(COORDENADOR)
+        self.assertEqual(self.client.post('/api/processos/exec_etapas/33/renovar-reserva/').status_code, 409)
+
+    def test_fila_vazia(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE execucao_etapa SET status_exec = 'CONCLUIDO' WHERE id_etapa IN (2, 6)")
+        self.assertEqual(self.reservar(COORDENADOR).status_code, 204)
+
+    def test_finalizar_sem_fluxo_nao_grava_os_campos(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO modelo_campo (id_etapa, nome) VALUES (2, 'Parecer')")
+            id_modelo = cursor.lastrowid
+            # sem destinos visíveis, a etapa 2 vira um beco sem saída
+            cursor.execute("UPDATE etapa SET oculto = TRUE WHERE id IN (3, 4)")
+
+        self.autenticar(COORDENADOR)
+        response = self.client.post(
+            '/api/processos/exec_etapas/2/finalizar/',
+            {"campos": [{"id_modelo": id_modelo, "dados": "favorável"}]}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM campo WHERE id_exec_etapa = 2")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+
+class BenchmarkContencaoTests(SimpleTestCase):
+
+    def test_percentil(self):
+        valores = [0.1 * i for i in range(1, 11)]
+        self.assertEqual(percentil(valores, 50), valores[4])
+        self.assertEqual(percentil(valores, 95), valores[9])
+        self.assertEqual(percentil(valores, 100), valores[9])
+        self.assertEqual(percentil([], 99), 0.0)
+
+    def test_exige_confirmacao(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_contencao', stdout=StringIO())
+
+
+class BenchmarkContencaoCargaTests(OrcamentoTestCase):
+
+    def test_carga_curta(self):
+        saida = StringIO()
+        call_command('benchmark_contencao', '--confirmar', '--threads', '2', '--duracao', '0.5', stdout=saida)
+        relatorio = saida.getvalue()
+        self.assertIn('iniciar', relatorio)
+        self.assertIn('deadlocks:', relatorio)
+
+        # as operações do benchmark passam pelas mesmas views: os processos criados seguem o workflow
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM processo WHERE id_exec_atual IS NULL")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+
+class ParticipacaoTests(OrcamentoTestCase):
+    """
+    A listagem do orientador vem de participacao_processo: os processos em que ele executou
+    alguma etapa, do mais recente para o mais antigo.
+    """
+
+    def ids_listados(self):
+        return [processo['id'] for processo in self.client.get('/api/processos/processos/?fields=id').data]
+
+    def test_lista_do_orientador(self):
+        self.autenticar(ORIENTADOR)
+        self.assertEqual(self.ids_listados(), [5, 3, 2, 1, 9, 7])
+
+        # ao executar uma etapa do processo 4, o orientador passa a participar dele
+        response = self.client.post('/api/processos/exec_etapas/10/finalizar/', {"observacoes": "ok"}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.ids_listados(), [5, 3, 2, 1, 4, 9, 7])
+
+    def test_popular_participacao(self):
+        self.autenticar(ORIENTADOR)
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM participacao_processo")
+        self.assertEqual(self.ids_listados(), [])
+
+        call_command('popular_participacao', '--lote', '2', stdout=StringIO())
+        self.assertEqual(self.ids_listados(), [5, 3, 2, 1, 9, 7])
+
+
+class ExecucaoEtapaOrcamentoTests(OrcamentoTestCase):
+
+    def test_caixa_de_entrada(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/exec_etapas/caixa-de-entrada/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_atrasadas(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE etapa SET prazo_horas = 1 WHERE id = 2")
+        call_command('escalonar_pendencias', stdout=StringIO())
+
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/exec_etapas/atrasadas/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(2, [execucao['id_exec'] for execucao in response.data])
+
+    def test_detalhe_tarefa(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/exec_etapas/2/detalhe-tarefa/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_iniciar(self):
+        self.autenticar(ORIENTADOR)
+        with self.orcamento(max_sql=2, max_procedures=1):
+            response = self.client.post('/api/processos/exec_etapas/iniciar/', {"id_template": 1}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_iniciar_repetido_com_idempotency_key(self):
+        self.autenticar(ORIENTADOR)
+        # busca e reserva da chave, etapa inicial, id do processo criado e o resultado da chave
+        with self.orcamento(max_sql=5, max_procedures=1):
+            response = self.client.post(
+                '/api/processos/exec_etapas/iniciar/', {"id_template": 1}, format='json',
+                HTTP_IDEMPOTENCY_KEY='chave-1'
+            )
+        self.assertEqual(response.status_code, 201)
+
+        # a repetição é respondida pela chave, sem tocar nas tabelas do workflow
+        with self.orcamento(max_sql=1, max_procedures=0):
+            repetida = self.client.post(
+                '/api/processos/exec_etapas/iniciar/', {"id_template": 1}, format='json',
+                HTTP_IDEMPOTENCY_KEY='chave-1'
+            )
+        self.assertEqual(repetida.status_code, 201)
+        self.assertEqual(repetida.data, response.data)
+
+    def test_finalizar(self):
+        self.autenticar(ORIENTADOR)
+        with self.orcamento(max_sql=4, max_procedures=1):
+            response = self.client.post('/api/processos/exec_etapas/2/finalizar/', {"observacoes": "ok"}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        processo = self.client.get('/api/processos/processos/1/').json()
+        self.assertEqual(processo['id_etapa_atual'], 3)
+        self.assertEqual(processo['id_usuario_atual'], ORIENTADOR)
+
+    def test_campos(self):
+        self.autenticar(COORDENADOR)
+        # modelos direto no banco: pela API eles iriam para uma nova versão do template, não para o processo 1
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO modelo_campo (id_etapa, nome, ordem) VALUES (2, %s, %s)",
+                [[f"Campo {i}", i] for i in range(40)]
+            )
+        valores = [{"id_modelo": i, "dados": f"valor {i}"} for i in range(1, 41)]
+
+        with self.orcamento(max_sql=2):
+            response = self.client.put('/api/processos/exec_etapas/2/campos/', valores, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/exec_etapas/2/campos/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 40)
+
+    def test_fila_de_tarefas(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=3):
+            response = self.client.post('/api/processos/exec_etapas/reservar/')
+        self.assertEqual(response.status_code, 200)
+        id_exec = response.data['id']
+
+        with self.orcamento(max_sql=2):
+            response = self.client.post(f'/api/processos/exec_etapas/{id_exec}/renovar-reserva/')
+        self.assertEqual(response.status_code, 200)
+
+        with self.orcamento(max_sql=1):
+            response = self.client.post(f'/api/processos/exec_etapas/{id_exec}/liberar-reserva/')
+        self.assertEqual(response.status_code, 204)
+
+
+    def test_reatribuir(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=2):
+            response = self.client.post(
+                '/api/processos/exec_etapas/reatribuir/',
+                {"id_usuario_origem": COORDENADOR, "id_usuario_destino": 4}, format='json'
+            )
+        self.assertEqual(response.status_code, 202)
+
+        job = reservar_job('teste')
+        self.assertTrue(executar_job(job))
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM execucao_etapa WHERE id_usuario = %s AND status_exec = 'PENDENTE'", [COORDENADOR])
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute("SELECT id_usuario FROM execucao_etapa WHERE id = 2")
+            self.assertEqual(cursor.fetchone()[0], 4)
+            cursor.execute("SELECT 1 FROM participacao_processo WHERE id_usuario = 4 AND id_processo = 1")
+            self.assertIsNotNone(cursor.fetchone())
+
+    def test_reatribuir_para_outro_cargo(self):
+        self.autenticar(COORDENADOR)
+        response = self.client.post(
+            '/api/processos/exec_etapas/reatribuir/',
+            {"id_usuario_origem": COORDENADOR, "id_usuario_destino": ORIENTADOR}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(REATRIBUICAO_LOTE=2, REATRIBUICAO_PAUSA_SEGUNDOS=0)
+class ReatribuicaoTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.autenticar(COORDENADOR)
+
+    def reatribuir(self, origem, destino):
+        return self.client.post(
+            '/api/processos/exec_etapas/reatribuir/',
+            {"id_usuario_origem": origem, "id_usuario_destino": destino}, format='json'
+        )
+
+    def consultar(self, query, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_reatribuir_em_lotes(self):
+        pendentes = self.consultar(
+            "SELECT id FROM execucao_etapa WHERE id_usuario = %s AND status_exec = 'PENDENTE' ORDER BY id", [COORDENADOR]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE etapa SET prazo_horas = 1 WHERE id IN (2, 6)")
+        call_command('escalonar_pendencias', stdout=StringIO())
+        # a reserva da origem não passa para o destino
+        self.client.post('/api/processos/exec_etapas/reservar/')
+
+        id_job = self.reatribuir(COORDENADOR, 4).data['id_job']
+        self.assertTrue(executar_job(reservar_job('teste')))
+        self.assertEqual(self.client.get(f'/api/processos/jobs/{id_job}/').data['resultado'], {"reatribuidas": len(pendentes)})
+
+        self.assertEqual(self.consultar(
+            f"SELECT DISTINCT id_usuario FROM execucao_etapa WHERE id IN ({', '.join(map(str, pendentes))})"
+        ), [4])
+        self.assertEqual(self.consultar(
+            "SELECT COUNT(*) FROM execucao_etapa WHERE reservado_por = %s AND status_exec = 'PENDENTE'", [COORDENADOR]
+        ), [0])
+        self.assertEqual(self.consultar("SELECT COUNT(*) FROM escalonamento WHERE id_usuario = %s", [COORDENADOR]), [0])
+        self.assertEqual(self.consultar("SELECT COUNT(*) FROM processo WHERE id_usuario_atual = %s", [COORDENADOR]), [0])
+
+        # a origem deixa de participar dos processos em que não tem mais nenhuma execução (ex.: o processo 4,
+        # em que só tinha a pendente) e continua nos que têm execuções concluídas por ela
+        participacoes = self.consultar("SELECT id_processo FROM participacao_processo WHERE id_usuario = %s ORDER BY id_processo", [COORDENADOR])
+        self.assertEqual(participacoes, self.consultar(
+            "SELECT DISTINCT id_processo FROM execucao_etapa WHERE id_usuario = %s ORDER BY id_processo", [COORDENADOR]
+        ))
+        self.assertNotIn(4, participacoes)
+
+        # os processos reatribuídos aparecem na caixa de entrada e na lista do destino
+        self.autenticar(4)
+        caixa = [execucao['id_exec'] for execucao in self.client.get('/api/processos/exec_etapas/caixa-de-entrada/').data]
+        self.assertTrue(set(pendentes) <= set(caixa))
+
+    def test_validacoes(self):
+        self.assertEqual(self.reatribuir(COORDENADOR, COORDENADOR).status_code, 400)
+        self.assertEqual(self.reatribuir(COORDENADOR, 999).status_code, 404)
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE execucao_etapa SET status_exec = 'CONCLUIDO' WHERE id_usuario = 5")
+        # sem pendências, nada é agendado
+        self.assertEqual(self.reatribuir(5, 4).status_code, 200)
+        self.assertEqual(self.client.get('/api/processos/jobs/').data, [])
+
+
+class CamposTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.autenticar(COORDENADOR)
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO modelo_campo (id_etapa, nome, obrigatorio, ordem) VALUES (2, 'Parecer', TRUE, 1)")
+            self.parecer = cursor.lastrowid
+            cursor.execute("INSERT INTO modelo_campo (id_etapa, nome, obrigatorio, ordem) VALUES (2, 'Nota', FALSE, 2)")
+            self.nota = cursor.lastrowid
+
+    def valores(self, id_exec):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id_modelo, dados FROM campo WHERE id_exec_etapa = %s ORDER BY id_modelo", [id_exec])
+            return cursor.fetchall()
+
+    def test_obrigatorio_bloqueia_finalizar(self):
+        response = self.client.post(
+            '/api/processos/exec_etapas/2/finalizar/',
+            {"campos": [{"id_modelo": self.nota, "dados": "7"}]}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Parecer', response.data['detail'])
+        # a nota enviada junto é desfeita com a transição
+        self.assertEqual(self.valores(2), ())
+        self.assertEqual(self.client.get('/api/processos/processos/1/').json()['id_etapa_atual'], 2)
+
+        response = self.client.post(
+            '/api/processos/exec_etapas/2/finalizar/',
+            {"campos": [{"id_modelo": self.parecer, "dados": "favorável"}, {"id_modelo": self.nota, "dados": "7"}]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.valores(2), ((self.parecer, 'favorável'), (self.nota, '7')))
+
+    def test_campo_de_outra_etapa(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO modelo_campo (id_etapa, nome, ordem) VALUES (3, 'Outro', 1)")
+            id_outro = cursor.lastrowid
+
+        valores = [{"id_modelo": self.nota, "dados": "7"}, {"id_modelo": id_outro, "dados": "x"}]
+        response = self.client.put('/api/processos/exec_etapas/2/campos/', valores, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(id_outro), response.data['detail'])
+        self.assertEqual(self.valores(2), ())
+
+    def test_execucao_concluida(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO modelo_campo (id_etapa, nome, ordem) VALUES (1, 'Origem', 1)")
+            id_origem = cursor.lastrowid
+        response = self.client.put('/api/processos/exec_etapas/1/campos/', [{"id_modelo": id_origem, "dados": "x"}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.valores(1), ())
+
+    def test_upsert(self):
+        self.client.put('/api/processos/exec_etapas/2/campos/', [{"id_modelo": self.nota, "dados": "7"}], format='json')
+        self.client.put('/api/processos/exec_etapas/2/campos/', [{"id_modelo": self.nota, "dados": "9"}], format='json')
+        self.assertEqual(self.valores(2), ((self.nota, '9'),))
+
+
+class EscalonamentoTests(OrcamentoTestCase):
+
+    def escalonar(self):
+        saida = StringIO()
+        call_command('escalonar_pendencias', stdout=saida)
+        return int(saida.getvalue().split()[0])
+
+    def atrasadas(self, id_usuario):
+        self.autenticar(id_usuario)
+        return sorted(execucao['id_exec'] for execucao in self.client.get('/api/processos/exec_etapas/atrasadas/').data)
+
+    def pendentes(self, *etapas):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id, id_usuario FROM execucao_etapa WHERE status_exec = 'PENDENTE' AND id_etapa IN ({', '.join(['%s'] * len(etapas))})",
+                etapas
+            )
+            return dict(cursor.fetchall())
+
+    def test_escalonamento_incremental(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE etapa SET prazo_horas = 1 WHERE id IN (2, 3)")
+        pendentes = self.pendentes(2, 3)
+
+        self.assertEqual(self.escalonar(), len(pendentes))
+        # cada execução é lida uma única vez
+        self.assertEqual(self.escalonar(), 0)
+
+        self.assertEqual(self.atrasadas(COORDENADOR), sorted(pendentes))
+        # o orientador vê só as suas
+        self.assertEqual(self.atrasadas(ORIENTADOR), sorted(i for i, usuario in pendentes.items() if usuario == ORIENTADOR))
+
+        self.autenticar(COORDENADOR)
+        self.client.post('/api/processos/exec_etapas/2/finalizar/', {"observacoes": "ok"}, format='json')
+        self.assertNotIn(2, self.atrasadas(COORDENADOR))
+
+    def test_etapa_sem_prazo(self):
+        self.assertEqual(self.escalonar(), 0)
+        self.assertEqual(self.atrasadas(COORDENADOR), [])
+
+    def test_prazo_ainda_nao_vencido(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE etapa SET prazo_horas = 1 WHERE id = 2")
+            cursor.execute("UPDATE execucao_etapa SET data_inicio = NOW() WHERE id = 2")
+        self.escalonar()
+        self.assertNotIn(2, self.atrasadas(COORDENADOR))
+
+
+class DimensoesTests(OrcamentoTestCase):
+    campos = {'template': ('template_processo', 'nome'), 'usuario': ('usuario', 'nome')}
+
+    def preencher(self, linhas):
+        from processos.dimensoes import dimensoes
+        return dimensoes.preencher(linhas, self.campos)
+
+    def test_nomes_do_cache_sem_consultas(self):
+        with self.orcamento(max_sql=0):
+            linhas = self.preencher([{'template': 1, 'usuario': 3}, {'template': 2, 'usuario': None}])
+        self.assertIsNotNone(linhas[0]['template'])
+        self.assertIsNotNone(linhas[0]['usuario'])
+        self.assertIsNone(linhas[1]['usuario'])
+
+    def test_id_novo_e_id_inexistente(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO template_processo (nome, descricao) VALUES ('Novo', 'x')")
+            id_template = cursor.lastrowid
+
+        # uma única busca pelos ids que faltam no cache
+        with self.orcamento(max_sql=1):
+            linhas = self.preencher([{'template': id_template}, {'template': 999}])
+        self.assertEqual([linha['template'] for linha in linhas], ['Novo', None])
+
+    @override_settings(DIMENSOES_INTERVALO_SEGUNDOS=0)
+    def test_alteracao_invalida_a_tabela(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE template_processo SET nome = 'Renomeado' WHERE id = 1")
+        self.assertEqual(self.preencher([{'template': 1}])[0]['template'], 'Renomeado')
+
+    def test_alteracao_vista_so_depois_do_intervalo(self):
+        nome = self.preencher([{'template': 1}])[0]['template']
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE template_processo SET nome = 'Renomeado' WHERE id = 1")
+        # DIMENSOES_INTERVALO_SEGUNDOS = 3600 nos testes: a versão ainda não foi conferida
+        self.assertEqual(self.preencher([{'template': 1}])[0]['template'], nome)
+
+    @override_settings(DIMENSOES_INTERVALO_SEGUNDOS=0)
+    def test_ocultos_invalidados_pela_versao(self):
+        from processos.dimensoes import dimensoes
+        with self.orcamento(max_sql=1):
+            self.assertEqual(dimensoes.ocultos('template_processo'), frozenset())
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE template_processo SET oculto = TRUE WHERE id = 2")
+        self.assertEqual(dimensoes.ocultos('template_processo'), {2})
+
+    def test_listagens_sem_join_com_dimensoes(self):
+        self.autenticar(COORDENADOR)
+        with CaptureQueriesContext(connection) as consultas:
+            self.client.get('/api/processos/processos/')
+            self.client.get('/api/processos/exec_etapas/caixa-de-entrada/')
+        self.assertFalse([c['sql'] for c in consultas.captured_queries if 'template_processo' in c['sql'] or 'etapa e' in c['sql']])
+
+        # o template excluído sai das listagens na hora, no worker que o excluiu
+        self.client.delete('/api/processos/templates/2/')
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM processo WHERE id_template <> 2")
+            visiveis = {linha[0] for linha in cursor.fetchall()}
+            cursor.execute("SELECT ee.id FROM execucao_etapa ee JOIN etapa e ON e.id = ee.id_etapa WHERE e.id_template = 2")
+            execucoes_ocultas = {linha[0] for linha in cursor.fetchall()}
+        self.assertEqual({processo['id'] for processo in self.client.get('/api/processos/processos/').data}, visiveis)
+
+        for id_usuario in (ORIENTADOR, 2, COORDENADOR, 4, 5):
+            self.autenticar(id_usuario)
+            caixa = self.client.get('/api/processos/exec_etapas/caixa-de-entrada/').data
+            self.assertFalse({execucao['id_exec'] for execucao in caixa} & execucoes_ocultas)
+
+class IdempotenciaTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.autenticar(ORIENTADOR)
+
+    def iniciar(self, corpo=None, chave='chave-1'):
+        return self.client.post(
+            '/api/processos/exec_etapas/iniciar/', corpo or {"id_template": 1}, format='json',
+            HTTP_IDEMPOTENCY_KEY=chave
+        )
+
+    def processos(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM processo")
+            return cursor.fetchone()[0]
+
+    def test_repeticao_nao_cria_outro_processo(self):
+        response = self.iniciar()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.processos(), 16)
+
+        repetida = self.iniciar()
+        self.assertEqual(repetida.status_code, 201)
+        self.assertEqual(repetida['Idempotent-Replayed'], 'true')
+        self.assertEqual(repetida.data['id_processo_criado'], response.data['id_processo_criado'])
+        self.assertEqual(self.processos(), 16)
+
+    def test_chave_com_outro_corpo(self):
+        self.iniciar()
+        response = self.iniciar({"id_template": 1, "observacoes": "outro"})
+        self.assertEqual(response.status_code, 422)
+
+        # a mesma chave em outra operação
+        response = self.client.post(
+            '/api/processos/exec_etapas/2/finalizar/', {"id_template": 1}, format='json',
+            HTTP_IDEMPOTENCY_KEY='chave-1'
+        )
+        self.assertEqual(response.status_code, 422)
+
+    def test_chave_em_andamento(self):
+        self.iniciar()
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE chave_idempotencia SET status_http = NULL, resposta = NULL,
+                    reserva_expira = NOW() + INTERVAL 1 MINUTE
+            """)
+        self.assertEqual(self.iniciar().status_code, 409)
+
+    def test_reserva_vencida_e_assumida(self):
+        self.iniciar()
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE chave_idempotencia SET status_http = NULL, resposta = NULL,
+                    reserva_expira = NOW() - INTERVAL 1 SECOND
+            """)
+
+        # a requisição original não gravou o resultado (caiu no meio): a repetição executa de novo
+        response = self.iniciar()
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(self.iniciar().data, response.data)
+
+    def test_reserva_perdida_desfaz_a_operacao(self):
+        from processos.procedures import chamar_procedure
+
+        def assumir_chave(*args):
+            # outra requisição assume a chave enquanto a procedure roda (a reserva venceu)
+            outra = connections.create_connection('default')
+            try:
+                with outra.cursor() as cursor:
+                    cursor.execute("UPDATE chave_idempotencia SET token = REPEAT('x', 32)")
+            finally:
+                outra.close()
+            return chamar_procedure(*args)
+
+        with mock.patch('processos.views.chamar_procedure', side_effect=assumir_chave):
+            response = self.iniciar()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.processos(), 15)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT status_http FROM chave_idempotencia")
+            self.assertEqual(cursor.fetchone()[0], None)
+
+    def test_conflito_nao_e_guardado(self):
+        # a execução 2 está reservada por outro usuário: 409 enquanto a reserva valer
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE execucao_etapa SET reservado_por = 2, reserva_expira = NOW() + INTERVAL 1 MINUTE WHERE id = 2")
+
+        def finalizar():
+            return self.client.post(
+                '/api/processos/exec_etapas/2/finalizar/', {"observacoes": "ok"}, format='json',
+                HTTP_IDEMPOTENCY_KEY='chave-2'
+            )
+
+        self.assertEqual(finalizar().status_code, 409)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM chave_idempotencia")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+        # a reserva venceu: a repetição com a mesma chave executa a operação
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE execucao_etapa SET reserva_expira = NOW() - INTERVAL 1 SECOND WHERE id = 2")
+        response = finalizar()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response)
+
+    def test_erro_5xx_libera_a_chave(self):
+        erro = OperationalError(1213, 'Deadlock found when trying to get lock; try restarting transaction')
+        with mock.patch('processos.views.chamar_procedure', side_effect=erro):
+            self.assertEqual(self.iniciar().status_code, 503)
+        self.assertEqual(self.iniciar().status_code, 201)
+
+
+@override_settings(RETENTATIVA_MAX_TENTATIVAS=3, RETENTATIVA_ESPERA_BASE_SEGUNDOS=0)
+class RetentativaTests(SimpleTestCase):
+    conexao = mock.Mock(in_atomic_block=False)
+
+    def transacao(self, *erros):
+        """
+        Transação falsa que levanta os erros recebidos, um por chamada, e depois retorna 'ok'.
+        """
+        chamadas = []
+
+        def executar():
+            chamadas.append(1)
+            if len(chamadas) <= len(erros):
+                raise erros[len(chamadas) - 1]
+            return 'ok'
+        return executar, chamadas
+
+    def test_repete_apos_deadlock(self):
+        executar, chamadas = self.transacao(OperationalError(1213, 'Deadlock'), OperationalError(1205, 'Lock wait timeout'))
+        self.assertEqual(com_retentativa('teste', executar, self.conexao), 'ok')
+        self.assertEqual(len(chamadas), 3)
+
+    def test_tentativas_esgotadas(self):
+        executar, chamadas = self.transacao(*[OperationalError(1213, 'Deadlock')] * 3)
+        with self.assertRaises(OperationalError):
+            com_retentativa('teste', executar, self.conexao)
+        self.assertEqual(len(chamadas), 3)
+
+    def test_outros_erros_nao_sao_repetidos(self):
+        executar, chamadas = self.transacao(OperationalError(1644, 'Usuário inválido'))
+        with self.assertRaises(OperationalError):
+            com_retentativa('teste', executar, self.conexao)
+        self.assertEqual(len(chamadas), 1)
+
+    def test_dentro_de_um_atomic_externo(self):
+        executar, chamadas = self.transacao(OperationalError(1213, 'Deadlock'))
+        with self.assertRaises(OperationalError):
+            com_retentativa('teste', executar, mock.Mock(in_atomic_block=True))
+        self.assertEqual(len(chamadas), 1)
+
+    @override_settings(RETENTATIVA_PRAZO_SEGUNDOS=0)
+    def test_prazo_esgotado(self):
+        executar, chamadas = self.transacao(OperationalError(1213, 'Deadlock'))
+        with self.assertRaises(OperationalError):
+            com_retentativa('teste', executar, self.conexao)
+        self.assertEqual(len(chamadas), 1)
+
+    @override_settings(RETENTATIVA_PRAZO_SEGUNDOS=100, IDEMPOTENCIA_ABANDONO_SEGUNDOS=60)
+    def test_prazo_abaixo_da_reserva_da_chave(self):
+        self.assertEqual(prazo_retentativas(), 30)
+
+
+class JobOrcamentoTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.autenticar(COORDENADOR)
+        self.client.delete('/api/processos/templates/2/')
+
+    def test_list(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/jobs/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+
+    def test_retrieve(self):
+        id_job = self.client.get('/api/processos/jobs/').data[0]['id']
+        with self.orcamento(max_sql=1):
+            response = self.client.get(f'/api/processos/jobs/{id_job}/')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(EXCLUSAO_LOTE=3, EXCLUSAO_PAUSA_SEGUNDOS=0)
+class ExclusaoTests(OrcamentoTestCase):
+
+    def contar(self, query):
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            return cursor.fetchone()[0]
+
+    def test_excluir_template_em_lotes(self):
+        execucoes = self.contar("SELECT COUNT(*) FROM execucao_etapa WHERE id_etapa IN (5, 6, 7, 8)")
+        processos = self.contar("SELECT COUNT(*) FROM processo WHERE id_template = 2")
+
+        self.autenticar(COORDENADOR)
+        id_job = self.client.delete('/api/processos/templates/2/').data['id_job']
+        # oculto na hora, removido pelo job
+        self.assertEqual(self.client.get('/api/processos/templates/2/').status_code, 404)
+        self.assertEqual(self.contar("SELECT COUNT(*) FROM etapa WHERE id_template = 2"), 4)
+
+        self.assertTrue(executar_job(reservar_job('teste')))
+        job = self.client.get(f'/api/processos/jobs/{id_job}/').data
+        self.assertEqual(job['status_job'], 'CONCLUIDO')
+        self.assertEqual(job['resultado']['execucao_etapa'], execucoes)
+        self.assertEqual(job['resultado']['processo'], processos)
+
+        self.assertEqual(self.contar("SELECT COUNT(*) FROM etapa WHERE id_template = 2"), 0)
+        self.assertEqual(self.contar("SELECT COUNT(*) FROM template_processo WHERE id = 2"), 0)
+        # o template 1 não é afetado
+        self.assertEqual(self.contar("SELECT COUNT(*) FROM etapa WHERE id_template = 1"), 4)
+
+    def test_excluir_etapa_de_rascunho(self):
+        self.autenticar(COORDENADOR)
+        id_template = self.client.post('/api/processos/templates/', {"nome": "Rascunho", "descricao": "x"}, format='json').data['id']
+        ids = [
+            self.client.post(
+                '/api/processos/etapas/', {"id_template": id_template, "nome": f"E{i}", "ordem": i, "responsavel": "JIJ"},
+                format='json'
+            ).data['id']
+            for i in (1, 2)
+        ]
+        self.client.post(f'/api/processos/etapas/{ids[0]}/vincular-etapa/', {"id_destino": ids[1]}, format='json')
+
+        self.client.delete(f'/api/processos/etapas/{ids[1]}/')
+        self.assertTrue(executar_job(reservar_job('teste')))
+        self.assertEqual(self.contar(f"SELECT COUNT(*) FROM etapa WHERE id_template = {id_template}"), 1)
+        self.assertEqual(self.contar(f"SELECT COUNT(*) FROM fluxo_execucao WHERE id_origem = {ids[0]}"), 0)
+
+
+class JobTests(OrcamentoTestCase):
+    """
+    Fila de jobs: SKIP LOCKED, expiração e renovação da reserva e resultado gravado só pelo dono da reserva.
+    """
+
+    def status_job(self, id_job):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT status_job, worker, tentativas, resultado FROM job WHERE id = %s", [id_job])
+            return cursor.fetchone()
+
+    def expirar_reserva(self, id_job):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE job SET reserva_expira = NOW() - INTERVAL 1 SECOND WHERE id = %s", [id_job])
+
+    def test_reserva_pula_jobs_travados(self):
+        primeiro = enfileirar_job('teste_eco', {})
+        segundo = enfileirar_job('teste_eco', {})
+
+        outra = connections.create_connection('default')
+        try:
+            outra.set_autocommit(False)
+            with outra.cursor() as cursor:
+                cursor.execute("SELECT id FROM job WHERE id = %s FOR UPDATE", [primeiro])
+
+            # o primeiro está travado por outra conexão: o worker pega o segundo, sem esperar
+            job = reservar_job('worker-a')
+            self.assertEqual(job.id, segundo)
+        finally:
+            outra.rollback()
+            outra.close()
+
+        self.assertEqual(reservar_job('worker-b').id, primeiro)
+        self.assertIsNone(reservar_job('worker-c'))
+
+    def test_reserva_expirada(self):
+        id_job = enfileirar_job('teste_eco', {"valor": 1}, max_tentativas=2)
+        antigo = reservar_job('worker-a')
+        self.expirar_reserva(id_job)
+
+        self.assertEqual(liberar_jobs_expirados(), 1)
+        self.assertEqual(self.status_job(id_job)[:3], ('PENDENTE', None, 1))
+
+        novo = reservar_job('worker-b')
+        self.assertEqual(novo.id, id_job)
+
+        # o worker cuja reserva expirou não grava o resultado por cima do novo dono
+        self.assertFalse(executar_job(antigo))
+        self.assertEqual(self.status_job(id_job)[:2], ('EXECUTANDO', 'worker-b'))
+
+        # o worker morre de novo: sem tentativas restantes, o job vai para ERRO em vez de voltar à fila
+        self.expirar_reserva(id_job)
+        self.assertEqual(liberar_jobs_expirados(), 1)
+        self.assertEqual(self.status_job(id_job)[0], 'ERRO')
+        self.assertIsNone(reservar_job('worker-c'))
+
+    @override_settings(JOBS_LEASE_SEGUNDOS=2)
+    def test_reserva_renovada_durante_a_execucao(self):
+        id_job = enfileirar_job('teste_lento', {"segundos": 3})
+
+        self.assertTrue(executar_job(reservar_job('worker-a')))
+        status_job, _, tentativas, resultado = self.status_job(id_job)
+        self.assertEqual((status_job, tentativas), ('CONCLUIDO', 1))
+        self.assertEqual(json.loads(resultado), {"liberados": 0})
+
+
+class MetricasTests(SimpleTestCase):
+
+    def setUp(self):
+        self.registro = metricas.Registro()
+        patcher = mock.patch('bdedica.metricas.registro', self.registro)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_nome_sql(self):
+        self.assertEqual(metricas.nome_sql("SELECT id FROM execucao_etapa WHERE id = %s"), 'SELECT execucao_etapa')
+        self.assertEqual(metricas.nome_sql("  insert into `campo` (id) values (%s)"), 'INSERT campo')
+        self.assertEqual(metricas.nome_sql("WITH mapa AS (SELECT 1) UPDATE etapa SET nome = 'x'"), 'UPDATE etapa')
+        self.assertEqual(metricas.nome_sql("/* dica */ DELETE FROM job WHERE id = 1"), 'DELETE job')
+        self.assertEqual(metricas.nome_sql("SET SESSION auto_increment_offset = 1"), 'OUTRO')
+
+    def test_exposicao(self):
+        self.registro.observar('bdedica_sql_segundos', {'sql': 'SELECT etapa'}, 0.003)
+        self.registro.observar('bdedica_sql_segundos', {'sql': 'SELECT etapa'}, 0.2)
+        self.registro.incrementar('bdedica_mysql_erros_total', {'codigo': '1213'}, 2)
+
+        linhas = metricas.view_metricas(RequestFactory().get('/metrics')).content.decode().splitlines()
+        self.assertIn('# TYPE bdedica_sql_segundos histogram', linhas)
+        # buckets cumulativos
+        self.assertIn('bdedica_sql_segundos_bucket{sql="SELECT etapa",le="0.005"} 1', linhas)
+        self.assertIn('bdedica_sql_segundos_bucket{sql="SELECT etapa",le="0.25"} 2', linhas)
+        self.assertIn('bdedica_sql_segundos_bucket{sql="SELECT etapa",le="+Inf"} 2', linhas)
+        self.assertIn('bdedica_sql_segundos_count{sql="SELECT etapa"} 2', linhas)
+        self.assertIn('bdedica_mysql_erros_total{codigo="1213"} 2', linhas)
+
+    def test_soma_dos_processos(self):
+        with tempfile.TemporaryDirectory() as diretorio, override_settings(METRICAS_DIR=diretorio):
+            # retrato gravado por outro processo do servidor
+            outro = metricas.Registro()
+            outro.incrementar('bdedica_retentativas_total', {'operacao': 'finalizar'}, 3)
+            with open(os.path.join(diretorio, '1-0.json'), 'w') as arquivo:
+                json.dump(outro.retrato(), arquivo)
+            self.registro.incrementar('bdedica_retentativas_total', {'operacao': 'finalizar'})
+
+            resposta = metricas.view_metricas(RequestFactory().get('/metrics'))
+        self.assertIn('bdedica_retentativas_total{operacao="finalizar"} 4', resposta.content.decode().splitlines())
+
+    @override_settings(METRICAS_TOKEN='segredo')
+    def test_token(self):
+        self.assertEqual(metricas.view_metricas(RequestFactory().get('/metrics')).status_code, 403)
+        resposta = metricas.view_metricas(RequestFactory().get('/metrics', HTTP_X_METRICAS_TOKEN='segred'))
+        self.assertEqual(resposta.status_code, 403)
+        resposta = metricas.view_metricas(RequestFactory().get('/metrics', HTTP_X_METRICAS_TOKEN='segredo'))
+        self.assertEqual(resposta.status_code, 200)
+
+    def test_middleware_mede_todos_os_aliases(self):
+        conexoes = [mock.MagicMock(alias=alias) for alias in ('default', 'shard1')]
+        instalados = []
+
+        def get_response(request):
+            instalados.extend(conexao.execute_wrapper.call_args.args[0] for conexao in conexoes)
+            return mock.Mock(status_code=200)
+
+        with mock.patch('bdedica.metricas.connections') as connections_mock:
+            connections_mock.all.return_value = conexoes
+            metricas.MetricasMiddleware(get_response)(RequestFactory().get('/api/'))
+        self.assertEqual(instalados, [metricas.medir_sql, metricas.medir_sql])
+        for conexao in conexoes:
+            conexao.execute_wrapper.return_value.__exit__.assert_called_once()
+
+
+class PerfilPedidoTests(SimpleTestCase):
+
+    @override_settings(PERFIL_TOKEN='token-perfil', PERFIL_AMOSTRAGEM=0)
+    def test_token(self):
+        self.assertTrue(perfil_pedido(RequestFactory().get('/', HTTP_X_PERFIL_TOKEN='token-perfil')))
+        self.assertFalse(perfil_pedido(RequestFactory().get('/', HTTP_X_PERFIL_TOKEN='token-perfi')))
+        self.assertFalse(perfil_pedido(RequestFactory().get('/')))
+
+    @override_settings(PERFIL_TOKEN=None, PERFIL_AMOSTRAGEM=0)
+    def test_sem_token_configurado(self):
+        self.assertFalse(perfil_pedido(RequestFactory().get('/', HTTP_X_PERFIL_TOKEN='')))
+
+
+@override_settings(PERFIL_TOKEN='token-perfil')
+class PerfilTests(OrcamentoTestCase):
+
+    def test_perfil_pelo_cabecalho(self):
+        self.autenticar(COORDENADOR)
+        # o perfil grava uma linha além das consultas da view
+        with self.orcamento(max_sql=2):
+            response = self.client.get(
+                '/api/processos/templates/1/processo-completo/', HTTP_X_PERFIL_TOKEN='token-perfil'
+            )
+        self.assertEqual(response.status_code, 200)
+
+        perfil = self.client.get(f"/api/perfis/{response['X-Perfil-Id']}/")
+        self.assertEqual(perfil.status_code, 200)
+        self.assertEqual(perfil.data['nome_view'], 'TemplateProcessoViewSet.processo_completo')
+        self.assertEqual(len(perfil.data['comandos_sql']), 1)
+        self.assertIn('processo_completo', perfil.data['chamadas'])
+
+    def test_sem_cabecalho_nao_grava(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=1):
+            response = self.client.get('/api/processos/templates/1/processo-completo/')
+        self.assertNotIn('X-Perfil-Id', response)
+
+@override_settings(MUDANCAS_ATRASO_SEGUNDOS=0)
+class MudancaOrcamentoTests(OrcamentoTestCase):
+
+    def test_feed_so_traz_o_que_mudou_depois_do_cursor(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=3):
+            response = self.client.get('/api/processos/mudancas/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['processos']), 15)
+        cursor = response.data['cursor']
+
+        self.autenticar(ORIENTADOR)
+        self.client.post('/api/processos/exec_etapas/2/finalizar/', {"observacoes": "ok"}, format='json')
+
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=3):
+            response = self.client.get(f'/api/processos/mudancas/?desde={cursor}')
+        self.assertEqual([processo['id'] for processo in response.data['processos']], [1])
+        self.assertIn(2, [execucao['id'] for execucao in response.data['execucoes']])
+        self.assertFalse(response.data['mais'])
+
+    def test_paginas(self):
+        self.autenticar(COORDENADOR)
+        vistos, cursor, mais = set(), 0, True
+        while mais:
+            pagina = self.client.get(f'/api/processos/mudancas/?desde={cursor}&limite=10').data
+            self.assertGreater(pagina['cursor'], cursor)
+            vistos.update(processo['id'] for processo in pagina['processos'])
+            cursor, mais = pagina['cursor'], pagina['mais']
+        self.assertEqual(vistos, set(range(1, 16)))
+        self.assertEqual(self.client.get(f'/api/processos/mudancas/?desde={cursor}').data['processos'], [])
+
+    def test_orientador_so_ve_os_seus(self):
+        self.autenticar(ORIENTADOR)
+        processos = {processo['id'] for processo in self.client.get('/api/processos/mudancas/').data['processos']}
+        self.assertEqual(processos, {processo['id'] for processo in self.client.get('/api/processos/processos/').data})
+
+    @override_settings(MUDANCAS_ATRASO_SEGUNDOS=3600)
+    def test_mudancas_recentes_ficam_para_depois(self):
+        self.autenticar(COORDENADOR)
+        response = self.client.get('/api/processos/mudancas/?desde=0')
+        self.assertEqual(response.data['cursor'], 0)
+        self.assertEqual(response.data['processos'], [])
+
+    def test_remocoes_ao_excluir_template(self):
+        self.autenticar(ORIENTADOR)
+        cursor = self.client.get('/api/processos/mudancas/').data['cursor']
+        with connection.cursor() as cursor_bd:
+            cursor_bd.execute("SELECT id FROM processo WHERE id_template = 2 ORDER BY id")
+            processos = [linha[0] for linha in cursor_bd.fetchall()]
+
+        self.autenticar(COORDENADOR)
+        self.client.delete('/api/processos/templates/2/')
+
+        # ocultado: o orientador é avisado dos processos que saíram do feed
+        self.autenticar(ORIENTADOR)
+        pagina = self.client.get(f'/api/processos/mudancas/?desde={cursor}').data
+        self.assertEqual(pagina['processos'], [])
+        self.assertEqual(pagina['removidos']['processos'], processos)
+        self.assertTrue(pagina['removidos']['execucoes'])
+        cursor = pagina['cursor']
+
+        # excluído pelo job: as remoções chegam de novo, mesmo sem a participação (removida em cascata)
+        self.assertTrue(executar_job(reservar_job('teste')))
+        pagina = self.client.get(f'/api/processos/mudancas/?desde={cursor}').data
+        self.assertEqual(pagina['removidos']['processos'], processos)
+        self.assertEqual(self.client.get(f"/api/processos/mudancas/?desde={pagina['cursor']}").data['removidos'],
+                         {'processos': [], 'execucoes': []})
+
+    def test_parametros_invalidos(self):
+        self.autenticar(COORDENADOR)
+        self.assertEqual(self.client.get('/api/processos/mudancas/?desde=x').status_code, 400)
+        self.assertEqual(self.client.get('/api/processos/mudancas/?limite=0').status_code, 400)
+
+
+class BatchOrcamentoTests(OrcamentoTestCase):
+
+    def test_batch_soma_os_orcamentos_das_sub_requisicoes(self):
+        self.autenticar(COORDENADOR)
+        requisicoes = [
+            {"metodo": "GET", "url": "/api/processos/templates/"},
+            {"metodo": "GET", "url": "/api/processos/templates/1/processo-completo/"},
+            {"metodo": "GET", "url": "/api/processos/exec_etapas/caixa-de-entrada/"},
+            {"metodo": "GET", "url": "/api/processos/exec_etapas/2/detalhe-tarefa/"},
+        ]
+        with self.orcamento(max_sql=6):
+            response = self.client.post('/api/batch/', {"requisicoes": requisicoes}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.data['respostas']], [200, 200, 200, 200])
+
+    def test_batch_transacional_desfaz_tudo(self):
+        self.autenticar(COORDENADOR)
+        requisicoes = [
+            {"metodo": "POST", "url": "/api/processos/templates/", "corpo": {"nome": "Novo", "descricao": "x"}},
+            {"metodo": "GET", "url": "/api/processos/templates/999/"},
+        ]
+        response = self.client.post('/api/batch/', {"transacional": True, "requisicoes": requisicoes}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.client.get('/api/processos/templates/').data), 2)
+
+
+    def test_batch_nao_transacional_continua_apos_erro(self):
+        self.autenticar(COORDENADOR)
+        requisicoes = [
+            {"metodo": "GET", "url": "/api/processos/templates/999/"},
+            {"metodo": "POST", "url": "/api/processos/templates/", "corpo": {"nome": "Novo", "descricao": "x"}},
+            {"metodo": "GET", "url": "/api/inexistente/"},
+        ]
+        response = self.client.post('/api/batch/', {"requisicoes": requisicoes}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.data['respostas']], [404, 201, 404])
+        self.assertEqual(len(self.client.get('/api/processos/templates/').data), 3)
+
+    def test_batch_transacional_desfaz_iniciar(self):
+        self.autenticar(ORIENTADOR)
+        requisicoes = [
+            {"metodo": "POST", "url": "/api/processos/exec_etapas/iniciar/", "corpo": {"id_template": 1}},
+            {"metodo": "POST", "url": "/api/processos/exec_etapas/999/finalizar/", "corpo": {}},
+        ]
+        response = self.client.post('/api/batch/', {"transacional": True, "requisicoes": requisicoes}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([r['status'] for r in response.data['respostas']], [201, 404])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM processo")
+            self.assertEqual(cursor.fetchone()[0], 15)
+
+        requisicoes.pop()
+        response = self.client.post('/api/batch/', {"transacional": True, "requisicoes": requisicoes}, format='json')
+        self.assertEqual(response.status_code, 200)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM processo")
+            self.assertEqual(cursor.fetchone()[0], 16)
+
+
+class BatchSerializerTests(SimpleTestCase):
+
+    def test_url_fora_da_api(self):
+        for url in ('/admin/', '/api/batch/', '/api/batch'):
+            serializer = BatchSerializer(data={"requisicoes": [{"metodo": "GET", "url": url}]})
+            self.assertFalse(serializer.is_valid(), url)
+
+    @override_settings(BATCH_MAX_REQUISICOES=2)
+    def test_maximo_de_requisicoes(self):
+        requisicao = {"metodo": "GET", "url": "/api/processos/templates/"}
+        self.assertTrue(BatchSerializer(data={"requisicoes": [requisicao] * 2}).is_valid())
+        self.assertFalse(BatchSerializer(data={"requisicoes": [requisicao] * 3}).is_valid())
+        self.assertFalse(BatchSerializer(data={"requisicoes": []}).is_valid())
+
+
+class AnexoTests(OrcamentoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        diretorio = tempfile.TemporaryDirectory()
+        self.addCleanup(diretorio.cleanup)
+        configuracao = override_settings(ANEXOS_DIR=diretorio.name, ANEXOS_TAMANHO_BLOCO=1024)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+        self.conteudo = bytes(range(256)) * 64
+
+    def enviar(self, conteudo, **cabecalhos):
+        return self.client.post(
+            '/api/processos/anexos/', data=conteudo, content_type='application/octet-stream', **cabecalhos
+        )
+
+    def referenciar(self, referencia, id_execucao):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE execucao_etapa SET anexo = %s WHERE id = %s", [referencia, id_execucao])
+
+    def test_upload_sem_duplicatas_e_download_com_range(self):
+        self.autenticar(COORDENADOR)
+        with self.orcamento(max_sql=0):
+            response = self.enviar(self.conteudo, HTTP_X_ANEXO_SHA256=hashlib.sha256(self.conteudo).hexdigest())
+        self.assertEqual(response.status_code, 201)
+        referencia = response.data['anexo']
+        self.assertEqual(referencia, 'sha256:' + hashlib.sha256(self.conteudo).hexdigest())
+
+        repetido = self.enviar(self.conteudo)
+        self.assertEqual(repetido.status_code, 200)
+        self.assertEqual(repetido.data['anexo'], referencia)
+
+        # enquanto nenhuma execução referencia o anexo, nem o coordenador o baixa
+        url = f"/api/processos/anexos/{referencia.removeprefix('sha256:')}/"
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.referenciar(referencia, id_execucao=1)
+        with self.orcamento(max_sql=1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.conteudo)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.conteudo)}')
+        self.assertEqual(b''.join(response.streaming_content), self.conteudo[100:200])
+
+        response = self.client.get(url, HTTP_RANGE=f'bytes={len(self.conteudo)}-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_upload_chunked_sem_content_length(self):
+        self.autenticar(COORDENADOR)
+        # sem corpo nem Transfer-Encoding: o DRF não expõe o stream
+        self.assertEqual(self.enviar(b'').status_code, 400)
+
+        # como o gunicorn entrega um corpo chunked: sem CONTENT_LENGTH e já decodificado em wsgi.input
+        response = self.enviar(b'', HTTP_TRANSFER_ENCODING='chunked', **{'wsgi.input': BytesIO(self.conteudo)})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['anexo'], 'sha256:' + hashlib.sha256(self.conteudo).hexdigest())
+        self.assertEqual(response.data['tamanho'], len(self.conteudo))
+
+    def test_download_so_para_quem_ve_o_processo(self):
+        self.autenticar(COORDENADOR)
+        referencia = self.enviar(self.conteudo).data['anexo']
+        # execução 1: processo 1, com participação dos usuários 1 (orientador) e 3 (coordenador)
+        self.referenciar(referencia, id_execucao=1)
+        url = f"/api/processos/anexos/{referencia.removeprefix('sha256:')}/"
+
+        for id_usuario, esperado in [(ORIENTADOR, 200), (2, 404), (4, 200), (5, 200)]:
+            self.autenticar(id_usuario)
+            with self.orcamento(max_sql=1):
+                response = self.client.get(url, HTTP_RANGE='bytes=0-9')
+            self.assertEqual(response.status_code, 206 if esperado == 200 else 404, id_usuario)
+
+    def test_hash_divergente(self):
+        self.autenticar(COORDENADOR)
+        response = self.enviar(self.conteudo, HTTP_X_ANEXO_SHA256='0' * 64)
+        self.assertEqual(response.status_code, 400)
+
+    def test_finalizar_com_referencia(self):
+        # uma referência "sha256:" só é aceita se aponta para um arquivo enviado
+        self.autenticar(ORIENTADOR)
+        response = self.client.post(
+            '/api/processos/exec_etapas/2/finalizar/', {"anexo": "sha256:" + "1" * 64}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+        referencia = self.enviar(self.conteudo).data['anexo']
+        with self.orcamento(max_sql=4, max_procedures=1):
+            response = self.client.post('/api/processos/exec_etapas/2/finalizar/', {"anexo": referencia}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+SHARDS_LOCAIS = getattr(settings, 'SHARDS', {})
+
+
+@skipUnless(SHARDS_LOCAIS, "Precisa de SHARDS e de uma segunda instância do MySQL em DATABASES (ver DOC.md).")
+@override_settings(SHARDS=SHARDS_LOCAIS)
+class ShardTests(OrcamentoTestCase):
+    """
+    Com um template em um shard: iniciar grava no shard, a listagem junta os shards por data_inicio,
+    retrieve/finalizar encontram o processo pelo id e as edições do template e os usuários novos são
+    copiados para o shard.
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        super().setUp()
+        self.alias, shard = next(iter(SHARDS_LOCAIS.items()))
+        self.id_template = shard['templates'][0]
+
+        # no shard, só as tabelas replicadas (templates, etapas, usuários): sem os processos dos dados de teste
+        carregar_dados(connections[self.alias])
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute("DELETE FROM processo")
+        for alias in shards.aliases():
+            shards.configurar_sessao(connections[alias])
+
+    def iniciar(self):
+        """
+        Inicia um processo do template do shard; retorna (id do processo, id da execução atual, responsável).
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT MIN(u.id) FROM usuario u
+                JOIN etapa e ON e.responsavel = u.cargo
+                WHERE e.id_template = %s AND e.ordem = 1
+            """, [self.id_template])
+            id_usuario = cursor.fetchone()[0]
+        self.autenticar(id_usuario)
+
+        response = self.client.post('/api/processos/exec_etapas/iniciar/', {"id_template": self.id_template}, format='json')
+        self.assertEqual(response.status_code, 201)
+        id_processo = response.data['id_processo_criado']
+        self.assertEqual(shards.alias_do_registro(id_processo), self.alias)
+
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute("SELECT id_exec_atual, id_usuario_atual FROM processo WHERE id = %s", [id_processo])
+            id_exec, id_responsavel = cursor.fetchone()
+        return id_processo, id_exec, id_responsavel
+
+    def test_processo_no_shard_do_template(self):
+        id_processo, id_exec, _ = self.iniciar()
+
+        self.autenticar(COORDENADOR)
+        processos = self.client.get('/api/processos/processos/').data
+        self.assertEqual(processos[0]['id'], id_processo)
+        self.assertEqual(len(processos), 16)
+        self.assertEqual(
+            [processo['data_inicio'] for processo in processos],
+            sorted((processo['data_inicio'] for processo in processos), reverse=True)
+        )
+
+        self.assertEqual(self.client.get(f'/api/processos/processos/{id_processo}/').status_code, 200)
+
+        # a primeira transição dos dois templates dos dados de teste vai para uma etapa do coordenador
+        response = self.client.post(f'/api/processos/exec_etapas/{id_exec}/finalizar/', {"observacoes": "ok"}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_rotas_de_execucao_no_shard(self):
+        self.autenticar(COORDENADOR)
+        # os processos dos dados de teste ficaram no 'default': no shard, o template ainda não tem processos
+        self.assertFalse(self.client.get(f'/api/processos/templates/{self.id_template}/').data['publicado'])
+
+        id_processo, id_exec, id_responsavel = self.iniciar()
+        self.autenticar(id_responsavel)
+        caixa = self.client.get('/api/processos/exec_etapas/caixa-de-entrada/').data
+        self.assertIn(id_exec, [execucao['id_exec'] for execucao in caixa])
+        self.assertEqual(self.client.get(f'/api/processos/exec_etapas/{id_exec}/detalhe-tarefa/').data['id'], id_exec)
+        self.assertEqual(self.client.get(f'/api/processos/exec_etapas/{id_exec}/campos/').status_code, 200)
+
+        self.autenticar(COORDENADOR)
+        self.assertTrue(self.client.get(f'/api/processos/templates/{self.id_template}/').data['publicado'])
+
+        with override_settings(MUDANCAS_ATRASO_SEGUNDOS=0):
+            feed = self.client.get('/api/processos/mudancas/').data
+            self.assertEqual(len(feed['cursor'].split('.')), len(shards.aliases()))
+            self.assertIn(id_processo, [processo['id'] for processo in feed['processos']])
+            # o cursor devolvido não repete o que já foi entregue
+            seguinte = self.client.get(f"/api/processos/mudancas/?desde={feed['cursor']}").data
+            self.assertNotIn(id_processo, [processo['id'] for processo in seguinte['processos']])
+
+    def test_escritas_replicadas_no_shard(self):
+        self.iniciar()
+        self.autenticar(COORDENADOR)
+        dados = {"id_template": self.id_template, "nome": "Nova", "ordem": 9, "responsavel": "JIJ"}
+        response = self.client.post('/api/processos/etapas/', dados, format='json')
+        self.assertEqual(response.status_code, 201)
+        id_versao, id_etapa = response.data['id_template'], response.data['id']
+
+        def grafo(alias):
+            with connections[alias].cursor() as cursor:
+                cursor.execute("""
+                    SELECT tp.id, tp.id_versao_atual, e.id, e.nome, e.oculto,
+                        (SELECT COUNT(*) FROM fluxo_execucao f WHERE f.id_origem = e.id)
+                    FROM template_processo tp
+                    LEFT JOIN etapa e ON e.id_template = tp.id
+                    WHERE tp.id IN (%s, %s)
+                    ORDER BY tp.id, e.id
+                """, [self.id_template, id_versao])
+                return cursor.fetchall()
+
+        # a nova versão (cópia do grafo + etapa nova) chega ao shard com os mesmos ids
+        self.assertIn(id_etapa, [linha[2] for linha in grafo(self.alias)])
+        self.assertEqual(grafo(self.alias), grafo('default'))
+
+        # a nova versão é um rascunho: a etapa é ocultada também no shard
+        self.assertEqual(self.client.delete(f'/api/processos/etapas/{id_etapa}/').status_code, 202)
+        self.assertEqual(grafo(self.alias), grafo('default'))
+
+        dados = {"username": "novo_jij", "nome": "Novo", "cargo": "JIJ", "password": "senha_segura_456", "password2": "senha_segura_456"}
+        self.assertEqual(self.client.post('/api/criar/', dados, format='json').status_code, 201)
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute("SELECT cargo FROM usuario WHERE username = %s", ['novo_jij'])
+            self.assertEqual(cursor.fetchone(), ('JIJ',))
+
+    def test_batch_transacional_desfaz_escrita_no_shard(self):
+        id_processo, id_exec, id_responsavel = self.iniciar()
+        self.autenticar(id_responsavel)
+        requisicoes = [
+            {"metodo": "POST", "url": f"/api/processos/exec_etapas/{id_exec}/finalizar/", "corpo": {"observacoes": "ok"}},
+            {"metodo": "GET", "url": "/api/processos/templates/999/"},
+        ]
+        response = self.client.post('/api/batch/', {"transacional": True, "requisicoes": requisicoes}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['respostas'][0]['status'], 200)
+
+        # a finalização, gravada no shard, foi desfeita com o batch
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute("SELECT status_exec FROM execucao_etapa WHERE id = %s", [id_exec])
+            self.assertEqual(cursor.fetchone()[0], 'PENDENTE')
+            cursor.execute("SELECT COUNT(*) FROM execucao_etapa WHERE id_processo = %s", [id_processo])
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+@override_settings(SHARDS={'shard1': {'offset': 2, 'templates': [1]}, 'shard2': {'offset': 3, 'templates': [5, 7]}})
+class RoteamentoShardsTests(SimpleTestCase):
+    """
+    Cálculo do alias (sem banco): pelo id do registro (offset) e pelo template.
+    """
+
+    def test_alias_do_registro(self):
+        self.assertEqual(shards.offsets(), {'default': 1, 'shard1': 2, 'shard2': 3})
+        self.assertEqual(
+            [shards.alias_do_registro(id_registro) for id_registro in (1, 2, 3, 11, 12, 23, '32')],
+            ['default', 'shard1', 'shard2', 'default', 'shard1', 'shard2', 'shard1']
+        )
+
+    def test_alias_do_template(self):
+        self.assertEqual(shards.alias_do_template(1), 'shard1')
+        self.assertEqual(shards.alias_do_template('7'), 'shard2')
+        self.assertEqual(shards.alias_do_template(2), 'default')
+
+    def test_offsets_invalidos(self):
+        for configuracao in ({'shard1': {'offset': 1}}, {'shard1': {'offset': 11}}):
+            with override_settings(SHARDS=configuracao), self.assertRaises(ImproperlyConfigured):
+                shards.offsets()
+
+    @override_settings(SHARDS={})
+    def test_sem_shards(self):
+        self.assertEqual(shards.aliases(), ['default'])
+        self.assertEqual(shards.alias_do_registro(2), 'default')
+        self.assertEqual(shards.em_todos(lambda cursor: None, incluir_default=False), [])
+
+    def test_em_todos_na_ordem_dos_aliases(self):
+        conexoes = {alias: mock.MagicMock(in_atomic_block=False) for alias in ('shard1', 'shard2')}
+        with mock.patch('processos.shards.connections', conexoes), \
+                mock.patch('processos.shards._consultar_shard', side_effect=lambda alias, consulta: consulta(alias)):
+            self.assertEqual(shards.em_todos(str.upper, incluir_default=False), ['SHARD1', 'SHARD2'])
+
+    def test_em_todos_consulta_na_thread_o_shard_em_transacao(self):
+        # shard1 está em uma transação desta thread (batch transacional): não vai para o pool
+        conexoes = {'shard1': mock.MagicMock(in_atomic_block=True), 'shard2': mock.MagicMock(in_atomic_block=False)}
+        conexoes['shard1'].cursor.return_value.__enter__.return_value = 'shard1'
+        with mock.patch('processos.shards.connections', conexoes), \
+                mock.patch('processos.shards._consultar_shard', side_effect=lambda alias, consulta: consulta('pool-' + alias)):
+            self.assertEqual(shards.em_todos(str.upper, incluir_default=False), ['SHARD1', 'POOL-SHARD2'])
+
+    def test_intercalar_shards(self):
+        resultados = [
+            Linhas([{'id': 1, 'ordem_shard': 1}, {'id': 2, 'ordem_shard': 4}], ['id', 'ordem_shard']),
+            Linhas([{'id': 3, 'ordem_shard': 2}, {'id': 4, 'ordem_shard': 3}], ['id', 'ordem_shard']),
+        ]
+        linhas = intercalar_shards(resultados, 'ordem_shard', decrescente=False)
+        self.assertEqual(linhas, [{'id': 1}, {'id': 3}, {'id': 4}, {'id': 2}])
+        self.assertEqual(linhas.colunas, ['id'])
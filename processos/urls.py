@@ -8,6 +8,9 @@ router.register(r'etapas', EtapaViewSet, basename='etapa')
 router.register(r'fluxos', FluxoExecucaoViewSet, basename='fluxoexecucao')
 router.register(r'processos', ProcessoViewSet, basename='processo')
 router.register(r'exec_etapas', ExecucaoEtapaViewSet, basename='execucaoetapa')
+router.register(r'jobs', JobViewSet, basename='job')
+router.register(r'mudancas', MudancaViewSet, basename='mudanca')
+router.register(r'anexos', AnexoViewSet, basename='anexo')
 
 urlpatterns = [
     path('', include(router.urls)),
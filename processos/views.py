@@ -1,22 +1,120 @@
+import heapq
+import json
+import os
+
+from django.conf import settings
 from django.db import connection, IntegrityError, transaction
 from django.db.utils import OperationalError
+from django.http import FileResponse, HttpResponse
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import action
 
 from .serializers import *
+from .jobs import enfileirar_job
+from .grafo import (
+    SUBQUERY_ORIGINAL, copiar_grafo, transacao_de_edicao, versao_para_edicao, mapear_etapas, VersaoSubstituida
+)
+from . import idempotencia
+from .campos import salvar_campos, campos_obrigatorios_pendentes
+from .procedures import chamar_procedure, com_retentativa, erro_transitorio
+from .selecao import colunas_selecionadas
+from .documentos import data_iso, objeto_json, lista_json, resposta_documento
+from .dimensoes import dimensoes
+from . import shards
+from . import anexos
 from usuarios.permissions import IsCoordenador
 
+class Linhas(list):
+    """
+    Lista de linhas (dicionários) que guarda também os nomes das colunas,
+    usados pelo ColunarRenderer (?format=columnar) mesmo quando a lista está vazia.
+    """
+
+    def __init__(self, linhas, colunas):
+        super().__init__(linhas)
+        self.colunas = colunas
+
+
 def dictfetchall(cursor):
     """
     Retorna todos os resultados de um cursor como uma lista de dicionários.
     """
     columns = [col[0] for col in cursor.description]
-    return [
-        dict(zip(columns, row))
-        for row in cursor.fetchall()
-    ]
+    return Linhas(
+        (dict(zip(columns, row)) for row in cursor.fetchall()),
+        columns
+    )
+
+
+# o processo é criado na versão atual do template e fica nela até o fim;
+# a versão original (menor id da família) define o shard dos processos do template
+QUERY_PRIMEIRA_ETAPA = """
+    SELECT e.id, e.id_template,
+        (SELECT MIN(v.id) FROM template_processo v
+         WHERE v.id = e.id_template OR v.id_versao_atual = e.id_template) AS id_original
+    FROM template_processo tp
+    JOIN etapa e ON e.id_template = COALESCE(tp.id_versao_atual, tp.id)
+    WHERE tp.id = %s AND e.ordem = 1 AND e.oculto = FALSE;
+"""
+
+
+def alias_do_iniciar(request, **kwargs):
+    """
+    Alias onde iniciar cria o processo (e guarda a Idempotency-Key). Só consulta o template com shards.
+    """
+    if not shards.fragmentado():
+        return 'default'
+    with connection.cursor() as cursor:
+        cursor.execute(QUERY_PRIMEIRA_ETAPA, [request.data.get('id_template')])
+        etapa_result = cursor.fetchone()
+    return shards.alias_do_template(etapa_result[2]) if etapa_result else 'default'
+
+
+def alias_da_execucao(request, pk=None, **kwargs):
+    return shards.alias_do_registro(pk)
+
+
+def expressao_publicado(id_template):
+    """
+    Expressão SQL da coluna 'publicado' (a versão já tem processos) do template 'tp'. Com shards, os processos
+    ficam no alias da versão original: a existência é verificada lá e entra na consulta como constante.
+    """
+    if not shards.fragmentado():
+        return "EXISTS(SELECT 1 FROM processo p WHERE p.id_template = tp.id)"
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {SUBQUERY_ORIGINAL} FROM template_processo tp WHERE tp.id = %s", [id_template])
+        linha = cursor.fetchone()
+    if linha is None:
+        return "FALSE"
+
+    with shards.conexao(shards.alias_do_template(linha[0])).cursor() as cursor:
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM processo WHERE id_template = %s)", [id_template])
+        return "TRUE" if cursor.fetchone()[0] else "FALSE"
+
+
+def concatenar_shards(resultados):
+    """
+    Junta as listas devolvidas por cada alias em shards.em_todos, quando a ordem não importa.
+    """
+    if len(resultados) == 1:
+        return resultados[0]
+    return Linhas((linha for resultado in resultados for linha in resultado), resultados[0].colunas)
+
+
+def intercalar_shards(resultados, coluna_ordem, decrescente=True):
+    """
+    Junta as listas (já ordenadas por 'coluna_ordem', de forma decrescente ou crescente) devolvidas por
+    cada shard em shards.em_todos, removendo a coluna de ordenação. Sem shards, devolve a única lista.
+    """
+    if len(resultados) == 1:
+        return resultados[0]
+    linhas = list(heapq.merge(*resultados, key=lambda linha: linha[coluna_ordem], reverse=decrescente))
+    for linha in linhas:
+        del linha[coluna_ordem]
+    return Linhas(linhas, [coluna for coluna in resultados[0].colunas if coluna != coluna_ordem])
 
 
 class TemplateProcessoViewSet(viewsets.ViewSet):
@@ -26,14 +124,21 @@ class TemplateProcessoViewSet(viewsets.ViewSet):
     """
     
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update', 'destroy', 'processo_completo']:
+        if self.action in ['create', 'update', 'partial_update', 'destroy', 'processo_completo', 'clonar', 'importar']:
             self.permission_classes = [IsAuthenticated, IsCoordenador]
         else: # list, retrieve
             self.permission_classes = [IsAuthenticated]
         return super().get_permissions()
 
+    colunas_lista = {'id': 'id', 'nome': 'nome', 'descricao': 'descricao', 'versao': 'versao'}
+
     def list(self, request):
-        query = "SELECT id, nome, descricao FROM template_processo"
+        selecao, _, erro = colunas_selecionadas(request, self.colunas_lista)
+        if erro:
+            return Response({"detail": erro}, status=status.HTTP_400_BAD_REQUEST)
+
+        # apenas a versão atual de cada template; as anteriores seguem acessíveis pelo id
+        query = f"SELECT {selecao} FROM template_processo WHERE oculto = FALSE AND id_versao_atual IS NULL"
         try:
             with connection.cursor() as cursor:
                 cursor.execute(query)
@@ -51,17 +156,26 @@ class TemplateProcessoViewSet(viewsets.ViewSet):
         query = "INSERT INTO template_processo (nome, descricao) VALUES (%s, %s)"
         
         try:
-            with connection.cursor() as cursor:
+            with transaction.atomic(), connection.cursor() as cursor:
                 cursor.execute(query, [data['nome'], data.get('descricao')])
                 new_id = cursor.lastrowid
+                shards.replicar_template(new_id)
             
             return Response({"id": new_id, **data}, status=status.HTTP_201_CREATED)
         except (OperationalError, IntegrityError) as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_400_BAD_REQUEST)
 
+    # publicado: a versão já tem processos e o seu grafo não muda mais (ver grafo.versao_para_edicao)
+    query_template = """
+        SELECT tp.id, tp.nome, tp.descricao, tp.versao, tp.id_versao_atual,
+            {publicado} AS publicado
+        FROM template_processo tp
+        WHERE tp.id = %s AND tp.oculto = FALSE
+    """
+
     def retrieve(self, request, pk=None):
-        query = "SELECT id, nome, descricao FROM template_processo WHERE id = %s"
         try:
+            query = self.query_template.format(publicado=expressao_publicado(pk))
             with connection.cursor() as cursor:
                 cursor.execute(query, [pk])
                 template = dictfetchall(cursor)
@@ -79,13 +193,18 @@ class TemplateProcessoViewSet(viewsets.ViewSet):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         data = serializer.validated_data
-        query = "UPDATE template_processo SET nome = %s, descricao = %s WHERE id = %s"
+        # nome e descrição valem para todas as versões do template (não fazem parte do grafo)
+        query = """
+            UPDATE template_processo SET nome = %s, descricao = %s
+            WHERE oculto = FALSE AND ((id = %s AND id_versao_atual IS NULL) OR id_versao_atual = %s)
+        """
 
         try:
-            with connection.cursor() as cursor:
-                cursor.execute(query, [data['nome'], data.get('descricao'), pk])
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(query, [data['nome'], data.get('descricao'), pk, pk])
                 if cursor.rowcount == 0:
                     return Response({"detail": "Template não encontrado."}, status=status.HTTP_404_NOT_FOUND)
+                shards.replicar_template(pk)
             
             return Response({"id": pk, **data}, status=status.HTTP_200_OK)
         except (OperationalError, IntegrityError) as e:
@@ -93,78 +212,230 @@ class TemplateProcessoViewSet(viewsets.ViewSet):
 
     def destroy(self, request, pk=None):
         """
-        Deleta um template.
-        ON DELETE CASCADE (no SQL) cuidará da limpeza das etapas/fluxos.
+        Deleta um template (pela versão atual), com todas as suas versões.
+        O template e as suas etapas são ocultados na hora e a remoção das linhas (etapas, fluxos,
+        processos e execuções) é feita em lotes pelo job 'excluir_template' (worker_jobs).
         """
-        query = "DELETE FROM template_processo WHERE id = %s"
-        
+        query_template = """
+            UPDATE template_processo SET oculto = TRUE
+            WHERE oculto = FALSE AND ((id = %s AND id_versao_atual IS NULL) OR id_versao_atual = %s)
+        """
+        query_etapas = """
+            UPDATE etapa e
+            JOIN template_processo tp ON tp.id = e.id_template
+            SET e.oculto = TRUE
+            WHERE tp.id = %s OR tp.id_versao_atual = %s
+        """
+
         try:
-            with connection.cursor() as cursor:
-                cursor.execute(query, [pk])
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(query_template, [pk, pk])
                 if cursor.rowcount == 0:
                     return Response({"detail": "Template não encontrado."}, status=status.HTTP_404_NOT_FOUND)
-            
-            return Response(status=status.HTTP_204_NO_CONTENT)
+
+                cursor.execute(query_etapas, [pk, pk])
+                # os processos do shard deixam de aparecer no feed já agora (trigger mudancaTemplateOculto)
+                shards.replicar_template(pk)
+                id_job = enfileirar_job('excluir_template', {"id_template": int(pk)}, request.user.id)
+            # os demais workers percebem pela versão das dimensões (DIMENSOES_INTERVALO_SEGUNDOS)
+            dimensoes.invalidar('template_processo', 'etapa')
+
+            return Response(
+                {"detail": "Exclusão agendada.", "id_job": id_job},
+                status=status.HTTP_202_ACCEPTED
+            )
         except (OperationalError, IntegrityError) as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    colunas_completo = {
+        'id': 'tp.id',
+        'nome': 'tp.nome',
+        'descricao': 'tp.descricao',
+        'versao': 'tp.versao',
+        'id_versao_atual': 'tp.id_versao_atual',
+    }
+
+    colunas_etapa = {
+        'id': 'e.id', 'id_template': 'e.id_template', 'nome': 'e.nome', 'ordem': 'e.ordem',
+        'campo_anexo': 'e.campo_anexo', 'responsavel': 'e.responsavel', 'prazo_horas': 'e.prazo_horas'
+    }
+
+    colunas_fluxo = {'id': 'f.id', 'id_origem': 'f.id_origem', 'id_destino': 'f.id_destino'}
+
     @action(detail=True, methods=['get'], url_path='processo-completo')
     def processo_completo(self, request, pk=None):
-        id_template = pk
-        
+        """
+        GET /api/processos/templates/<pk>/processo-completo/
+        Template, etapas e fluxos em um único documento JSON montado pelo MySQL.
+        """
+        etapas = lista_json(
+            objeto_json(self.colunas_etapa),
+            "FROM etapa e WHERE e.id_template = tp.id AND e.oculto = FALSE",
+            ordem="e.ordem, e.id"
+        )
+        fluxos = lista_json(
+            objeto_json(self.colunas_fluxo),
+            """
+                FROM fluxo_execucao f
+                JOIN etapa e ON e.id = f.id_origem
+                WHERE e.id_template = tp.id AND e.oculto = FALSE
+            """
+        )
+
         try:
+            # publicado: ver query_template
+            colunas = {**self.colunas_completo, 'publicado': expressao_publicado(pk), 'etapas': etapas, 'fluxos': fluxos}
+            query = f"""
+                SELECT {objeto_json(colunas)}
+                FROM template_processo tp
+                WHERE tp.id = %s AND tp.oculto = FALSE
+            """
             with connection.cursor() as cursor:
-                query_template = "SELECT * FROM template_processo WHERE id = %s"
-                cursor.execute(query_template, [id_template])
-                template_data = dictfetchall(cursor)
-                
-                if not template_data:
-                    return Response({"detail": "Template não encontrado."}, status=status.HTTP_404_NOT_FOUND)
-                
-                resultado = template_data[0]
-                
-                query_etapas = "SELECT * FROM etapa WHERE id_template = %s ORDER BY ordem"
-                cursor.execute(query_etapas, [id_template])
-                etapas_data = dictfetchall(cursor)
-                
-                query_fluxos = """
-                    SELECT * FROM fluxo_execucao 
-                    WHERE id_origem IN (
-                        SELECT id FROM etapa WHERE id_template = %s
-                    )
-                """
-                cursor.execute(query_fluxos, [id_template])
-                fluxos_data = dictfetchall(cursor)
+                cursor.execute(query, [pk])
+                documento = cursor.fetchone()
+
+            if not documento:
+                return Response({"detail": "Template não encontrado."}, status=status.HTTP_404_NOT_FOUND)
+
+            return resposta_documento(documento[0])
 
-            resultado['etapas'] = etapas_data
-            resultado['fluxos'] = fluxos_data
-                
-            return Response(resultado, status=status.HTTP_200_OK)
-            
         except Exception as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=True, methods=['post'], url_path='clonar')
+    def clonar(self, request, pk=None):
+        """
+        POST /api/processos/templates/<pk>/clonar/
+        Cria uma cópia do template com todas as etapas e fluxos, em uma única transação
+        e com um número constante de comandos SQL (ver grafo.copiar_grafo).
+
+        Body (Opcional):
+        {
+            "nome": "..."
+        }
+        """
+        nome = request.data.get('nome')
+
+        query_template = """
+            INSERT INTO template_processo (nome, descricao)
+            SELECT COALESCE(%s, CONCAT(nome, ' (cópia)')), descricao
+            FROM template_processo
+            WHERE id = %s AND oculto = FALSE
+        """
+
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(query_template, [nome, pk])
+                    if cursor.rowcount == 0:
+                        return Response({"detail": "Template não encontrado."}, status=status.HTTP_404_NOT_FOUND)
+
+                    novo_id = cursor.lastrowid
+                    qtd_etapas, qtd_fluxos = copiar_grafo(cursor, pk, novo_id)
+                    shards.replicar_template(novo_id)
+
+            return Response(
+                {
+                    "id": novo_id,
+                    "id_template_origem": int(pk),
+                    "etapas_copiadas": qtd_etapas,
+                    "fluxos_copiados": qtd_fluxos
+                },
+                status=status.HTTP_201_CREATED
+            )
+        except (OperationalError, IntegrityError) as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['post'], url_path='importar')
+    def importar(self, request):
+        """
+        POST /api/processos/templates/importar/
+        Cria um template completo (template, etapas e fluxos) em uma única transação.
+        O grafo é validado em memória (TemplateImportacaoSerializer) antes de qualquer escrita
+        e as etapas/fluxos são gravados com INSERTs de várias linhas.
+        """
+        serializer = TemplateImportacaoSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        etapas = data['etapas']
+
+        query_template = "INSERT INTO template_processo (nome, descricao) VALUES (%s, %s)"
+        query_etapas = "INSERT INTO etapa (id_template, nome, ordem, responsavel, campo_anexo, prazo_horas) VALUES (%s, %s, %s, %s, %s, %s)"
+        query_ids = "SELECT id FROM etapa WHERE id_template = %s ORDER BY id"
+        query_fluxos = "INSERT INTO fluxo_execucao (id_origem, id_destino) VALUES (%s, %s)"
+
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(query_template, [data['nome'], data['descricao']])
+                    id_template = cursor.lastrowid
+
+                    cursor.executemany(query_etapas, [
+                        [id_template, etapa['nome'], etapa['ordem'], etapa['responsavel'], etapa['campo_anexo'], etapa['prazo_horas']]
+                        for etapa in etapas
+                    ])
+
+                    # o INSERT de várias linhas preserva a ordem da lista, então os ids crescem na mesma ordem
+                    cursor.execute(query_ids, [id_template])
+                    ids_etapas = {
+                        etapa['chave']: row[0]
+                        for etapa, row in zip(etapas, cursor.fetchall())
+                    }
+
+                    cursor.executemany(query_fluxos, [
+                        [ids_etapas[fluxo['origem']], ids_etapas[fluxo['destino']]]
+                        for fluxo in data['fluxos']
+                    ])
+                    shards.replicar_template(id_template)
+
+            return Response(
+                {
+                    "id": id_template,
+                    "nome": data['nome'],
+                    "descricao": data['descricao'],
+                    "etapas": ids_etapas
+                },
+                status=status.HTTP_201_CREATED
+            )
+        except (OperationalError, IntegrityError) as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
 class EtapaViewSet(viewsets.ViewSet):
     """
     API para gerenciar Etapas (CRUD) e suas ações (Vincular).
     """
     
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update', 'destroy', 'vincular_etapa']:
+        if self.action in ['create', 'update', 'partial_update', 'destroy', 'vincular_etapa'] or \
+                (self.action == 'campos' and self.request.method == 'POST'):
             self.permission_classes = [IsAuthenticated, IsCoordenador]
         else:
             self.permission_classes = [IsAuthenticated]
         return super().get_permissions()
     
+    colunas_lista = {
+        'id': 'id', 'id_template': 'id_template', 'nome': 'nome',
+        'ordem': 'ordem', 'responsavel': 'responsavel', 'campo_anexo': 'campo_anexo',
+        'prazo_horas': 'prazo_horas'
+    }
+
     def list(self, request):
         id_template = request.query_params.get('id_template')
+
+        selecao, _, erro = colunas_selecionadas(request, self.colunas_lista)
+        if erro:
+            return Response({"detail": erro}, status=status.HTTP_400_BAD_REQUEST)
         
-        query = "SELECT id, id_template, nome, ordem, responsavel, campo_anexo FROM etapa"
+        query = f"SELECT {selecao} FROM etapa WHERE oculto = FALSE"
         params = []
         
         if id_template:
-            query += " WHERE id_template = %s"
+            query += " AND id_template = %s"
             params.append(id_template)
+        else:
+            query += " AND id_template IN (SELECT id FROM template_processo WHERE id_versao_atual IS NULL)"
             
         query += " ORDER BY ordem"
 
@@ -182,25 +453,48 @@ class EtapaViewSet(viewsets.ViewSet):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         data = serializer.validated_data
-        query = "INSERT INTO etapa (id_template, nome, ordem, responsavel, campo_anexo) VALUES (%s, %s, %s, %s, %s)"
+        query = "INSERT INTO etapa (id_template, nome, ordem, responsavel, campo_anexo, prazo_horas) VALUES (%s, %s, %s, %s, %s, %s)"
 
         try:
-            with connection.cursor() as cursor:
+            with transacao_de_edicao(id_template=data['id_template']), connection.cursor() as cursor:
+                versao = versao_para_edicao(cursor, id_template=data['id_template'])
+                if versao is None:
+                    return Response({"detail": "Template não encontrado."}, status=status.HTTP_404_NOT_FOUND)
+                _, id_versao, _ = versao
+
                 cursor.execute(query, [
-                    data['id_template'],
+                    id_versao,
                     data['nome'],
                     data['ordem'],
                     data['responsavel'],
-                    data.get('campo_anexo', False) 
+                    data.get('campo_anexo', False),
+                    data.get('prazo_horas')
                 ])
                 new_id = cursor.lastrowid
             
-            return Response({"id": new_id, **data}, status=status.HTTP_201_CREATED)
+            return Response({"id": new_id, **data, "id_template": id_versao}, status=status.HTTP_201_CREATED)
+        except VersaoSubstituida as e:
+            return self._resposta_versao_substituida(e)
         except (OperationalError, IntegrityError) as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+    def _resposta_versao_substituida(self, erro):
+        return Response(
+            {"detail": str(erro), "id_versao_atual": erro.id_versao_atual},
+            status=status.HTTP_409_CONFLICT
+        )
+
+    def _etapa_na_versao(self, cursor, versao, id_etapa):
+        """
+        Id da etapa na versão que está sendo editada (a própria etapa, se a versão não foi copiada).
+        """
+        id_template, id_versao, copiada = versao
+        if not copiada:
+            return int(id_etapa)
+        return mapear_etapas(cursor, id_template, id_versao, [id_etapa])[int(id_etapa)]
         
     def retrieve(self, request, pk=None):
-        query = "SELECT id, id_template, nome, ordem, responsavel, campo_anexo FROM etapa WHERE id = %s"
+        query = "SELECT id, id_template, nome, ordem, responsavel, campo_anexo, prazo_horas FROM etapa WHERE id = %s AND oculto = FALSE"
         try:
             with connection.cursor() as cursor:
                 cursor.execute(query, [pk])
@@ -219,39 +513,72 @@ class EtapaViewSet(viewsets.ViewSet):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         data = serializer.validated_data
-        query = "UPDATE etapa SET id_template = %s, nome = %s, ordem = %s, responsavel = %s, campo_anexo = %s WHERE id = %s"
+        query = """
+            UPDATE etapa SET nome = %s, ordem = %s, responsavel = %s, campo_anexo = %s, prazo_horas = %s
+            WHERE id = %s
+        """
 
         try:
-            with connection.cursor() as cursor:
+            with transacao_de_edicao(id_etapa=pk), connection.cursor() as cursor:
+                versao = versao_para_edicao(cursor, id_etapa=pk)
+                if versao is None:
+                    return Response({"detail": "Etapa não encontrada."}, status=status.HTTP_404_NOT_FOUND)
+                if data['id_template'] != versao[0]:
+                    # desfaz a nova versão que versao_para_edicao pode ter acabado de criar
+                    transaction.set_rollback(True)
+                    return Response(
+                        {"detail": "Não é possível mover uma etapa para outro template."},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
+                id_etapa = self._etapa_na_versao(cursor, versao, pk)
                 cursor.execute(query, [
-                    data['id_template'],
                     data['nome'],
                     data['ordem'],
                     data['responsavel'],
                     data.get('campo_anexo', False),
-                    pk
+                    data.get('prazo_horas'),
+                    id_etapa
                 ])
-                if cursor.rowcount == 0:
-                    return Response({"detail": "Etapa não encontrada."}, status=status.HTTP_404_NOT_FOUND)
             
-            return Response({"id": pk, **data}, status=status.HTTP_200_OK)
+            return Response({"id": id_etapa, **data, "id_template": versao[1]}, status=status.HTTP_200_OK)
+        except VersaoSubstituida as e:
+            return self._resposta_versao_substituida(e)
         except (OperationalError, IntegrityError) as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_400_BAD_REQUEST)
         
     def destroy(self, request, pk=None):
         """
         Deleta uma etapa.
-        ON DELETE CASCADE (no SQL) cuidará da limpeza dos fluxos/execuções.
+        Em uma versão publicada, a etapa é removida de uma nova versão do template (sem tocar nos
+        processos em andamento). Em um rascunho, a etapa é ocultada na hora e a remoção das
+        execuções, fluxos e campos é feita em lotes pelo job 'excluir_etapa' (worker_jobs).
         """
-        query = "DELETE FROM etapa WHERE id = %s"
-        
         try:
-            with connection.cursor() as cursor:
-                cursor.execute(query, [pk])
-                if cursor.rowcount == 0:
+            with transacao_de_edicao(id_etapa=pk), connection.cursor() as cursor:
+                versao = versao_para_edicao(cursor, id_etapa=pk)
+                if versao is None:
                     return Response({"detail": "Etapa não encontrada."}, status=status.HTTP_404_NOT_FOUND)
-            
-            return Response(status=status.HTTP_204_NO_CONTENT)
+
+                _, id_versao, copiada = versao
+                if copiada:
+                    # a cópia acabou de ser criada e ainda não tem execuções: remoção direta
+                    cursor.execute("DELETE FROM etapa WHERE id = %s", [self._etapa_na_versao(cursor, versao, pk)])
+                    return Response(
+                        {"detail": "Etapa removida em uma nova versão do template.", "id_template": id_versao},
+                        status=status.HTTP_200_OK
+                    )
+
+                cursor.execute("UPDATE etapa SET oculto = TRUE WHERE id = %s", [pk])
+                id_job = enfileirar_job('excluir_etapa', {"id_etapa": int(pk)}, request.user.id)
+            dimensoes.invalidar('etapa')
+
+            return Response(
+                {"detail": "Exclusão agendada.", "id_job": id_job},
+                status=status.HTTP_202_ACCEPTED
+            )
+        except VersaoSubstituida as e:
+            return self._resposta_versao_substituida(e)
         except (OperationalError, IntegrityError) as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -266,21 +593,43 @@ class EtapaViewSet(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        query = "INSERT INTO fluxo_execucao (id_origem, id_destino) VALUES (%s, %s)"
+        query = """
+            INSERT INTO fluxo_execucao (id_origem, id_destino)
+            SELECT %s, id FROM etapa
+            WHERE id = %s AND id_template = %s AND oculto = FALSE
+        """
         
         try:
-            with connection.cursor() as cursor:
-                cursor.execute(query, [id_origem, id_destino])
+            with transacao_de_edicao(id_etapa=id_origem), connection.cursor() as cursor:
+                versao = versao_para_edicao(cursor, id_etapa=id_origem)
+                if versao is None:
+                    return Response({"detail": "Etapa não encontrada."}, status=status.HTTP_404_NOT_FOUND)
+
+                id_template, id_versao, copiada = versao
+                if copiada:
+                    mapa = mapear_etapas(cursor, id_template, id_versao, [id_origem, id_destino])
+                    id_origem, id_destino = mapa[int(id_origem)], mapa.get(int(id_destino), 0)
+
+                cursor.execute(query, [id_origem, id_destino, id_versao])
+                if cursor.rowcount == 0:
+                    transaction.set_rollback(True)
+                    return Response(
+                        {"detail": "A etapa de destino não pertence ao template da etapa de origem."},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
                 new_fluxo_id = cursor.lastrowid
             
             return Response(
                 {
                     "id": new_fluxo_id,
                     "id_origem": int(id_origem),
-                    "id_destino": int(id_destino)
+                    "id_destino": int(id_destino),
+                    "id_template": id_versao
                 },
                 status=status.HTTP_201_CREATED
             )
+        except VersaoSubstituida as e:
+            return self._resposta_versao_substituida(e)
         except IntegrityError as e:
             return Response(
                 {"detail": f"Erro de integridade do banco: {e}"},
@@ -293,6 +642,61 @@ class EtapaViewSet(viewsets.ViewSet):
             )
 
 
+    @action(detail=True, methods=['get', 'post'], url_path='campos')
+    def campos(self, request, pk=None):
+        """
+        GET /api/processos/etapas/<pk>/campos/
+        Lista as definições de todos os campos dinâmicos da etapa.
+
+        POST /api/processos/etapas/<pk>/campos/
+        Cria várias definições de uma vez (INSERT de várias linhas).
+        Body esperado: [{"nome": "...", "tipo": "TEXTO", "obrigatorio": true, "ordem": 1}, ...]
+        """
+        if request.method == 'POST':
+            serializer = ModeloCampoSerializer(data=request.data, many=True)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+            query = "INSERT INTO modelo_campo (id_etapa, nome, tipo, obrigatorio, ordem) VALUES (%s, %s, %s, %s, %s)"
+            try:
+                with transacao_de_edicao(id_etapa=pk), connection.cursor() as cursor:
+                    versao = versao_para_edicao(cursor, id_etapa=pk)
+                    if versao is None:
+                        return Response({"detail": "Etapa não encontrada."}, status=status.HTTP_404_NOT_FOUND)
+
+                    id_etapa = self._etapa_na_versao(cursor, versao, pk)
+                    cursor.executemany(query, [
+                        [id_etapa, campo['nome'], campo['tipo'], campo['obrigatorio'], campo['ordem']]
+                        for campo in serializer.validated_data
+                    ])
+
+                if id_etapa != int(pk):
+                    # os campos foram criados na etapa da nova versão do template
+                    return Response(
+                        {"id_etapa": id_etapa, "id_template": versao[1], "campos": serializer.validated_data},
+                        status=status.HTTP_201_CREATED
+                    )
+                return Response(serializer.validated_data, status=status.HTTP_201_CREATED)
+            except VersaoSubstituida as e:
+                return self._resposta_versao_substituida(e)
+            except (OperationalError, IntegrityError) as e:
+                return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        query = """
+            SELECT id, nome, tipo, obrigatorio, ordem
+            FROM modelo_campo
+            WHERE id_etapa = %s
+            ORDER BY ordem, id
+        """
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, [pk])
+                campos = dictfetchall(cursor)
+            return Response(campos, status=status.HTTP_200_OK)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 class FluxoExecucaoViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API para visualizar Fluxos de Execução.
@@ -302,11 +706,17 @@ class FluxoExecucaoViewSet(viewsets.ReadOnlyModelViewSet):
     
     permission_classes = [IsAuthenticated]
     
+    colunas_lista = {'id': 'f.id', 'id_origem': 'f.id_origem', 'id_destino': 'f.id_destino'}
+
     def list(self, request):
         id_template = request.query_params.get('id_template')
+
+        selecao, _, erro = colunas_selecionadas(request, self.colunas_lista)
+        if erro:
+            return Response({"detail": erro}, status=status.HTTP_400_BAD_REQUEST)
         
-        query = """
-            SELECT f.id, f.id_origem, f.id_destino 
+        query = f"""
+            SELECT {selecao}
             FROM fluxo_execucao f
         """
         params = []
@@ -348,31 +758,82 @@ class ProcessoViewSet(viewsets.ReadOnlyModelViewSet):
     """
     permission_classes = [IsAuthenticated]
 
+    colunas_lista = {
+        'id': 'p.id',
+        'tipo_processo': 'tp.nome',
+        'iniciado_por': 'p.id_usuario',
+        'status_proc': 'p.status_proc',
+        'data_inicio': 'p.data_inicio',
+        'id_etapa_atual': 'p.id_etapa_atual',
+        'etapa_atual': 'p.id_etapa_atual',
+        'responsavel_atual': 'p.id_usuario_atual',
+    }
+
+    # colunas que a consulta traz como id e que são preenchidas pelo cache de dimensões (sem joins)
+    dimensoes_lista = {
+        'iniciado_por': ('usuario', 'nome'),
+        'etapa_atual': ('etapa', 'nome'),
+        'responsavel_atual': ('usuario', 'nome'),
+    }
+
+    colunas_historico = {
+        'Etapa': 'e.nome',
+        'Encaminhado_por': 'u.nome',
+        'Status': 'ee.status_exec',
+        'Data_Inicio': data_iso('ee.data_inicio'),
+        'Data_Fim': data_iso('ee.data_fim'),
+        'Mensagem': 'ee.observacoes',
+    }
+
+    colunas_processo = {
+        'id': 'p.id',
+        'id_template': 'p.id_template',
+        'id_usuario': 'p.id_usuario',
+        'status_proc': 'p.status_proc',
+        'data_inicio': data_iso('p.data_inicio'),
+        'id_exec_atual': 'p.id_exec_atual',
+        'id_etapa_atual': 'p.id_etapa_atual',
+        'id_usuario_atual': 'p.id_usuario_atual',
+    }
+
     def list(self, request):
         cargo_usuario = request.user.cargo
         id_usuario = request.user.id
 
+        selecao, _, erro = colunas_selecionadas(request, self.colunas_lista)
+        if erro:
+            return Response({"detail": erro}, status=status.HTTP_400_BAD_REQUEST)
+
         params = []
+        coluna_ordem = "p.data_inicio" if cargo_usuario in ['COORDENADOR', 'JIJ'] else "pp.data_inicio"
+        if shards.fragmentado():
+            # cada shard devolve as linhas já ordenadas; a coluna de ordenação serve para intercalá-las
+            selecao += f", {coluna_ordem} AS ordem_shard"
+
+        # templates excluídos (ocultos) vêm do cache de dimensões: a consulta lê só as tabelas de processo
+        try:
+            templates_ocultos = sorted(dimensoes.ocultos('template_processo'))
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        filtro_ocultos = f"p.id_template NOT IN ({', '.join(['%s'] * len(templates_ocultos))})" if templates_ocultos else "TRUE"
+
         if cargo_usuario in ['COORDENADOR', 'JIJ']:
-            query_base = """
-                SELECT p.id, tp.nome as tipo_processo, u.nome as iniciado_por, 
-                    p.status_proc, p.data_inicio
+            query_base = f"""
+                SELECT {selecao}
                 FROM processo p 
-                JOIN template_processo tp ON p.id_template = tp.id
-                JOIN usuario u ON p.id_usuario = u.id
-                WHERE 1=1 
+                WHERE {filtro_ocultos}
             """
         else:
-            query_base = """
-                SELECT p.id, tp.nome as tipo_processo, u.nome as iniciado_por, 
-                    p.status_proc, p.data_inicio
-                FROM processo p 
-                JOIN template_processo tp ON p.id_template = tp.id
-                JOIN usuario u ON p.id_usuario = u.id
-                WHERE p.id IN (SELECT id_processo FROM execucao_etapa WHERE id_usuario = %s)
-                AND 1=1
+            # participacao_processo é indexada por (id_usuario, data_inicio): join direto, já na ordem da listagem
+            query_base = f"""
+                SELECT {selecao}
+                FROM participacao_processo pp
+                JOIN processo p ON p.id = pp.id_processo
+                WHERE pp.id_usuario = %s
+                AND {filtro_ocultos}
             """
             params.append(id_usuario)
+        params.extend(templates_ocultos)
 
         filtro_status = request.query_params.get('status_proc')
         if filtro_status:
@@ -381,20 +842,28 @@ class ProcessoViewSet(viewsets.ReadOnlyModelViewSet):
 
         filtro_template = request.query_params.get('id_template')
         if filtro_template:
-            query_base += " AND tp.id = %s"
+            query_base += " AND p.id_template = %s"
             params.append(filtro_template)
 
+        filtro_etapa = request.query_params.get('id_etapa_atual')
+        if filtro_etapa:
+            query_base += " AND p.id_etapa_atual = %s"
+            params.append(filtro_etapa)
+
         filtro_usuario = request.query_params.get('id_usuario')
         if filtro_usuario and cargo_usuario in ['COORDENADOR', 'JIJ']:
-            query_base += " AND u.id = %s"
+            query_base += " AND p.id_usuario = %s"
             params.append(filtro_usuario)
 
-        query_base += " ORDER BY p.data_inicio DESC"
+        query_base += f" ORDER BY {coluna_ordem} DESC"
+
+        def consultar(cursor):
+            cursor.execute(query_base, params)
+            return dictfetchall(cursor)
 
         try:
-            with connection.cursor() as cursor:
-                cursor.execute(query_base, params)
-                processos = dictfetchall(cursor)
+            processos = intercalar_shards(shards.em_todos(consultar), 'ordem_shard')
+            dimensoes.preencher(processos, self.dimensoes_lista)
             return Response(processos, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -403,40 +872,78 @@ class ProcessoViewSet(viewsets.ReadOnlyModelViewSet):
         """
         GET /api/processos/processos/<pk>/
         Busca o histórico de um processo (Implementação da Query 2).
+        O processo e o histórico são montados como um único documento JSON pelo MySQL.
+        """
+        _, nomes, erro = colunas_selecionadas(request, self.colunas_historico)
+        if erro:
+            return Response({"detail": erro}, status=status.HTTP_400_BAD_REQUEST)
+        join_usuario = "JOIN usuario u ON u.id = ee.id_usuario" if 'Encaminhado_por' in nomes else ""
+
+        historico = lista_json(
+            objeto_json(self.colunas_historico, nomes),
+            f"""
+                FROM etapa e
+                JOIN execucao_etapa ee ON e.id = ee.id_etapa
+                {join_usuario}
+                WHERE ee.id_processo = p.id
+            """,
+            ordem="ee.data_inicio ASC, ee.status_exec DESC"
+        )
+        query = f"""
+            SELECT {objeto_json({**self.colunas_processo, 'historico_etapas': historico})}
+            FROM processo p
+            WHERE p.id = %s
         """
-        id_processo = pk
+
         try:
-            with connection.cursor() as cursor:
-                query_processo = "SELECT * FROM processo WHERE id = %s"
-                cursor.execute(query_processo, [id_processo])
-                processo_data = dictfetchall(cursor)
+            with shards.conexao(shards.alias_do_registro(pk)).cursor() as cursor:
+                cursor.execute(query, [pk])
+                documento = cursor.fetchone()
 
-                if not processo_data:
-                    return Response({"detail": "Processo não encontrado."}, status=status.HTTP_404_NOT_FOUND)
-                
-                resultado_processo = processo_data[0]
+            if not documento:
+                return Response({"detail": "Processo não encontrado."}, status=status.HTTP_404_NOT_FOUND)
 
-                query_historico = """
-                    SELECT 
-                        e.nome as 'Etapa', 
-                        u.nome as 'Encaminhado_por', 
-                        ee.status_exec as 'Status', 
-                        ee.data_inicio as 'Data_Inicio',
-                        ee.data_fim as 'Data_Fim', 
-                        ee.observacoes as 'Mensagem' 
-                    FROM etapa e 
-                    JOIN execucao_etapa ee ON e.id = ee.id_etapa
-                    JOIN usuario u ON u.id = ee.id_usuario 
-                    WHERE ee.id_processo = %s
-                    ORDER BY ee.data_inicio ASC, ee.status_exec DESC
-                """
-                cursor.execute(query_historico, [id_processo])
-                historico_data = dictfetchall(cursor)
-                
-                resultado_processo['historico_etapas'] = historico_data
-                
-                return Response(resultado_processo, status=status.HTTP_200_OK)
+            return resposta_documento(documento[0])
+
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['get', 'post'], url_path='previsao', permission_classes=[IsAuthenticated, IsCoordenador])
+    def previsao(self, request):
+        """
+        GET /api/processos/processos/previsao/
+        Previsões de conclusão dos processos abertos (percentis 50, 80 e 95 e probabilidade de conclusão),
+        gravadas pela última execução do job prever_conclusoes. Aceita ?id_template= e ?id_processo=.
+
+        POST /api/processos/processos/previsao/
+        Agenda uma nova simulação (job prever_conclusoes).
+        """
+        if request.method == 'POST':
+            try:
+                id_job = enfileirar_job('prever_conclusoes', {}, request.user.id)
+            except Exception as e:
+                return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return Response({"detail": "Previsão agendada.", "id_job": id_job}, status=status.HTTP_202_ACCEPTED)
+
+        query = """
+            SELECT id_processo, id_template, id_etapa_atual, p50, p80, p95, prob_conclusao, data_previsao
+            FROM previsao_conclusao
+            WHERE 1 = 1
+        """
+        params = []
+
+        for filtro in ('id_template', 'id_processo'):
+            if request.query_params.get(filtro):
+                query += f" AND {filtro} = %s"
+                params.append(request.query_params[filtro])
+
+        query += " ORDER BY id_processo"
 
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                previsoes = dictfetchall(cursor)
+            return Response(previsoes, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -447,6 +954,38 @@ class ExecucaoEtapaViewSet(viewsets.ReadOnlyModelViewSet):
     """
     permission_classes = [IsAuthenticated]
 
+    colunas_caixa = {
+        'id_exec': 'ee.id',
+        'Id_Processo': 'p.id',
+        'Tipo_Processo': 'p.id_template',
+        'Processo_iniciado_por': 'p.id_usuario',
+        'Status': 'p.status_proc',
+        'Iniciado_em': 'p.data_inicio',
+        'Etapa_Pendente': 'ee.id_etapa',
+    }
+
+    colunas_atrasadas = {
+        'id_exec': 'es.id_exec_etapa',
+        'id_processo': 'es.id_processo',
+        'etapa': 'es.id_etapa',
+        'responsavel': 'es.id_usuario',
+        'data_inicio': 'ee.data_inicio',
+        'prazo': 'es.prazo',
+        'data_escalonamento': 'es.data_escalonamento',
+    }
+
+    dimensoes_atrasadas = {
+        'etapa': ('etapa', 'nome'),
+        'responsavel': ('usuario', 'nome'),
+    }
+
+    # preenchidas pelo cache de dimensões (a consulta traz os ids)
+    dimensoes_caixa = {
+        'Tipo_Processo': ('template_processo', 'nome'),
+        'Processo_iniciado_por': ('usuario', 'nome'),
+        'Etapa_Pendente': ('etapa', 'nome'),
+    }
+
     @action(detail=False, methods=['get'], url_path='caixa-de-entrada')
     def caixa_de_entrada(self, request):     
         """
@@ -454,31 +993,42 @@ class ExecucaoEtapaViewSet(viewsets.ReadOnlyModelViewSet):
         Implementação da Query 1.3 (Tarefas pendentes do usuário)
         """
         id_usuario = request.user.id
+
+        selecao, _, erro = colunas_selecionadas(request, self.colunas_caixa)
+        if erro:
+            return Response({"detail": erro}, status=status.HTTP_400_BAD_REQUEST)
         
-        query = """
-            SELECT ee.id AS id_exec,
-                   p.id AS Id_Processo,
-                   tp.nome AS Tipo_Processo,
-                   u.nome AS Processo_iniciado_por,
-                   p.status_proc AS Status,
-                   p.data_inicio AS Iniciado_em,
-                   e.nome AS Etapa_Pendente
+        # etapas excluídas (ocultas) vêm do cache de dimensões, como os nomes
+        try:
+            etapas_ocultas = sorted(dimensoes.ocultos('etapa'))
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        query = f"""
+            SELECT {selecao}
             FROM processo p 
-            JOIN template_processo tp ON p.id_template = tp.id
-            JOIN usuario u ON p.id_usuario = u.id 
             JOIN execucao_etapa ee ON ee.id_processo = p.id 
-            JOIN etapa e ON e.id = ee.id_etapa
             WHERE ee.id_usuario = %s AND ee.status_exec = 'PENDENTE'
         """
+        if etapas_ocultas:
+            query += f" AND ee.id_etapa NOT IN ({', '.join(['%s'] * len(etapas_ocultas))})"
+
+        def consultar(cursor):
+            cursor.execute(query, [id_usuario, *etapas_ocultas])
+            return dictfetchall(cursor)
 
         try:
-            with connection.cursor() as cursor:
-                cursor.execute(query, [id_usuario])
-                execucoes = dictfetchall(cursor)
+            execucoes = concatenar_shards(shards.em_todos(consultar))
+            dimensoes.preencher(execucoes, self.dimensoes_caixa)
             return Response(execucoes, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
+    dimensoes_tarefa = {
+        'nome_etapa': ('etapa', 'nome'),
+        'cargo_responsavel': ('etapa', 'responsavel'),
+        'campo_anexo': ('etapa', 'campo_anexo'),
+    }
+
     @action(detail=True, methods=['get'], url_path='detalhe-tarefa')
     def detalhe_tarefa(self, request, pk=None):
         """
@@ -488,34 +1038,36 @@ class ExecucaoEtapaViewSet(viewsets.ReadOnlyModelViewSet):
         id_exec_etapa = pk
         
         try:
-            with connection.cursor() as cursor:
+            with shards.conexao(shards.alias_do_registro(id_exec_etapa)).cursor() as cursor:
+                # os dados da etapa vêm do cache de dimensões: a consulta traz o id_etapa nessas colunas
                 query_exec = """
                     SELECT 
                         exec.id, exec.id_processo, exec.id_etapa,
                         exec.id_usuario, exec.observacoes, exec.data_inicio,
                         exec.data_fim, exec.anexo, exec.status_exec,
-                        et.nome as nome_etapa, et.responsavel as cargo_responsavel,
-                        et.campo_anexo
+                        exec.id_etapa as nome_etapa, exec.id_etapa as cargo_responsavel,
+                        exec.id_etapa as campo_anexo
                     FROM execucao_etapa exec
-                    JOIN etapa et ON exec.id_etapa = et.id
                     WHERE exec.id = %s
                 """
                 cursor.execute(query_exec, [id_exec_etapa])
                 execucao_data = dictfetchall(cursor)
 
-                if not execucao_data:
-                    return Response({"detail": "Execução de etapa não encontrada."}, status=status.HTTP_404_NOT_FOUND)
-                
-                return Response(execucao_data[0], status=status.HTTP_200_OK)
+            if not execucao_data:
+                return Response({"detail": "Execução de etapa não encontrada."}, status=status.HTTP_404_NOT_FOUND)
+
+            dimensoes.preencher(execucao_data, self.dimensoes_tarefa)
+            return Response(execucao_data[0], status=status.HTTP_200_OK)
             
         except Exception as e:
             return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR) 
         
     @action(detail=False, methods=['post'], url_path='iniciar')
+    @idempotencia.idempotente('iniciar', alias_do_iniciar)
     def iniciar_processo(self, request):
         """
         POST /api/processos/execucoes/iniciar/
-        Inicia um novo processo chamando a Stored Procedure 'criacaoProcessoEtapa'.
+        Inicia um novo processo chamando a Stored Procedure 'criacaoProcesso'.
         
         Body esperado: 
         { 
@@ -535,53 +1087,72 @@ class ExecucaoEtapaViewSet(viewsets.ReadOnlyModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        erro_anexo = anexos.anexo_invalido(anexo)
+        if erro_anexo:
+            return Response({"detail": erro_anexo}, status=status.HTTP_400_BAD_REQUEST)
+
         try:
             with connection.cursor() as cursor:
-                query_primeira_etapa = """
-                    SELECT id FROM etapa
-                    WHERE id_template = %s AND ordem = 1;
-                """
-                cursor.execute(query_primeira_etapa, [id_template])
+                cursor.execute(QUERY_PRIMEIRA_ETAPA, [id_template])
                 etapa_result = cursor.fetchone()
                 
-                if not etapa_result:
-                    raise Exception(f"Template (id={id_template}) não possui uma etapa com 'ordem = 1'.")
-                
-                first_etapa_id = etapa_result[0]
+            if not etapa_result:
+                raise Exception(f"Template (id={id_template}) não possui uma etapa com 'ordem = 1'.")
 
-                cursor.callproc('criacaoProcessoEtapa', [
-                    id_template,
-                    id_usuario_iniciador,
-                    first_etapa_id,
-                    observacoes,
-                    anexo
-                ])
-                
-                cursor.execute("""
-                    SELECT id FROM processo 
-                    WHERE id_usuario = %s 
-                    ORDER BY data_inicio DESC 
-                    LIMIT 1
-                """, [id_usuario_iniciador])
-                
-                processo_criado = cursor.fetchone()
-                new_processo_id = processo_criado[0] if processo_criado else None
+            first_etapa_id, id_template, id_original = etapa_result
+            alias = shards.alias_do_template(id_original)
 
-            return Response(
-                {
-                    "detalhe": "Processo iniciado com sucesso.",
-                    "id_processo_criado": new_processo_id
-                },
-                status=status.HTTP_201_CREATED
-            )
+            def criacao():
+                # criacaoProcesso não controla a transação: o processo, a primeira execução e o
+                # resultado da Idempotency-Key são confirmados (ou desfeitos) juntos
+                with transaction.atomic(using=alias), shards.conexao(alias).cursor() as cursor:
+                    chamar_procedure(cursor, 'criacaoProcesso', [
+                        id_template,
+                        id_usuario_iniciador,
+                        first_etapa_id,
+                        observacoes,
+                        anexo,
+                        None
+                    ])
+                    cursor.execute("SELECT @_criacaoProcesso_5")
+                    new_processo_id = cursor.fetchone()[0]
+
+                    response = Response(
+                        {
+                            "detalhe": "Processo iniciado com sucesso.",
+                            "id_processo_criado": new_processo_id
+                        },
+                        status=status.HTTP_201_CREATED
+                    )
+                    if not idempotencia.gravar_resposta(request, cursor, response):
+                        transaction.set_rollback(True, using=alias)
+                        return idempotencia.resposta_em_processamento()
+                return response
+
+            # deadlock/lock wait timeout desfazem a transação inteira, que é repetida do início
+            return com_retentativa('iniciar', criacao, shards.conexao(alias))
         
         except (IntegrityError, OperationalError, Exception) as e:
+            if erro_transitorio(e):
+                return self._resposta_erro_transitorio(e)
             return Response(
                 {"detail": f"Erro do banco de dados: {e}"},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+    def _resposta_erro_transitorio(self, erro):
+        """
+        Deadlock/lock wait timeout que persistiu após as retentativas. 503 (e não 400): nada foi
+        gravado e a mesma requisição pode ser repetida; com Idempotency-Key, a chave não é salva.
+        """
+        return Response(
+            {"detail": f"Banco de dados ocupado, tente novamente: {erro}"},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": "1"}
+        )
+
     @action(detail=True, methods=['post'], url_path='finalizar')
+    @idempotencia.idempotente('finalizar', alias_da_execucao)
     def finalizar_execucao(self, request, pk=None):
         """
         POST /api/processos/execucoes/<pk>/finalizar/
@@ -590,7 +1161,8 @@ class ExecucaoEtapaViewSet(viewsets.ReadOnlyModelViewSet):
         Body esperado:
         {
             "observacoes": "...",
-            "anexo": "..." (Opcional)
+            "anexo": "...", (Opcional)
+            "campos": [{"id_modelo": <id>, "dados": "..."}] (Opcional)
         }
         """
         id_exec_etapa_atual = pk
@@ -599,38 +1171,680 @@ class ExecucaoEtapaViewSet(viewsets.ReadOnlyModelViewSet):
         anexo = request.data.get('anexo', None)
         id_usuario_executor = request.user.id
 
-        try:
-            with connection.cursor() as cursor:
-                query_info = "SELECT id_etapa, id_processo FROM execucao_etapa WHERE id = %s AND status_exec = 'PENDENTE'"
+        campos_serializer = CampoSerializer(data=request.data.get('campos', []), many=True)
+        if not campos_serializer.is_valid():
+            return Response({"campos": campos_serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+        campos = campos_serializer.validated_data
+
+        erro_anexo = anexos.anexo_invalido(anexo)
+        if erro_anexo:
+            return Response({"detail": erro_anexo}, status=status.HTTP_400_BAD_REQUEST)
+
+        alias = shards.alias_do_registro(id_exec_etapa_atual)
+
+        def transicao():
+            # a procedure e a manutenção de participacao_processo precisam ser atômicas
+            with transaction.atomic(using=alias), shards.conexao(alias).cursor() as cursor:
+                # FOR UPDATE: duas finalizações simultâneas da mesma execução são serializadas
+                # aqui; a segunda só lê a linha depois do commit da primeira e recebe 404.
+                query_info = """
+                    SELECT id_etapa, id_processo, reservado_por, reserva_expira >= NOW()
+                    FROM execucao_etapa
+                    WHERE id = %s AND status_exec = 'PENDENTE'
+                    FOR UPDATE
+                """
                 cursor.execute(query_info, [id_exec_etapa_atual])
                 info_result = cursor.fetchone()
 
                 if not info_result:
                     return Response({"detail": "Execução de etapa não encontrada ou já concluída."}, status=status.HTTP_404_NOT_FOUND)
                 
-                id_etapa_atual, id_processo_atual = info_result[0], info_result[1]
+                id_etapa_atual, id_processo_atual, reservado_por, reserva_ativa = info_result
+
+                if reserva_ativa and reservado_por != id_usuario_executor:
+                    return Response({"detail": "Tarefa reservada por outro usuário."}, status=status.HTTP_409_CONFLICT)
 
-                query_fluxo = "SELECT id_destino FROM fluxo_execucao WHERE id_origem = %s"
+                erro_campos = salvar_campos(cursor, id_exec_etapa_atual, campos)
+                if erro_campos:
+                    transaction.set_rollback(True, using=alias)
+                    return Response({"detail": erro_campos}, status=status.HTTP_400_BAD_REQUEST)
+
+                pendentes = campos_obrigatorios_pendentes(cursor, id_exec_etapa_atual, id_etapa_atual)
+                if pendentes:
+                    transaction.set_rollback(True, using=alias)
+                    return Response(
+                        {"detail": f"Campos obrigatórios não preenchidos: {', '.join(pendentes)}."},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
+                query_fluxo = """
+                    SELECT f.id_destino FROM fluxo_execucao f
+                    JOIN etapa e ON e.id = f.id_destino
+                    WHERE f.id_origem = %s AND e.oculto = FALSE
+                """
                 cursor.execute(query_fluxo, [id_etapa_atual])
                 proxima_etapa = cursor.fetchone()
 
                 if not proxima_etapa:
+                    # os campos já foram gravados acima: a resposta de erro não pode confirmá-los
+                    transaction.set_rollback(True, using=alias)
                     return Response({"detail": "Fluxo não definido. Esta etapa é um beco sem saída."}, status=status.HTTP_400_BAD_REQUEST)
                 
                 id_etapa_destino = proxima_etapa[0]
 
-                cursor.callproc('validacaoEtapas', [
+                chamar_procedure(cursor, 'validacaoEtapas', [
                     id_processo_atual,
                     id_etapa_destino,
                     id_usuario_executor,
                     observacoes,
                     anexo
                 ])
-        
-                return Response({"detail": "Etapa avançada com sucesso."}, status=status.HTTP_200_OK)
+
+                response = Response({"detail": "Etapa avançada com sucesso."}, status=status.HTTP_200_OK)
+                if not idempotencia.gravar_resposta(request, cursor, response):
+                    transaction.set_rollback(True, using=alias)
+                    return idempotencia.resposta_em_processamento()
+            return response
+
+        try:
+            # deadlock/lock wait timeout desfazem a transação inteira, que é repetida do início
+            return com_retentativa('finalizar', transicao, shards.conexao(alias))
 
         except (IntegrityError, OperationalError, Exception) as e:
+            if erro_transitorio(e):
+                return self._resposta_erro_transitorio(e)
             return Response(
                 {"detail": f"Erro do banco de dados: {e}"},
                 status=status.HTTP_400_BAD_REQUEST
-            )
\ No newline at end of file
+            )
+
+    @action(detail=True, methods=['get', 'put'], url_path='campos')
+    def campos(self, request, pk=None):
+        """
+        GET /api/processos/exec_etapas/<pk>/campos/
+        Retorna, em uma única consulta, todos os campos da etapa com os valores já preenchidos.
+
+        PUT /api/processos/exec_etapas/<pk>/campos/
+        Grava todos os valores enviados com um único upsert de várias linhas.
+        Body esperado: [{"id_modelo": <id>, "dados": "..."}, ...]
+        """
+        if request.method == 'PUT':
+            serializer = CampoSerializer(data=request.data, many=True)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+            alias = shards.alias_do_registro(pk)
+            try:
+                with transaction.atomic(using=alias), shards.conexao(alias).cursor() as cursor:
+                    erro = salvar_campos(cursor, pk, serializer.validated_data)
+                    if erro:
+                        return Response({"detail": erro}, status=status.HTTP_400_BAD_REQUEST)
+
+                return Response(serializer.validated_data, status=status.HTTP_200_OK)
+            except (OperationalError, IntegrityError) as e:
+                return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        query = """
+            SELECT mc.id AS id_modelo, mc.nome, mc.tipo, mc.obrigatorio, c.dados
+            FROM execucao_etapa ee
+            JOIN modelo_campo mc ON mc.id_etapa = ee.id_etapa
+            LEFT JOIN campo c ON c.id_modelo = mc.id AND c.id_exec_etapa = ee.id
+            WHERE ee.id = %s
+            ORDER BY mc.ordem, mc.id
+        """
+        try:
+            with shards.conexao(shards.alias_do_registro(pk)).cursor() as cursor:
+                cursor.execute(query, [pk])
+                campos = dictfetchall(cursor)
+            return Response(campos, status=status.HTTP_200_OK)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['get'], url_path='atrasadas')
+    def atrasadas(self, request):
+        """
+        GET /api/processos/exec_etapas/atrasadas/
+        Caixa de entrada das execuções pendentes além do prazo da etapa (tabela 'escalonamento',
+        preenchida pelo comando escalonar_pendencias). Coordenadores e JIJ veem as de todos os usuários.
+        """
+        selecao, _, erro = colunas_selecionadas(request, self.colunas_atrasadas)
+        if erro:
+            return Response({"detail": erro}, status=status.HTTP_400_BAD_REQUEST)
+        if shards.fragmentado():
+            # cada shard devolve as linhas já ordenadas pelo prazo; a coluna de ordenação serve para intercalá-las
+            selecao += ", es.prazo AS ordem_shard"
+
+        query = f"""
+            SELECT {selecao}
+            FROM escalonamento es
+            JOIN execucao_etapa ee ON ee.id = es.id_exec_etapa
+            WHERE ee.status_exec = 'PENDENTE'
+        """
+        params = []
+
+        if request.user.cargo not in ['COORDENADOR', 'JIJ']:
+            query += " AND es.id_usuario = %s"
+            params.append(request.user.id)
+
+        query += " ORDER BY es.prazo"
+
+        def consultar(cursor):
+            cursor.execute(query, params)
+            return dictfetchall(cursor)
+
+        try:
+            execucoes = intercalar_shards(shards.em_todos(consultar), 'ordem_shard', decrescente=False)
+            dimensoes.preencher(execucoes, self.dimensoes_atrasadas)
+            return Response(execucoes, status=status.HTTP_200_OK)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['post'], url_path='reservar')
+    def reservar(self, request):
+        """
+        POST /api/processos/exec_etapas/reservar/
+        Entrega a próxima tarefa pendente da fila do cargo do usuário e a reserva
+        por FILA_RESERVA_SEGUNDOS.
+
+        SKIP LOCKED faz com que vários usuários do mesmo cargo esvaziem a fila em paralelo:
+        cada um pula as linhas que estão sendo reservadas por outro, sem esperar.
+        Tarefas com reserva expirada voltam a ser entregues.
+
+        Com shards, cada alias tem a sua fila: a reserva é tentada primeiro no alias cuja tarefa
+        disponível é a mais antiga, e passa para o seguinte se nada restar nele.
+        """
+        filtro_fila = """
+            FROM execucao_etapa ee
+            JOIN etapa e ON e.id = ee.id_etapa
+            WHERE ee.status_exec = 'PENDENTE' AND e.responsavel = %s AND e.oculto = FALSE
+            AND (ee.reserva_expira IS NULL OR ee.reserva_expira < NOW())
+        """
+        query_proxima = f"""
+            SELECT ee.id {filtro_fila}
+            ORDER BY ee.data_inicio, ee.id
+            LIMIT 1
+            FOR UPDATE OF ee SKIP LOCKED
+        """
+        query_reserva = """
+            UPDATE execucao_etapa
+            SET reservado_por = %s, reserva_expira = NOW() + INTERVAL %s SECOND
+            WHERE id = %s
+        """
+        query_tarefa = """
+            SELECT ee.id, ee.id_processo, ee.id_etapa, e.nome as nome_etapa,
+                ee.observacoes, ee.data_inicio, ee.reserva_expira
+            FROM execucao_etapa ee
+            JOIN etapa e ON e.id = ee.id_etapa
+            WHERE ee.id = %s
+        """
+
+        def reservar_no_alias(alias):
+            with transaction.atomic(using=alias), shards.conexao(alias).cursor() as cursor:
+                cursor.execute(query_proxima, [request.user.cargo])
+                proxima = cursor.fetchone()
+
+                if not proxima:
+                    return None
+
+                cursor.execute(query_reserva, [request.user.id, getattr(settings, 'FILA_RESERVA_SEGUNDOS', 600), proxima[0]])
+                cursor.execute(query_tarefa, [proxima[0]])
+                return dictfetchall(cursor)[0]
+
+        def mais_antiga(cursor):
+            cursor.execute(f"SELECT MIN(ee.data_inicio) {filtro_fila}", [request.user.cargo])
+            return cursor.fetchone()[0]
+
+        try:
+            aliases = ['default']
+            if shards.fragmentado():
+                inicios = zip(shards.em_todos(mais_antiga), shards.aliases())
+                aliases = [alias for inicio, alias in sorted(par for par in inicios if par[0] is not None)]
+
+            for alias in aliases:
+                tarefa = reservar_no_alias(alias)
+                if tarefa is not None:
+                    return Response(tarefa, status=status.HTTP_200_OK)
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=True, methods=['post'], url_path='renovar-reserva')
+    def renovar_reserva(self, request, pk=None):
+        """
+        POST /api/processos/exec_etapas/<pk>/renovar-reserva/
+        Estende a reserva de uma tarefa que ainda pertence ao usuário.
+        """
+        query = """
+            UPDATE execucao_etapa
+            SET reserva_expira = NOW() + INTERVAL %s SECOND
+            WHERE id = %s AND reservado_por = %s
+            AND status_exec = 'PENDENTE' AND reserva_expira >= NOW()
+        """
+
+        try:
+            with shards.conexao(shards.alias_do_registro(pk)).cursor() as cursor:
+                cursor.execute(query, [getattr(settings, 'FILA_RESERVA_SEGUNDOS', 600), pk, request.user.id])
+                if cursor.rowcount == 0:
+                    return Response(
+                        {"detail": "Reserva expirada, inexistente ou pertencente a outro usuário."},
+                        status=status.HTTP_409_CONFLICT
+                    )
+
+                cursor.execute("SELECT reserva_expira FROM execucao_etapa WHERE id = %s", [pk])
+                reserva_expira = cursor.fetchone()[0]
+
+            return Response({"id": int(pk), "reserva_expira": reserva_expira}, status=status.HTTP_200_OK)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=True, methods=['post'], url_path='liberar-reserva')
+    def liberar_reserva(self, request, pk=None):
+        """
+        POST /api/processos/exec_etapas/<pk>/liberar-reserva/
+        Devolve a tarefa para a fila antes da reserva expirar.
+        """
+        query = """
+            UPDATE execucao_etapa
+            SET reservado_por = NULL, reserva_expira = NULL
+            WHERE id = %s AND reservado_por = %s AND status_exec = 'PENDENTE'
+        """
+
+        try:
+            with shards.conexao(shards.alias_do_registro(pk)).cursor() as cursor:
+                cursor.execute(query, [pk, request.user.id])
+                if cursor.rowcount == 0:
+                    return Response({"detail": "Reserva não encontrada."}, status=status.HTTP_404_NOT_FOUND)
+
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+    @action(detail=False, methods=['post'], url_path='reatribuir', permission_classes=[IsAuthenticated, IsCoordenador])
+    def reatribuir(self, request):
+        """
+        POST /api/processos/exec_etapas/reatribuir/
+        Agenda a passagem de todas as execuções pendentes de um usuário para outro (job reatribuir_pendencias).
+
+        Body esperado:
+        {
+            "id_usuario_origem": <id>,
+            "id_usuario_destino": <id>
+        }
+
+        Como o trigger insertExecucao só confere inserções, a compatibilidade é validada aqui, uma vez
+        para o conjunto: todas as pendências da origem (em todos os aliases) devem ser de etapas do cargo do destino.
+        """
+        origem = request.data.get('id_usuario_origem')
+        destino = request.data.get('id_usuario_destino')
+
+        if not origem or not destino:
+            return Response(
+                {"detail": "Os campos 'id_usuario_origem' e 'id_usuario_destino' são obrigatórios no body."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if str(origem) == str(destino):
+            return Response({"detail": "Origem e destino devem ser usuários diferentes."}, status=status.HTTP_400_BAD_REQUEST)
+
+        query_cargos = """
+            SELECT GROUP_CONCAT(DISTINCT e.responsavel)
+            FROM execucao_etapa ee
+            JOIN etapa e ON e.id = ee.id_etapa
+            WHERE ee.id_usuario = %s AND ee.status_exec = 'PENDENTE'
+        """
+        query_validacao = f"""
+            SELECT
+                (SELECT COUNT(*) FROM usuario WHERE id = %s),
+                (SELECT cargo FROM usuario WHERE id = %s),
+                ({query_cargos})
+        """
+
+        def cargos_no_shard(cursor):
+            cursor.execute(query_cargos, [origem])
+            return cursor.fetchone()[0]
+
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(query_validacao, [origem, destino, origem])
+                existe_origem, cargo_destino, cargos_default = cursor.fetchone()
+
+                if not existe_origem or cargo_destino is None:
+                    return Response({"detail": "Usuário de origem ou de destino não encontrado."}, status=status.HTTP_404_NOT_FOUND)
+
+                cargos_pendentes = set()
+                for cargos in [cargos_default, *shards.em_todos(cargos_no_shard, incluir_default=False)]:
+                    if cargos is not None:
+                        cargos_pendentes.update(cargos.split(','))
+                if not cargos_pendentes:
+                    return Response({"detail": "O usuário de origem não tem execuções pendentes."}, status=status.HTTP_200_OK)
+
+                incompativeis = sorted(cargos_pendentes - {cargo_destino})
+                if incompativeis:
+                    return Response(
+                        {"detail": f"O destino ({cargo_destino}) não pode assumir etapas de: {', '.join(incompativeis)}."},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
+                id_job = enfileirar_job('reatribuir_pendencias', {
+                    "id_usuario_origem": int(origem),
+                    "id_usuario_destino": int(destino),
+                    "cargo": cargo_destino,
+                }, request.user.id)
+
+            return Response(
+                {"detail": "Reatribuição agendada.", "id_job": id_job},
+                status=status.HTTP_202_ACCEPTED
+            )
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class JobViewSet(viewsets.ViewSet):
+    """
+    API para acompanhar os jobs executados em segundo plano (worker_jobs).
+    Coordenadores veem todos os jobs; os demais usuários apenas os que criaram.
+    """
+    permission_classes = [IsAuthenticated]
+
+    colunas_json = ['parametros', 'progresso', 'resultado']
+
+    def _carregar_json(self, jobs):
+        for job in jobs:
+            for coluna in self.colunas_json:
+                if job.get(coluna) is not None:
+                    job[coluna] = json.loads(job[coluna])
+        return jobs
+
+    colunas_lista = {
+        'id': 'id', 'tipo': 'tipo', 'status_job': 'status_job', 'tentativas': 'tentativas',
+        'progresso': 'progresso', 'data_criacao': 'data_criacao',
+        'data_inicio': 'data_inicio', 'data_fim': 'data_fim'
+    }
+
+    def list(self, request):
+        selecao, _, erro = colunas_selecionadas(request, self.colunas_lista)
+        if erro:
+            return Response({"detail": erro}, status=status.HTTP_400_BAD_REQUEST)
+
+        query = f"""
+            SELECT {selecao}
+            FROM job
+            WHERE 1=1
+        """
+        params = []
+
+        if request.user.cargo != 'COORDENADOR':
+            query += " AND id_usuario = %s"
+            params.append(request.user.id)
+
+        filtro_status = request.query_params.get('status_job')
+        if filtro_status:
+            query += " AND status_job = %s"
+            params.append(filtro_status)
+
+        query += " ORDER BY data_criacao DESC LIMIT 100"
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                jobs = self._carregar_json(dictfetchall(cursor))
+            return Response(jobs, status=status.HTTP_200_OK)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def retrieve(self, request, pk=None):
+        """
+        GET /api/processos/jobs/<pk>/
+        Endpoint de polling: status, progresso e resultado de um job.
+        """
+        query = """
+            SELECT id, tipo, parametros, status_job, id_usuario, tentativas, max_tentativas,
+                progresso, resultado, erro, data_criacao, data_inicio, data_fim
+            FROM job
+            WHERE id = %s
+        """
+        params = [pk]
+
+        if request.user.cargo != 'COORDENADOR':
+            query += " AND id_usuario = %s"
+            params.append(request.user.id)
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                job = self._carregar_json(dictfetchall(cursor))
+
+            if not job:
+                return Response({"detail": "Job não encontrado."}, status=status.HTTP_404_NOT_FOUND)
+
+            return Response(job[0], status=status.HTTP_200_OK)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class MudancaViewSet(viewsets.ViewSet):
+    """
+    Feed incremental de processos e execuções, para sincronização de clientes.
+    Coordenadores e JIJ recebem todas as mudanças; os demais, apenas as dos processos em que participam.
+    """
+    permission_classes = [IsAuthenticated]
+
+    colunas_processo = [
+        'id', 'id_template', 'id_usuario', 'status_proc', 'data_inicio',
+        'id_exec_atual', 'id_etapa_atual', 'id_usuario_atual'
+    ]
+
+    colunas_execucao = [
+        'id', 'id_processo', 'id_etapa', 'id_usuario', 'observacoes',
+        'data_inicio', 'data_fim', 'anexo', 'status_exec'
+    ]
+
+    def list(self, request):
+        """
+        GET /api/processos/mudancas/?desde=<cursor>&limite=<n>
+        Estado atual dos processos e execuções alterados depois de 'desde' (o 'cursor' da página anterior)
+        e os ids dos que saíram do feed (template ou etapa ocultados, linhas excluídas) em 'removidos'.
+
+        Cada alias tem a sua tabela 'mudanca' (preenchida pelos triggers): com shards, o cursor guarda a
+        posição em cada alias ("<default>.<shard>...", na ordem de shards.aliases()) e o limite vale por alias.
+        """
+        limite_max = getattr(settings, 'MUDANCAS_LIMITE', 500)
+        try:
+            posicoes = [int(posicao) for posicao in request.query_params.get('desde', '0').split('.')]
+            limite = min(int(request.query_params.get('limite', limite_max)), limite_max)
+        except ValueError:
+            return Response({"detail": "'desde' e 'limite' devem ser inteiros."}, status=status.HTTP_400_BAD_REQUEST)
+        if posicoes == [0]:
+            posicoes = [0] * len(shards.aliases())
+        if len(posicoes) != len(shards.aliases()):
+            return Response({"detail": "'desde' não é um cursor deste feed."}, status=status.HTTP_400_BAD_REQUEST)
+        if min(posicoes) < 0 or limite < 1:
+            return Response({"detail": "'desde' deve ser >= 0 e 'limite' >= 1."}, status=status.HTTP_400_BAD_REQUEST)
+        desde = dict(zip(shards.aliases(), posicoes))
+
+        # 'estavel': as mudanças mais recentes que o atraso ficam para a próxima página, para que uma
+        # transação ainda aberta com id menor não seja pulada pelo cursor
+        query_mudancas = """
+            SELECT m.id, m.tabela, m.id_registro, m.removido,
+                m.data_mudanca <= NOW(6) - INTERVAL %s SECOND AS estavel
+            FROM mudanca m
+        """
+        params = [getattr(settings, 'MUDANCAS_ATRASO_SEGUNDOS', 1)]
+
+        if request.user.cargo not in ['COORDENADOR', 'JIJ']:
+            # remoções vão para todos: a participação de um processo excluído já foi removida em cascata
+            query_mudancas += """
+                LEFT JOIN participacao_processo pp ON pp.id_processo = m.id_processo AND pp.id_usuario = %s
+                WHERE m.id > %s AND (pp.id_usuario IS NOT NULL OR m.removido)
+            """
+            params.append(request.user.id)
+        else:
+            query_mudancas += " WHERE m.id > %s"
+
+        query_mudancas += " ORDER BY m.id LIMIT %s"
+
+        def pagina(cursor):
+            desde_alias = desde[cursor.db.alias]
+            cursor.execute(query_mudancas, [*params, desde_alias, limite])
+            mudancas = cursor.fetchall()
+
+            estaveis = []
+            for mudanca in mudancas:
+                if not mudanca[4]:
+                    break
+                estaveis.append(mudanca)
+
+            # a última mudança de cada registro na página decide se ele vem com o estado atual ou como removido
+            ids = {'processo': set(), 'execucao_etapa': set()}
+            removidos = {'processo': set(), 'execucao_etapa': set()}
+            for _, tabela, id_registro, removido, _ in estaveis:
+                if removido:
+                    ids[tabela].discard(id_registro)
+                    removidos[tabela].add(id_registro)
+                else:
+                    removidos[tabela].discard(id_registro)
+                    ids[tabela].add(id_registro)
+
+            processos = self._carregar(cursor, """
+                SELECT {colunas}
+                FROM processo p
+                JOIN template_processo tp ON tp.id = p.id_template
+                WHERE p.id IN ({ids}) AND tp.oculto = FALSE
+                ORDER BY p.id
+            """, 'p', self.colunas_processo, ids['processo'])
+
+            execucoes = self._carregar(cursor, """
+                SELECT {colunas}
+                FROM execucao_etapa ee
+                JOIN etapa e ON e.id = ee.id_etapa
+                WHERE ee.id IN ({ids}) AND e.oculto = FALSE
+                ORDER BY ee.id
+            """, 'ee', self.colunas_execucao, ids['execucao_etapa'])
+
+            return estaveis[-1][0] if estaveis else desde_alias, len(estaveis) == limite, processos, execucoes, removidos
+
+        try:
+            paginas = shards.em_todos(pagina)
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        cursores = [str(cursor) for cursor, _, _, _, _ in paginas]
+        return Response({
+            "cursor": '.'.join(cursores) if shards.fragmentado() else paginas[0][0],
+            "mais": any(mais for _, mais, _, _, _ in paginas),
+            "processos": sorted((p for _, _, processos, _, _ in paginas for p in processos), key=lambda p: p['id']),
+            "execucoes": sorted((e for _, _, _, execucoes, _ in paginas for e in execucoes), key=lambda e: e['id']),
+            "removidos": {
+                "processos": sorted(i for *_, removidos in paginas for i in removidos['processo']),
+                "execucoes": sorted(i for *_, removidos in paginas for i in removidos['execucao_etapa']),
+            },
+        }, status=status.HTTP_200_OK)
+
+    def _carregar(self, cursor, query, alias, colunas, ids):
+        if not ids:
+            return []
+        query = query.format(
+            colunas=', '.join(f"{alias}.{coluna}" for coluna in colunas),
+            ids=', '.join(['%s'] * len(ids))
+        )
+        cursor.execute(query, sorted(ids))
+        return dictfetchall(cursor)
+
+
+class AnexoViewSet(viewsets.ViewSet):
+    """
+    Upload e download dos anexos das execuções (processos.anexos).
+    O conteúdo é endereçado pelo SHA-256: enviar o mesmo arquivo duas vezes não ocupa espaço duas vezes.
+    """
+    permission_classes = [IsAuthenticated]
+    lookup_value_regex = '[0-9a-f]{64}'
+
+    def create(self, request):
+        """
+        POST /api/processos/anexos/
+        Corpo: o conteúdo do arquivo (application/octet-stream), lido em blocos, sem ser carregado inteiro
+        na memória; com Content-Length ou Transfer-Encoding: chunked. Opcionalmente, o cabeçalho X-Anexo-Sha256 com o hash esperado do conteúdo.
+        Retorna a referência a ser enviada em "anexo" (iniciar/finalizar).
+        """
+        stream = request.stream
+        if stream is None and request.META.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+            # sem Content-Length, o Django e o DRF tratam o corpo como vazio; o servidor WSGI
+            # (ex.: gunicorn) entrega em wsgi.input o corpo chunked já decodificado, até o fim
+            stream = request._request.META['wsgi.input']
+        if stream is None:
+            return Response({"detail": "O corpo da requisição deve conter o arquivo."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            hash_hex, tamanho, novo = anexos.salvar(stream, request.headers.get('X-Anexo-Sha256'))
+        except anexos.AnexoGrandeDemais as e:
+            return Response({"detail": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except anexos.HashDivergente as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except OSError as e:
+            return Response({"detail": f"Erro ao gravar o anexo: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return Response(
+            {"anexo": f"{anexos.PREFIXO}{hash_hex}", "tamanho": tamanho},
+            status=status.HTTP_201_CREATED if novo else status.HTTP_200_OK
+        )
+
+    def retrieve(self, request, pk=None):
+        """
+        GET /api/processos/anexos/<sha256>/
+        Envia o arquivo direto do disco. Aceita Range (um intervalo) para downloads retomáveis;
+        o ETag é o próprio hash, e o conteúdo de um hash nunca muda.
+        Só anexos referenciados por uma execução são enviados: para coordenadores e JIJ, de qualquer
+        processo; para os demais, dos processos em que participam. Os outros recebem 404.
+        """
+        query_visivel = "SELECT 1 FROM execucao_etapa ee"
+        params = []
+        if request.user.cargo not in ['COORDENADOR', 'JIJ']:
+            query_visivel += " JOIN participacao_processo pp ON pp.id_processo = ee.id_processo AND pp.id_usuario = %s"
+            params.append(request.user.id)
+        # pelo índice idx_exec_anexo; com shards, o processo pode estar em qualquer um deles
+        query_visivel += " WHERE ee.anexo = %s LIMIT 1"
+        params.append(f"{anexos.PREFIXO}{pk}")
+
+        def consultar(cursor):
+            cursor.execute(query_visivel, params)
+            return cursor.fetchone() is not None
+
+        try:
+            visivel = any(shards.em_todos(consultar))
+        except Exception as e:
+            return Response({"detail": f"Erro de banco: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if not visivel:
+            return Response({"detail": "Anexo não encontrado."}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            arquivo = open(anexos.caminho(pk), 'rb')
+        except FileNotFoundError:
+            return Response({"detail": "Anexo não encontrado."}, status=status.HTTP_404_NOT_FOUND)
+
+        tamanho = os.fstat(arquivo.fileno()).st_size
+        trecho = anexos.intervalo(request.headers.get('Range'), tamanho)
+
+        if trecho is False:
+            arquivo.close()
+            resposta = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            resposta['Content-Range'] = f"bytes */{tamanho}"
+            return resposta
+
+        nome = request.query_params.get('nome') or pk
+        if trecho is None:
+            resposta = FileResponse(arquivo, as_attachment=True, filename=nome, content_type='application/octet-stream')
+            resposta['Content-Length'] = str(tamanho)
+        else:
+            inicio, fim = trecho
+            arquivo.seek(inicio)
+            resposta = FileResponse(
+                anexos.TrechoArquivo(arquivo, fim - inicio + 1),
+                as_attachment=True, filename=nome, content_type='application/octet-stream',
+                status=status.HTTP_206_PARTIAL_CONTENT
+            )
+            resposta['Content-Length'] = str(fim - inicio + 1)
+            resposta['Content-Range'] = f"bytes {inicio}-{fim}/{tamanho}"
+
+        resposta['Accept-Ranges'] = 'bytes'
+        resposta['ETag'] = f'"{pk}"'
+        resposta['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return resposta
@@ -14,7 +14,14 @@ senha varchar(255) not null);
 create table if not exists template_processo (
 id bigint primary key auto_increment,
 nome varchar(100) not null,
-descricao tinytext not null );
+descricao tinytext not null,
+-- marcado na exclusão; as linhas são removidas em lotes pelo worker_jobs --
+oculto boolean default false not null,
+-- versões: cada edição do grafo de uma versão com processos cria uma nova linha (ver grafo.versao_para_edicao) --
+-- id_versao_atual aponta, em todas as versões antigas, para a versão atual; nulo na versão atual --
+versao int default 1 not null,
+id_versao_atual bigint,
+index idx_template_versao_atual (id_versao_atual) );
 
 -- 1.3. PROCESSO -- 
 create table if not exists processo (
@@ -23,8 +30,14 @@ id_template bigint not null,
 id_usuario bigint not null,
 status_proc enum('PENDENTE', 'CONCLUIDO') default 'PENDENTE' not null,
 data_inicio datetime default NOW() not null,
+-- etapa atual do processo (última execucao_etapa), mantida pela procedure validacaoEtapas --
+id_exec_atual bigint,
+id_etapa_atual bigint,
+id_usuario_atual bigint,
+index idx_processo_etapa_atual (id_etapa_atual, status_proc),
 foreign key (id_template) references template_processo(id) ON DELETE CASCADE,
-foreign key (id_usuario) references usuario(id));
+foreign key (id_usuario) references usuario(id),
+foreign key (id_usuario_atual) references usuario(id));
 
 -- 1.4. ETAPA -- 
 create table if not exists etapa (
@@ -34,6 +47,9 @@ nome varchar(100) not null,
 ordem int not null,
 campo_anexo boolean default false,
 responsavel enum('ORIENTADOR', 'COORDENADOR', 'JIJ') not null,
+-- prazo (SLA) de cada execução da etapa; nulo = sem prazo (ver escalonamento) --
+prazo_horas int,
+oculto boolean default false not null,
 foreign key (id_template) references template_processo(id) ON DELETE CASCADE
 );
 
@@ -56,13 +72,175 @@ id_usuario bigint not null,
 observacoes text not null,
 data_inicio datetime default now() not null,
 data_fim datetime,
+-- referência "sha256:<hash>" de um arquivo enviado em /api/processos/anexos/ (ou texto livre, nos anexos antigos) --
 anexo varchar(255),
 status_exec enum('PENDENTE', 'CONCLUIDO') default 'PENDENTE' not null,
+-- reserva (lease) da tarefa na fila compartilhada do cargo responsável --
+reservado_por bigint,
+reserva_expira datetime,
+-- fila por cargo e escalonamento: pendentes de cada etapa, por data_inicio --
+index idx_exec_fila (status_exec, id_etapa, data_inicio),
+-- pendências de cada usuário (reatribuição em lotes, job reatribuir_pendencias) --
+index idx_exec_usuario (id_usuario, status_exec),
+-- execuções que referenciam cada anexo (permissão de download em /api/processos/anexos/<sha256>/) --
+index idx_exec_anexo (anexo),
+foreign key (id_processo) references processo(id) ON DELETE CASCADE,
+foreign key (id_etapa) references etapa(id) ON DELETE CASCADE,
+foreign key (id_usuario) references usuario(id),
+foreign key (reservado_por) references usuario(id)
+);
+
+-- 1.7. FILA DE JOBS EM SEGUNDO PLANO --
+-- operações pesadas (exclusões em cascata, exportações, etc.) são executadas pelo worker_jobs --
+create table if not exists job (
+id bigint primary key auto_increment,
+tipo varchar(100) not null,
+parametros json not null,
+status_job enum('PENDENTE', 'EXECUTANDO', 'CONCLUIDO', 'ERRO') default 'PENDENTE' not null,
+id_usuario bigint,
+tentativas int default 0 not null,
+max_tentativas int default 3 not null,
+progresso json,
+resultado json,
+erro text,
+worker varchar(100),
+data_criacao datetime default now() not null,
+data_disponivel datetime default now() not null,
+data_inicio datetime,
+data_fim datetime,
+reserva_expira datetime,
+index idx_job_fila (status_job, data_disponivel, id),
+index idx_job_usuario (id_usuario, data_criacao),
+foreign key (id_usuario) references usuario(id) ON DELETE SET NULL
+);
+
+-- 1.8. PARTICIPAÇÃO DOS USUÁRIOS NOS PROCESSOS --
+-- uma linha por (usuário, processo) em que o usuário executou alguma etapa; mantida pela validacaoEtapas --
+create table if not exists participacao_processo (
+id_usuario bigint not null,
+id_processo bigint not null,
+data_inicio datetime not null,
+primary key (id_usuario, id_processo),
+index idx_participacao_usuario_data (id_usuario, data_inicio),
+foreign key (id_usuario) references usuario(id),
+foreign key (id_processo) references processo(id) ON DELETE CASCADE
+);
+
+-- 1.9. CHAVES DE IDEMPOTÊNCIA (cabeçalho Idempotency-Key em iniciar/finalizar) --
+create table if not exists chave_idempotencia (
+id_usuario bigint not null,
+chave varchar(255) not null,
+rota varchar(100) not null,
+hash_corpo char(64) not null,
+token char(32) not null,
+status_http int,
+resposta json,
+data_criacao datetime default now() not null,
+reserva_expira datetime not null,
+expira_em datetime not null,
+primary key (id_usuario, chave),
+index idx_idempotencia_expira (expira_em),
+foreign key (id_usuario) references usuario(id) ON DELETE CASCADE
+);
+
+-- 1.10. MODELOS DOS CAMPOS DINÂMICOS DE CADA ETAPA --
+create table if not exists modelo_campo (
+id bigint primary key auto_increment,
+id_etapa bigint not null,
+nome varchar(100) not null,
+tipo enum('TEXTO', 'NUMERO', 'DATA', 'BOOLEANO') default 'TEXTO' not null,
+obrigatorio boolean default false not null,
+ordem int default 0 not null,
+index idx_modelo_campo_etapa (id_etapa, ordem),
+foreign key (id_etapa) references etapa(id) ON DELETE CASCADE
+);
+
+-- 1.11. VALORES DOS CAMPOS PREENCHIDOS EM CADA EXECUÇÃO --
+create table if not exists campo (
+id bigint primary key auto_increment,
+id_modelo bigint not null,
+id_exec_etapa bigint not null,
+dados text,
+unique (id_exec_etapa, id_modelo),
+foreign key (id_modelo) references modelo_campo(id) ON DELETE CASCADE,
+foreign key (id_exec_etapa) references execucao_etapa(id) ON DELETE CASCADE
+);
+
+-- 1.12. EXECUÇÕES PENDENTES ALÉM DO PRAZO DA ETAPA (python manage.py escalonar_pendencias) --
+create table if not exists escalonamento (
+id bigint primary key auto_increment,
+id_exec_etapa bigint not null,
+id_processo bigint not null,
+id_etapa bigint not null,
+id_usuario bigint not null,
+prazo datetime not null,
+data_escalonamento datetime default now() not null,
+unique (id_exec_etapa),
+index idx_escalonamento_usuario (id_usuario, prazo),
+index idx_escalonamento_prazo (prazo),
+foreign key (id_exec_etapa) references execucao_etapa(id) ON DELETE CASCADE,
 foreign key (id_processo) references processo(id) ON DELETE CASCADE,
 foreign key (id_etapa) references etapa(id) ON DELETE CASCADE,
 foreign key (id_usuario) references usuario(id)
 );
 
+-- 1.13. MARCA D'ÁGUA DO ESCALONAMENTO POR ETAPA --
+-- execuções da etapa iniciadas até 'ate' já foram verificadas; cada execução só é lida uma vez --
+create table if not exists marca_escalonamento (
+id_etapa bigint primary key,
+ate datetime not null,
+foreign key (id_etapa) references etapa(id) ON DELETE CASCADE
+);
+
+-- 1.14. LOG DE MUDANÇAS (feed /api/processos/mudancas/), preenchido pelos triggers da seção 4 --
+-- id é o cursor do feed: cada inserção ou alteração de processo/execucao_etapa gera uma linha --
+-- removido: o registro saiu do feed (template/etapa ocultados ou linha excluída); o cliente deve apagá-lo --
+create table if not exists mudanca (
+id bigint primary key auto_increment,
+tabela enum('processo', 'execucao_etapa') not null,
+id_registro bigint not null,
+id_processo bigint not null,
+removido boolean default false not null,
+data_mudanca datetime(6) default now(6) not null
+);
+
+-- 1.15. VERSÕES DAS TABELAS DE DIMENSÃO (cache processos.dimensoes), incrementadas pelos triggers da seção 4 --
+create table if not exists versao_dimensao (
+tabela varchar(64) primary key,
+versao bigint default 0 not null
+);
+
+-- 1.16. PERFIS DE REQUISIÇÕES (bdedica.perfil: cabeçalho X-Perfil-Token ou PERFIL_AMOSTRAGEM) --
+-- chamadas: saída do pstats; comandos_sql: lista de {sql, ms, many} na ordem de execução --
+create table if not exists perfil_requisicao (
+id bigint primary key auto_increment,
+nome_view varchar(150) not null,
+metodo varchar(10) not null,
+caminho varchar(255) not null,
+status_http int not null,
+duracao_ms decimal(12, 3) not null,
+id_usuario bigint,
+chamadas mediumtext not null,
+comandos_sql json not null,
+data_criacao datetime default now() not null,
+index idx_perfil_view (nome_view, id),
+foreign key (id_usuario) references usuario(id) ON DELETE SET NULL
+);
+
+-- 1.17. PREVISÕES DE CONCLUSÃO DOS PROCESSOS ABERTOS (job prever_conclusoes, processos.previsao) --
+-- regravada inteira a cada execução do job; sem chaves estrangeiras porque os processos podem estar em um shard --
+create table if not exists previsao_conclusao (
+id_processo bigint primary key,
+id_template bigint not null,
+id_etapa_atual bigint not null,
+p50 datetime,
+p80 datetime,
+p95 datetime,
+prob_conclusao decimal(5, 4) not null,
+data_previsao datetime not null,
+index idx_previsao_template (id_template)
+);
+
 -- 2. FUNCTIONS 
 -- 2.1. Verifica se a etapa sendo inserida precisa de anexo -- 
 DELIMITER $$
@@ -88,21 +266,16 @@ DELIMITER $$
 CREATE PROCEDURE validacaoEtapas(IN novo_id_processo bigint, in novo_id_etapa bigint, in novo_id_usuario bigint, 
 in novo_observacoes text, in novo_anexo varchar(255))
 	BEGIN
+		DECLARE id_exec_anterior bigint;
 		DECLARE id_ultima_etapa bigint;
-        DECLARE id_etapa_final bigint;
         DECLARE precisa_anexo boolean;
         
-        -- vai selecionar a última etapa do processo inserida no banco --
-        select id_etapa into id_ultima_etapa from execucao_etapa
-        where id_processo = novo_id_processo
-        and data_inicio = ( select max(data_inicio) from execucao_etapa
-								where id_processo = novo_id_processo);
-                                
-		-- descobre qual a etapa final do processo -- 
-        select e.id into id_etapa_final 
-		from etapa e join fluxo_execucao f on f.id_origem = e.id
-        where f.id_origem = f.id_destino
-        limit 1;
+        -- a última etapa do processo fica em processo.id_exec_atual (busca pela chave primária); --
+        -- o FOR UPDATE serializa transições simultâneas do mesmo processo --
+        select id_exec_atual, id_etapa_atual into id_exec_anterior, id_ultima_etapa
+        from processo
+        where id = novo_id_processo
+        for update;
         
         -- verifica se precisa de anexo --
         SET precisa_anexo = anexoObrigatorio(novo_id_etapa);
@@ -123,16 +296,12 @@ in novo_observacoes text, in novo_anexo varchar(255))
                     SET MESSAGE_TEXT = 'Essa etapa exige envio de anexo';
 				END IF;
             
-            -- se for a última etapa, não cria nova etapa e atualiza o processo como concluído -- 
-            IF id_ultima_etapa = id_etapa_final THEN
+            -- etapa final: o fluxo (já validado acima) é o laço da etapa atual para ela mesma; --
+            -- não cria nova etapa e atualiza o processo como concluído -- 
+            IF novo_id_etapa = id_ultima_etapa THEN
             
-				update execucao_etapa set data_fim = now()
-				where id_etapa = id_ultima_etapa
-				and id_processo = novo_id_processo;
-                
-				update execucao_etapa set status_exec = 'CONCLUIDO'
-				where id_etapa = id_ultima_etapa
-				and id_processo = novo_id_processo;
+				update execucao_etapa set data_fim = now(), status_exec = 'CONCLUIDO'
+				where id = id_exec_anterior;
                 
                 update processo set status_proc = 'CONCLUIDO'
                 where id = novo_id_processo;
@@ -144,20 +313,38 @@ in novo_observacoes text, in novo_anexo varchar(255))
 	INSERT INTO execucao_etapa (id_processo, id_etapa, id_usuario, observacoes)
     VALUES (novo_id_processo, novo_id_etapa, novo_id_usuario, novo_observacoes);
     
-    -- depois de inserir a etapa nova, atualiza a anterior como concluída e adiciona a data_fim -- 
-	update execucao_etapa set data_fim = now()
-    where id_etapa = id_ultima_etapa
-    and id_processo = novo_id_processo;
+    update processo set id_exec_atual = LAST_INSERT_ID(), id_etapa_atual = novo_id_etapa,
+    id_usuario_atual = novo_id_usuario
+    where id = novo_id_processo;
+    
+    -- registra a participação do usuário no processo (lista de processos do orientador) --
+    INSERT IGNORE INTO participacao_processo (id_usuario, id_processo, data_inicio)
+    SELECT novo_id_usuario, id, data_inicio FROM processo
+    WHERE id = novo_id_processo;
     
-    update execucao_etapa set status_exec = 'CONCLUIDO'
-    where id_etapa = id_ultima_etapa
-    and id_processo = novo_id_processo;
+    -- depois de inserir a etapa nova, atualiza a anterior como concluída e adiciona a data_fim -- 
+	update execucao_etapa set data_fim = now(), status_exec = 'CONCLUIDO'
+    where id = id_exec_anterior;
 		END controle_insert;
 END 
 $$
 DELIMITER ;
 
--- 3.2. TRANSAÇÃO PARA, SE A EXECUÇÃO_ETAPA N. 1 FALHAR, NÃO HAVER INSERÇÃO DE NOVO PROCESSO -- 
+-- 3.2. CRIA O PROCESSO E A SUA PRIMEIRA EXECUÇÃO, SEM CONTROLAR A TRANSAÇÃO (QUEM CHAMA FAZ O COMMIT) --
+DELIMITER $$
+CREATE PROCEDURE criacaoProcesso(in novo_id_template bigint, in novo_id_usuario bigint, 
+in novo_id_etapa bigint, in novo_observacoes text, in novo_anexo varchar(255), out novo_id_processo bigint)
+BEGIN
+	insert into processo (id_template, id_usuario) values
+	(novo_id_template, novo_id_usuario); 
+    
+    SET novo_id_processo = LAST_INSERT_ID();
+        
+	CALL validacaoEtapas(novo_id_processo, novo_id_etapa, novo_id_usuario, novo_observacoes, novo_anexo);
+END $$
+DELIMITER ;
+
+-- 3.3. TRANSAÇÃO PARA, SE A EXECUÇÃO_ETAPA N. 1 FALHAR, NÃO HAVER INSERÇÃO DE NOVO PROCESSO -- 
 DELIMITER $$
 CREATE PROCEDURE criacaoProcessoEtapa(in novo_id_template bigint, in novo_id_usuario bigint, 
 in novo_id_etapa bigint, in novo_observacoes text, in novo_anexo varchar(255))
@@ -170,12 +357,7 @@ BEGIN
     END;
         
 START TRANSACTION;
-	insert into processo (id_template, id_usuario) values
-	(novo_id_template, novo_id_usuario); 
-    
-    SET novo_id_processo = LAST_INSERT_ID();
-        
-	CALL validacaoEtapas(novo_id_processo, novo_id_etapa, novo_id_usuario, novo_observacoes, novo_anexo);
+	CALL criacaoProcesso(novo_id_template, novo_id_usuario, novo_id_etapa, novo_observacoes, novo_anexo, novo_id_processo);
     
     COMMIT;
     
@@ -208,6 +390,143 @@ CREATE TRIGGER insertExecucao
 $$ 
 DELIMITER ;
 
+-- 4.2. REGISTRAM EM 'mudanca' AS INSERÇÕES, ALTERAÇÕES E REMOÇÕES DE PROCESSO E EXECUCAO_ETAPA --
+DELIMITER $$
+CREATE TRIGGER mudancaProcessoInsert
+	AFTER INSERT ON processo
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO mudanca (tabela, id_registro, id_processo) VALUES ('processo', NEW.id, NEW.id);
+	END
+$$
+
+CREATE TRIGGER mudancaProcessoUpdate
+	AFTER UPDATE ON processo
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO mudanca (tabela, id_registro, id_processo) VALUES ('processo', NEW.id, NEW.id);
+	END
+$$
+
+CREATE TRIGGER mudancaExecucaoInsert
+	AFTER INSERT ON execucao_etapa
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO mudanca (tabela, id_registro, id_processo) VALUES ('execucao_etapa', NEW.id, NEW.id_processo);
+	END
+$$
+
+CREATE TRIGGER mudancaExecucaoUpdate
+	AFTER UPDATE ON execucao_etapa
+    FOR EACH ROW
+    BEGIN
+		-- reservar/renovar/liberar só mexem na reserva, que não faz parte do feed
+		IF NOT (OLD.status_exec <=> NEW.status_exec AND OLD.observacoes <=> NEW.observacoes
+			AND OLD.data_fim <=> NEW.data_fim AND OLD.anexo <=> NEW.anexo
+			AND OLD.id_usuario <=> NEW.id_usuario AND OLD.id_etapa <=> NEW.id_etapa) THEN
+			INSERT INTO mudanca (tabela, id_registro, id_processo) VALUES ('execucao_etapa', NEW.id, NEW.id_processo);
+		END IF;
+	END
+$$
+
+-- remoções: exclusão das linhas (jobs excluir_template/excluir_etapa) e ocultação do template ou da etapa --
+CREATE TRIGGER mudancaProcessoDelete
+	AFTER DELETE ON processo
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO mudanca (tabela, id_registro, id_processo, removido) VALUES ('processo', OLD.id, OLD.id, TRUE);
+	END
+$$
+
+CREATE TRIGGER mudancaExecucaoDelete
+	AFTER DELETE ON execucao_etapa
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO mudanca (tabela, id_registro, id_processo, removido) VALUES ('execucao_etapa', OLD.id, OLD.id_processo, TRUE);
+	END
+$$
+
+CREATE TRIGGER mudancaTemplateOculto
+	AFTER UPDATE ON template_processo
+    FOR EACH ROW
+    BEGIN
+		IF NEW.oculto AND NOT OLD.oculto THEN
+			INSERT INTO mudanca (tabela, id_registro, id_processo, removido)
+			SELECT 'processo', p.id, p.id, TRUE FROM processo p WHERE p.id_template = NEW.id;
+		END IF;
+	END
+$$
+
+CREATE TRIGGER mudancaEtapaOculta
+	AFTER UPDATE ON etapa
+    FOR EACH ROW
+    BEGIN
+		IF NEW.oculto AND NOT OLD.oculto THEN
+			INSERT INTO mudanca (tabela, id_registro, id_processo, removido)
+			SELECT 'execucao_etapa', ee.id, ee.id_processo, TRUE FROM execucao_etapa ee WHERE ee.id_etapa = NEW.id;
+		END IF;
+	END
+$$
+DELIMITER ;
+
+-- 4.3. INVALIDAM O CACHE DE DIMENSÕES QUANDO TEMPLATE_PROCESSO, USUARIO OU ETAPA MUDAM --
+-- inserções não invalidam: ids novos ainda não estão no cache e são buscados quando aparecem --
+DELIMITER $$
+CREATE TRIGGER dimensaoTemplateUpdate
+	AFTER UPDATE ON template_processo
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO versao_dimensao (tabela, versao) VALUES ('template_processo', 1)
+		ON DUPLICATE KEY UPDATE versao = versao + 1;
+	END
+$$
+
+CREATE TRIGGER dimensaoTemplateDelete
+	AFTER DELETE ON template_processo
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO versao_dimensao (tabela, versao) VALUES ('template_processo', 1)
+		ON DUPLICATE KEY UPDATE versao = versao + 1;
+	END
+$$
+
+CREATE TRIGGER dimensaoUsuarioUpdate
+	AFTER UPDATE ON usuario
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO versao_dimensao (tabela, versao) VALUES ('usuario', 1)
+		ON DUPLICATE KEY UPDATE versao = versao + 1;
+	END
+$$
+
+CREATE TRIGGER dimensaoUsuarioDelete
+	AFTER DELETE ON usuario
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO versao_dimensao (tabela, versao) VALUES ('usuario', 1)
+		ON DUPLICATE KEY UPDATE versao = versao + 1;
+	END
+$$
+
+CREATE TRIGGER dimensaoEtapaUpdate
+	AFTER UPDATE ON etapa
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO versao_dimensao (tabela, versao) VALUES ('etapa', 1)
+		ON DUPLICATE KEY UPDATE versao = versao + 1;
+	END
+$$
+
+CREATE TRIGGER dimensaoEtapaDelete
+	AFTER DELETE ON etapa
+    FOR EACH ROW
+    BEGIN
+		INSERT INTO versao_dimensao (tabela, versao) VALUES ('etapa', 1)
+		ON DUPLICATE KEY UPDATE versao = versao + 1;
+	END
+$$
+DELIMITER ;
+
 -- 5. VIEWS --
 CREATE VIEW v_etapa_processo AS (SELECT tp.id as 'id_template',tp.nome as 'nome_processo', e.id as 'id_etapa', e.nome as 'nome_etapa'
 from template_processo tp join etapa e on tp.id = e.id_template);
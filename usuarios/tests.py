@@ -1,3 +1,31 @@
-from django.test import TestCase
+from bdedica.testes import OrcamentoTestCase
 
-# Create your tests here.
+COORDENADOR = 3
+
+
+class UsuarioOrcamentoTests(OrcamentoTestCase):
+
+    def test_login(self):
+        with self.orcamento(max_sql=1):
+            response = self.client.post('/api/login/', {"username": "f.oliveira", "password": "4321"}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.data)
+
+    def test_login_refresh(self):
+        refresh = self.client.post('/api/login/', {"username": "f.oliveira", "password": "4321"}, format='json').data['refresh']
+        with self.orcamento(max_sql=0):
+            response = self.client.post('/api/login/refresh/', {"refresh": refresh}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_criar(self):
+        self.autenticar(COORDENADOR)
+        dados = {
+            "username": "novo_orientador",
+            "nome": "Novo Orientador",
+            "cargo": "ORIENTADOR",
+            "password": "senha_segura_456",
+            "password2": "senha_segura_456"
+        }
+        with self.orcamento(max_sql=1):
+            response = self.client.post('/api/criar/', dados, format='json')
+        self.assertEqual(response.status_code, 201)
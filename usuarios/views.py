@@ -1,4 +1,4 @@
-from django.db import connection, IntegrityError
+from django.db import connection, transaction, IntegrityError
 from django.db.utils import OperationalError
 from django.contrib.auth.hashers import make_password
 from rest_framework import generics, status
@@ -6,6 +6,8 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework_simplejwt.views import TokenObtainPairView
 
+from processos import shards
+
 from .serializers import CustomTokenObtainPairSerializer, UsuarioCreateSerializer
 
 class UsuarioCreateView(generics.CreateAPIView):
@@ -34,9 +36,11 @@ class UsuarioCreateView(generics.CreateAPIView):
         ]
 
         try:
-            with connection.cursor() as cursor:
+            with transaction.atomic(), connection.cursor() as cursor:
                 cursor.execute(sql, params)
                 new_id = cursor.lastrowid
+                # as chaves estrangeiras e o trigger insertExecucao de cada shard leem o usuário lá
+                shards.replicar_usuario(new_id)
             
             response_data = serializer.validated_data.copy()
             response_data.pop('password')